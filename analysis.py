@@ -0,0 +1,83 @@
+from opcodes import Opcode as O
+from operations import UNARY_OPS, BINARY_OPS
+
+# Load-time analysis over a function's decoded code (after createInnerBlocks).
+
+# operand stack effect of instructions with a fixed signature
+STACK_EFFECT = {
+    O.nop: 0,
+    O.drop: -1,
+    O.select: -2,
+    O.get_local: 1,
+    O.set_local: -1,
+    O.tee_local: 0,
+    O.get_global: 1,
+    O.set_global: -1,
+    O.i32_const: 1,
+    O.i64_const: 1,
+    O.f32_const: 1,
+    O.f64_const: 1,
+    O.current_memory: 1,
+    O.grow_memory: 0,
+}
+for op in (O.i32_load, O.i64_load, O.f32_load, O.f64_load,
+           O.i32_load8_s, O.i32_load8_u, O.i32_load16_s, O.i32_load16_u,
+           O.i64_load8_s, O.i64_load8_u, O.i64_load16_s, O.i64_load16_u,
+           O.i64_load32_s, O.i64_load32_u):
+    STACK_EFFECT[op] = 0
+for op in (O.i32_store, O.i64_store, O.f32_store, O.f64_store,
+           O.i32_store8, O.i32_store16, O.i64_store8, O.i64_store16, O.i64_store32):
+    STACK_EFFECT[op] = -2
+for op in UNARY_OPS:
+    STACK_EFFECT[op] = 0
+for op in BINARY_OPS:
+    STACK_EFFECT[op] = -1
+
+
+# Computes the operand stack height before every instruction (None where the
+# instruction is unreachable) and stores the entry height of every block in
+# InstrBlock.height. `signature_of(fnid)` and `type_signature(typeidx)` return
+# (params, results) of a call target.
+def stack_heights(fn, signature_of, type_signature=None):
+    code = fn.code
+    heights = [None] * (len(code) + 1)
+    fn.body.height = 0
+    height = 0
+    for i, instr in enumerate(code):
+        heights[i] = height
+        op = instr.opcode
+        if op in (O.block, O.loop, O.if_):
+            blk = instr.payload
+            if height is not None and op == O.if_:
+                height -= 1
+            blk.height = height
+        elif op == O.else_:
+            height = instr.payload.height
+        elif op == O.end:
+            blk = instr.payload
+            height = None if blk.height is None else blk.height + blk.arity
+        elif height is None:
+            continue
+        elif op in (O.br, O.br_table, O.return_, O.unreachable):
+            height = None
+        elif op == O.br_if:
+            height -= 1
+        elif op == O.call:
+            params, results = signature_of(instr.payload)
+            height += len(results) - len(params)
+        elif op == O.call_indirect:
+            params, results = type_signature(instr.payload[0])
+            height += len(results) - len(params) - 1
+        else:
+            height += STACK_EFFECT[op]
+    heights[len(code)] = height
+    return heights
+
+
+# instruction index execution continues at when branching to `blk`
+def branch_target(blk):
+    if blk.kind == O.loop:
+        return blk.startOffs + 1
+    if blk.parent is None:
+        return blk.endOffs  # function body: one past the last instruction
+    return blk.endOffs + 1
@@ -0,0 +1,538 @@
+#!/usr/bin/python3
+import argparse
+import collections
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cache
+import parallel
+import parser
+from interpreter import Interpreter, Module
+from opcodes import Opcode as O
+from tracing import TraceLevel, Tracer
+
+# Benchmarks tracked across changes. Loads run in a fresh child process each
+# so that the peak RSS reported belongs to that single load.
+
+
+def leb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def section(id, payload):
+    return bytes([id]) + leb128(len(payload)) + payload
+
+
+# a module with one memory and a single data segment of `size` bytes
+def data_module(size):
+    pages = (size + 0xffff) // 0x10000
+    memory = leb128(1) + b"\x00" + leb128(pages)
+    segment = leb128(0) + b"\x41\x00\x0b" + leb128(size) + bytes(range(256)) * (size // 256) + bytes(size % 256)
+    data = leb128(1) + segment
+    return b"\x00asm\x01\x00\x00\x00" + section(5, memory) + section(11, data)
+
+
+# a module with `count` functions of (i32, i32) -> i32, each about `body_size` bytes of straight-line code
+def code_module(count, body_size):
+    types = leb128(1) + b"\x60\x02\x7f\x7f\x01\x7f"
+    functions = leb128(count) + b"\x00" * count
+    step = b"\x20\x01\x41" + leb128(1000000) + b"\x6a\x73"  # x ^= (y + 1000000)
+    code = b"\x00\x20\x00" + step * (body_size // len(step)) + b"\x0b"
+    body = leb128(len(code)) + code
+    return (b"\x00asm\x01\x00\x00\x00" + section(1, types) + section(3, functions) +
+            section(10, leb128(count) + body * count))
+
+
+# a module with `pages` pages of memory and an export touch(addr, count) storing
+# an i32 every 64 KiB from addr on, `count` times
+def store_module(pages=4):
+    types = leb128(1) + b"\x60\x02\x7f\x7f\x00"
+    memory = leb128(1) + b"\x00" + leb128(pages)
+    code = (b"\x00\x02\x40\x03\x40"                             # block loop
+            b"\x20\x01\x45\x0d\x01"                             # br_if 1 (count == 0)
+            b"\x20\x00\x20\x01\x36\x02\x00"                     # i32.store (addr, count)
+            b"\x20\x00\x41\x80\x80\x04\x6a\x21\x00"             # addr += 0x10000
+            b"\x20\x01\x41\x01\x6b\x21\x01\x0c\x00\x0b\x0b\x0b")  # count -= 1, br 0
+    export = leb128(1) + leb128(5) + b"touch" + b"\x00" + leb128(0)
+    return (b"\x00asm\x01\x00\x00\x00" + section(1, types) + section(3, leb128(1) + b"\x00") +
+            section(5, memory) + section(7, export) + section(10, leb128(1) + leb128(len(code)) + code))
+
+
+# a module exporting the recursive fib(n) and depth(n), which recurses n times
+def calls_module():
+    types = leb128(1) + b"\x60\x01\x7f\x01\x7f"
+    fib = (b"\x00\x20\x00\x41\x02\x49\x04\x7f\x20\x00\x05"  # if n < 2: n
+           b"\x20\x00\x41\x01\x6b\x10\x00"                     # else fib(n - 1)
+           b"\x20\x00\x41\x02\x6b\x10\x00\x6a\x0b\x0b")       # + fib(n - 2)
+    depth = (b"\x00\x20\x00\x45\x04\x7f\x41\x00\x05"          # if n == 0: 0
+             b"\x20\x00\x41\x01\x6b\x10\x01\x41\x01\x6a\x0b\x0b")  # else depth(n - 1) + 1
+    export = leb128(2) + leb128(3) + b"fib" + b"\x00" + leb128(0) + leb128(5) + b"depth" + b"\x00" + leb128(1)
+    return (b"\x00asm\x01\x00\x00\x00" + section(1, types) + section(3, leb128(2) + b"\x00\x00") +
+            section(7, export) + section(10, leb128(2) + leb128(len(fib)) + fib + leb128(len(depth)) + depth))
+
+
+# peak resident set size of this process in KiB
+def peak_rss_kb():
+    # ru_maxrss survives exec, so a child would report its parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_once(path, use_mmap):
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        res = parser.Parser(f, use_mmap=use_mmap).parse()
+    parsed = time.perf_counter()
+    Interpreter(res).initialize()
+    done = time.perf_counter()
+    return {
+        "parse_s": parsed - start,
+        "instantiate_s": done - parsed,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def bench_load(paths):
+    print(f"{'module':28} {'size KiB':>9} {'mode':5} {'parse ms':>9} {'init ms':>8} {'peak RSS MiB':>13}")
+    for path in paths:
+        for mode in ("read", "mmap"):
+            out = subprocess.run([sys.executable, __file__, "load", "--child-load", path, mode],
+                                 check=True, capture_output=True, text=True).stdout
+            r = json.loads(out)
+            print(f"{os.path.basename(path):28} {os.path.getsize(path) / 1024:9.0f} {mode:5} "
+                  f"{r['parse_s'] * 1000:9.1f} {r['instantiate_s'] * 1000:8.1f} {r['peak_rss_kb'] / 1024:13.1f}")
+
+
+def bench_parse(paths, repeat=3):
+    print(f"{'module':28} {'size KiB':>9} {'parse ms':>9} {'MB/s':>8}")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                parser.Parser(f).parse()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{os.path.basename(path):28} {len(data) / 1024:9.0f} {best * 1000:9.1f} {len(data) / best / 1e6:8.2f}")
+
+
+def bench_startup(paths, engine="stack"):
+    print(f"{'module':28} {'size KiB':>9} {'eager ms':>9} {'lazy ms':>8}")
+    for path in paths:
+        times = []
+        for lazy in (False, True):
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                res = parser.Parser(f, lazy=lazy).parse()
+            Interpreter(res, engine=engine).initialize()
+            times.append(time.perf_counter() - start)
+        print(f"{os.path.basename(path):28} {os.path.getsize(path) / 1024:9.0f} {times[0] * 1000:9.1f} {times[1] * 1000:8.1f}")
+
+
+# code section decoding with 1, 2, 4, ... worker processes up to the core count
+def bench_decode(paths, workers=None):
+    if workers is None:
+        cores = os.cpu_count() or 1
+        workers = sorted({1 << i for i in range(cores.bit_length())} | {cores})
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'module':28} {'size KiB':>9} {'workers':>7} {'parse ms':>9} {'speedup':>8}")
+    for path in paths:
+        base = None
+        for n in workers:
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                parser.Parser(f, workers=n).parse()
+            elapsed = time.perf_counter() - start
+            base = elapsed if base is None else base
+            print(f"{os.path.basename(path):28} {os.path.getsize(path) / 1024:9.0f} {n:7} "
+                  f"{elapsed * 1000:9.1f} {base / elapsed:8.2f}")
+
+
+# parse and initialize without the module cache, on a miss and on a hit
+def bench_cache(paths, engine="stack"):
+    print(f"{'module':28} {'size KiB':>9} {'uncached ms':>11} {'miss ms':>8} {'hit ms':>7} {'entry KiB':>9}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for path in paths:
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                res = parser.Parser(f).parse()
+            Interpreter(res, engine=engine).initialize()
+            times = [time.perf_counter() - start]
+            for _ in range(2):
+                start = time.perf_counter()
+                res = cache.load_module(path, cache_dir)
+                Interpreter(res, engine=engine).initialize()
+                times.append(time.perf_counter() - start)
+            with open(path, "rb") as f:
+                entry = cache.entry_path(cache_dir, f.read())
+            print(f"{os.path.basename(path):28} {os.path.getsize(path) / 1024:9.0f} {times[0] * 1000:11.1f} "
+                  f"{times[1] * 1000:8.1f} {times[2] * 1000:7.1f} {os.path.getsize(entry) / 1024:9.0f}")
+
+
+# parse and prepare a Module once, then create instances of it
+def bench_instantiate(paths, count=100):
+    print(f"{'module':28} {'size KiB':>9} {'module ms':>9}  " + "  ".join(f"{e + ' us':>11}" for e in Interpreter.ENGINES))
+    for path in paths:
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            module = Module(parser.Parser(f).parse())
+        prepared = time.perf_counter() - start
+        times = []
+        for engine in Interpreter.ENGINES:
+            start = time.perf_counter()
+            for _ in range(count):
+                module.instantiate(engine=engine)
+            times.append((time.perf_counter() - start) / count)
+        print(f"{os.path.basename(path):28} {os.path.getsize(path) / 1024:9.0f} {prepared * 1000:9.1f}  " +
+              "  ".join(f"{t * 1e6:11.0f}" for t in times))
+
+
+# Resetting an instance between requests that each write `dirty` pages of a
+# `mb` MiB memory: a new instance of the prepared module vs restoring a snapshot.
+def bench_reset(mb, engine="stack", repeat=20):
+    module = Module(parser.Parser(store_module(mb * 16)).parse())
+    print(f"memory: {mb} MiB, engine: {engine}")
+    print(f"{'dirty pages':>11} {'instantiate ms':>14} {'restore ms':>10}")
+    for dirty in (0, 1, 16, 256):
+        if dirty > mb * 16:
+            break
+        start = time.perf_counter()
+        for _ in range(repeat):
+            module.instantiate(engine=engine).run_exported_fn("touch", [0, dirty])
+        fresh = (time.perf_counter() - start) / repeat
+        inst = module.instantiate(engine=engine)
+        snapshot = inst.snapshot()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            inst.run_exported_fn("touch", [0, dirty])
+            inst.restore(snapshot)
+        restore = (time.perf_counter() - start) / repeat
+        print(f"{dirty:11} {fresh * 1000:14.2f} {restore * 1000:10.2f}")
+
+
+# elements per second for an export called over `count` argument tuples:
+# one call per tuple on the stack and python engines (timed on a sample)
+# vs a single lane-parallel batch
+def bench_batch(count=100000):
+    import numpy as np
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    rng = np.random.default_rng(0)
+    cases = [
+        ("add.wasm", "add_one", [rng.integers(-2**31, 2**31, count)]),
+        ("xor.wasm", "XOR", [rng.integers(-2**31, 2**31, count), rng.integers(-2**31, 2**31, count)]),
+        ("add.wasm", "fac", [rng.integers(0, 13, count)]),
+        ("factorial.wasm", "fac", [rng.integers(0, 13, count).astype(np.float64)]),
+    ]
+    print(f"{count} argument tuples, elements per second")
+    print(f"{'export':24} {'stack':>10} {'python':>10} {'batch':>12} {'numpy op':>12}")
+    for file, name, arrays in cases:
+        with open(os.path.join(examples, file), "rb") as f:
+            module = Module(parser.Parser(f).parse())
+        rates = []
+        for engine in ("stack", "python"):
+            inst = module.instantiate(engine=engine)
+            sample = min(count, 2000)
+            start = time.perf_counter()
+            for i in range(sample):
+                inst.run_exported_fn(name, [a[i].item() for a in arrays])
+            rates.append(sample / (time.perf_counter() - start))
+        inst = module.instantiate()
+        inst.run_exported_fn_batch(name, [a[:1] for a in arrays])  # imports lanes.py
+        start = time.perf_counter()
+        inst.run_exported_fn_batch(name, arrays)
+        rates.append(count / (time.perf_counter() - start))
+        # one NumPy operation over the same number of lanes, as the ceiling
+        a = arrays[0].astype(np.uint32)
+        start = time.perf_counter()
+        a ^ a
+        rates.append(count / (time.perf_counter() - start))
+        print(f"{file + ':' + name:24} {rates[0]:10.0f} {rates[1]:10.0f} {rates[2]:12.0f} {rates[3]:12.0f}")
+
+
+# rows per second of an export mapped over worker processes, including pool
+# startup, against calling it in this process
+def bench_map(workers=None, count=20000):
+    if workers is None:
+        cores = os.cpu_count() or 1
+        workers = sorted({1 << i for i in range(cores.bit_length())} | {cores})
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    path = os.path.join(examples, "add.wasm")
+    rows = [[str(i % 13)] for i in range(count)]
+    print(f"cores: {os.cpu_count()}, {count} rows of add.wasm:fac")
+    print(f"{'workers':>7} {'rows/s':>10} {'speedup':>8}")
+    with open(path, "rb") as f:
+        inst = Module(parser.Parser(f).parse()).instantiate()
+    start = time.perf_counter()
+    for row in rows:
+        inst.run_exported_fn("fac", row)
+    base = count / (time.perf_counter() - start)
+    print(f"{'inline':>7} {base:10.0f} {1:8.2f}")
+    for n in workers:
+        start = time.perf_counter()
+        for _ in parallel.map_exported_fn(path, "fac", rows, n):
+            pass
+        rate = count / (time.perf_counter() - start)
+        print(f"{n:7} {rate:10.0f} {rate / base:8.2f}")
+
+
+# time per call of exports with and without fuel metering, and the fuel
+# (about the number of instructions) each call takes
+def bench_fuel(repeat=2000):
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    cases = [("add.wasm", "fac", [12]), ("factorial.wasm", "fac", [20]), ("simple.wasm", "addTwo", [1, 2]),
+             ("xor.wasm", "XOR", [5, 3])]
+    print(f"{'export':24} {'fuel':>6} {'plain us':>9} {'metered us':>10} {'overhead':>8}")
+    for file, name, args in cases:
+        with open(os.path.join(examples, file), "rb") as f:
+            inst = Module(parser.Parser(f).parse()).instantiate()
+        # rounds alternate so that both see the same load on the machine
+        times = [None, None]
+        for _ in range(7):
+            for k, fuel in enumerate((None, 10**9)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    inst.run_exported_fn(name, args, fuel)
+                elapsed = (time.perf_counter() - start) / repeat
+                times[k] = elapsed if times[k] is None else min(times[k], elapsed)
+        print(f"{file + ':' + name:24} {10**9 - inst.fuel:6} {times[0] * 1e6:9.1f} {times[1] * 1e6:10.1f} "
+              f"{times[1] / times[0] - 1:8.1%}")
+
+
+# calls per second of the recursive fib(n) per engine, and the deepest
+# recursion the stack engine gets through
+def bench_calls(n=20):
+    module = Module(parser.Parser(calls_module()).parse())
+    calls = 2 * fib(n + 1) - 1
+    print(f"fib({n}): {calls} calls")
+    print(f"{'engine':10} {'ms':>8} {'calls/s':>10}")
+    for engine in Interpreter.ENGINES:
+        inst = module.instantiate(engine=engine)
+        try:
+            start = time.perf_counter()
+            inst.run_exported_fn("fib", [n])
+            elapsed = time.perf_counter() - start
+        except RecursionError:
+            print(f"{engine:10} {'recursion limit':>19}")
+            continue
+        print(f"{engine:10} {elapsed * 1000:8.1f} {calls / elapsed:10.0f}")
+    inst = module.instantiate()
+    for depth in (1000, 10000, 100000, 1000000):
+        start = time.perf_counter()
+        assert inst.run_exported_fn("depth", [depth]) == depth
+        print(f"stack engine, recursion depth {depth}: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+# time to validate modules of growing code size (which should grow
+# linearly), and calls per second of instances of a validated module, which
+# skip the interpreter's consistency checks
+def bench_validate(sizes=(1, 2, 4, 8)):
+    import validation
+    print(f"{'code KiB':>8} {'instrs':>8} {'validate ms':>11} {'us/instr':>8}")
+    for mb in sizes:
+        res = parser.Parser(code_module(mb * 16, 8192)).parse()
+        validation.validate_module(res)
+        module = Module(res)
+        instrs = sum(len(body.code) for body in module.bodies)
+        start = time.perf_counter()
+        validation.validate_module(res)
+        for i, (locals, code) in enumerate(res.code_section):
+            validation.validate_function(module, i, module.function_types[i], locals, code)
+        elapsed = time.perf_counter() - start
+        print(f"{mb * 128:8} {instrs:8} {elapsed * 1000:11.1f} {elapsed / instrs * 1e6:8.2f}")
+    res = parser.Parser(calls_module()).parse()
+    for validate in (False, True):
+        inst = Module(res, validate).instantiate()
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            inst.run_exported_fn("fib", [18])
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"fib(18), {'validated' if validate else 'not validated':13}: {best * 1000:.1f} ms")
+
+
+# exports run by the fusion benchmark: (module file or generator, export, arguments)
+FUSION_CORPUS = [
+    ("add.wasm", "fac", [12]),
+    ("factorial.wasm", "fac", [20]),
+    ("simple.wasm", "addTwo", [1, 2]),
+    ("xor.wasm", "XOR", [5, 3]),
+    ("hello.wasm", "_memset", [1024, 7, 300]),
+    ("hello.wasm", "_memcpy", [2048, 1024, 301]),
+    ("hello.wasm", "_llvm_bswap_i32", [12345]),
+    (calls_module, "fib", [15]),
+    (store_module, "touch", [0, 4]),
+]
+
+
+# collects the opcodes of the executed instructions from an instr trace
+class OpcodeSink:
+    def __init__(self):
+        self.opcodes = []
+
+    def emit(self, record):
+        if record.event == "instr" and isinstance(record.args[0], int):
+            self.opcodes.append(record.args[1].opcode)
+
+
+# The pairs and triples of executed instructions that superinstructions
+# could replace (see fusion.py), each example weighted equally, then per
+# example the instructions dispatched and the time per call without and
+# with superinstructions.
+def bench_fusion(repeat=200, top=12):
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    # execution only continues after these by falling through (or br_if)
+    straight = lambda op: op not in (O.block, O.loop, O.if_, O.else_, O.end, O.br, O.br_table, O.return_,
+                                     O.call, O.call_indirect)
+    cases = []
+    ngrams = {2: collections.Counter(), 3: collections.Counter()}
+    for source, name, args in FUSION_CORPUS:
+        if callable(source):
+            label, data = f"{source.__name__}:{name}", source()
+        else:
+            label = f"{source}:{name}"
+            with open(os.path.join(examples, source), "rb") as f:
+                data = f.read()
+        module = Module(parser.Parser(data).parse())
+        counts = []
+        for fuse in (False, True):
+            sink = OpcodeSink()
+            module.instantiate(Tracer(TraceLevel.instr, sink), fuse=fuse).run_exported_fn(name, args)
+            counts.append(len(sink.opcodes))
+            if not fuse:
+                executed = sink.opcodes
+        for n, counter in ngrams.items():
+            for i in range(len(executed) - n + 1):
+                seq = tuple(executed[i:i + n])
+                if all(straight(op) for op in seq[:-1]) and (straight(seq[-1]) or seq[-1] == O.br_if):
+                    counter[seq] += 1 / len(executed)
+        times = []
+        for fuse in (False, True):
+            inst = module.instantiate(fuse=fuse)
+            best = None
+            for _ in range(5):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    inst.run_exported_fn(name, args)
+                elapsed = (time.perf_counter() - start) / repeat
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        cases.append((label, counts, times))
+    for n, counter in ngrams.items():
+        print(f"most frequent executed {'pairs' if n == 2 else 'triples'} (share of instructions, mean over examples)")
+        for seq, share in counter.most_common(top):
+            print(f"  {share / len(FUSION_CORPUS):6.1%}  " + " ".join(op.name for op in seq))
+    print(f"{'export':30} {'dispatched':>10} {'fused':>7} {'saved':>6} {'plain us':>9} {'fused us':>9} {'speedup':>7}")
+    for label, (plain, fused), (plain_t, fused_t) in cases:
+        print(f"{label:30} {plain:10} {fused:7} {1 - fused / plain:6.1%} {plain_t * 1e6:9.1f} {fused_t * 1e6:9.1f} "
+              f"{plain_t / fused_t:7.2f}")
+
+
+def fib(n):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Interpreter benchmarks")
+    ap.add_argument("benchmark", choices=["load", "parse", "startup", "decode", "cache", "instantiate", "reset", "batch",
+                                              "map", "fuel", "calls", "validate", "fusion"],
+                    help="load: parse time and peak RSS with and without mmap, parse: parse throughput, "
+                    "startup: parse and initialize with eager and lazy body decoding, "
+                    "decode: parse time with the code section decoded by 1, 2, 4, ... processes, "
+                    "cache: parse and initialize without, missing and hitting the module cache, "
+                    "instantiate: time to create an instance of an already prepared module per engine, "
+                    "reset: run a request writing N pages and reset by re-instantiating or restoring a snapshot, "
+                    "batch: calls per second of exports over many arguments, one by one and as a NumPy batch, "
+                    "map: rows per second of an export mapped over 1, 2, 4, ... worker processes, "
+                    "fuel: time per call with and without fuel metering, "
+                    "calls: speed of a recursive function and the deepest recursion, "
+                    "validate: validation time by code size and calls of a validated module, "
+                    "fusion: executed instruction pairs and triples, and dispatches and time per call "
+                    "with and without superinstructions")
+    ap.add_argument("files", nargs="*", help="modules to load (default: examples/*.wasm and a generated one)")
+    ap.add_argument("--data-mb", type=int, default=64,
+                    help="size of the data section of the generated module, for reset of its memory (default: 64)")
+    ap.add_argument("--code-mb", type=int, default=4,
+                    help="size of the code section of the generated module (default: 4)")
+    ap.add_argument("--workers", type=lambda s: [int(n) for n in s.split(",")], metavar="N,N,...",
+                    help="decode, map: worker counts to compare (default: powers of two up to the core count)")
+    ap.add_argument("--child-load", nargs=2, metavar=("FILE", "MODE"), help=argparse.SUPPRESS)
+    opts = ap.parse_args()
+    if opts.child_load:
+        path, mode = opts.child_load
+        print(json.dumps(load_once(path, mode == "mmap")))
+        return
+    if opts.benchmark == "reset":
+        bench_reset(opts.data_mb)
+        return
+    if opts.benchmark == "batch":
+        bench_batch()
+        return
+    if opts.benchmark == "map":
+        bench_map(opts.workers)
+        return
+    if opts.benchmark == "fuel":
+        bench_fuel()
+        return
+    if opts.benchmark == "calls":
+        bench_calls()
+        return
+    if opts.benchmark == "validate":
+        bench_validate()
+        return
+    if opts.benchmark == "fusion":
+        bench_fusion()
+        return
+
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    paths = opts.files or sorted(os.path.join(examples, f) for f in os.listdir(examples) if f.endswith(".wasm"))
+    with tempfile.TemporaryDirectory() as tmp:
+        if opts.benchmark == "load":
+            big = os.path.join(tmp, f"data_{opts.data_mb}mb.wasm")
+            module = data_module(opts.data_mb << 20)
+        else:
+            big = os.path.join(tmp, f"code_{opts.code_mb}mb.wasm")
+            module = code_module(opts.code_mb * 128, 8192)
+        with open(big, "wb") as f:
+            f.write(module)
+        del module
+        if opts.benchmark == "load":
+            bench_load(paths + [big])
+        elif opts.benchmark == "parse":
+            bench_parse(paths + [big])
+        elif opts.benchmark == "decode":
+            bench_decode(paths + [big], opts.workers)
+        elif opts.benchmark == "cache":
+            bench_cache(paths + [big])
+        elif opts.benchmark == "instantiate":
+            bench_instantiate(paths)
+        else:
+            bench_startup(paths + [big])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+
+import optimizer
+import parser
+from interpreter import Module
+from tracing import TraceLevel, NO_TRACE
+
+# On-disk cache of prepared modules: the parse result with every function
+# body decoded, its constants canonicalised and its blocks resolved (see
+# Interpreter.prepare_body), so that a hit replaces parsing and preparing by
+# reading one file. Entries are named after the SHA-256 of the module bytes,
+# the interpreter version and the optimization level; a file holds a small header followed by a
+# zlib compressed pickle of the ParseData. The cache directory is trusted
+# like the code.
+
+MAGIC = b"WASMPREP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sI")
+
+# modules that determine what a prepared module looks like
+SOURCES = ("parser.py", "opcodes.py", "operations.py", "analysis.py", "validation.py", "optimizer.py",
+           "memory.py", "fusion.py", "interpreter.py", "cache.py")
+
+_version = None
+
+
+# digest of the interpreter sources, so that a changed interpreter never
+# reads entries written by an older one
+def interpreter_version():
+    global _version
+    if _version is None:
+        h = hashlib.sha256(FORMAT_VERSION.to_bytes(4, "little"))
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in SOURCES:
+            with open(os.path.join(here, name), "rb") as f:
+                h.update(f.read())
+        _version = h.hexdigest()[:16]
+    return _version
+
+
+def entry_path(cache_dir, module_bytes, opt_level=optimizer.DEFAULT_LEVEL):
+    return os.path.join(cache_dir, f"{hashlib.sha256(module_bytes).hexdigest()}-{interpreter_version()}"
+                                   f"-O{opt_level}.wprep")
+
+
+# Makes a parse result self-contained: bodies validated and prepared, and
+# data segments copied out of the source buffer. Only valid modules are
+# cached.
+def prepare(res, opt_level=optimizer.DEFAULT_LEVEL):
+    if res.code_section:
+        module = Module(res, validate=True, opt_level=opt_level)
+        res.code_section = [module.body(index) for index in range(len(module.bodies))]
+    if res.data_section:
+        res.data_section = [(index, offset, size, bytes(data)) for index, offset, size, data in res.data_section]
+    return res
+
+
+# the ParseData stored at `path`, or None if there is none or it cannot be used
+def read_entry(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < HEADER.size or HEADER.unpack_from(data) != (MAGIC, FORMAT_VERSION):
+        return None
+    try:
+        return pickle.loads(zlib.decompress(memoryview(data)[HEADER.size:]))
+    except Exception:
+        return None
+
+
+# Writes to a temporary file renamed into place, so that concurrent runs
+# never see a partial entry. Returns whether the entry was written.
+def write_entry(path, res):
+    try:
+        payload = zlib.compress(pickle.dumps(res, pickle.HIGHEST_PROTOCOL), 1)
+    except RecursionError:  # blocks nested too deeply to pickle
+        return False
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+            f.write(payload)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        return False
+    return True
+
+
+# Parse result of the module at `path`, prepared at `opt_level`, from
+# `cache_dir` if it is there and parsed (with the parser options
+# `parser_args`) and stored otherwise.
+def load_module(path, cache_dir, tracer=NO_TRACE, opt_level=optimizer.DEFAULT_LEVEL, **parser_args):
+    trace = tracer.channel(TraceLevel.info, "cache")
+    with open(path, "rb") as f:
+        module_bytes = f.read()
+    entry = entry_path(cache_dir, module_bytes, opt_level)
+    res = read_entry(entry)
+    if res is not None:
+        trace("hit:", entry)
+        return res
+    trace("miss:", entry)
+    res = prepare(parser.Parser(module_bytes, tracer, **parser_args).parse(), opt_level)
+    if not write_entry(entry, res):
+        trace("could not write", entry)
+    return res
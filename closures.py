@@ -0,0 +1,397 @@
+from opcodes import Opcode as O
+from operations import *
+import analysis
+import memory
+import struct
+
+# Closure-compiled engine: every function body is translated once into a flat
+# list of closures with operands, local indices and jump targets baked in.
+# Each closure takes (stack, locals) and returns the index of the next
+# closure to run. block/loop/end/nop need no runtime work (stack heights are
+# resolved statically) and are not emitted at all.
+
+_NO_CODE = (O.block, O.loop, O.end, O.nop)
+
+
+def execute(fn, params):
+    locals = list(params)
+    locals.extend(fn.local_defaults)
+    stack = []
+    code = fn.closures
+    pc = 0
+    end = len(code)
+    while pc < end:
+        pc = code[pc](stack, locals)
+    return stack[-1] if stack else None
+
+
+def compile_function(interp, fn):
+    code = fn.code
+    heights = analysis.stack_heights(fn, interp.fn_signature, interp.type_signature)
+    # closure index for every instruction index (and one past the end)
+    index_map = []
+    emitted = 0
+    for i, instr in enumerate(code):
+        index_map.append(emitted)
+        if heights[i] is not None and instr.opcode not in _NO_CODE:
+            emitted += 1
+    index_map.append(emitted)
+
+    closures = []
+    for i, instr in enumerate(code):
+        if heights[i] is None or instr.opcode in _NO_CODE:
+            continue
+        nxt = index_map[i + 1]
+        closures.append(_make(interp, instr, nxt, heights[i], index_map))
+    return closures
+
+
+def _branch(blk, height, index_map):
+    # returns the target index, and the (height, arity) adjustment or None if
+    # the operand stack is statically known to be in shape already
+    target = index_map[analysis.branch_target(blk)]
+    arity = blk.branch_arity()
+    if height == blk.height + arity:
+        return target, None
+    return target, (blk.height, arity)
+
+
+def _make(interp, instr, nxt, height, index_map):
+    op = instr.opcode
+    p = instr.payload
+
+    if op == O.get_local:
+        def get_local(stack, locals):
+            stack.append(locals[p])
+            return nxt
+        return get_local
+    if op == O.set_local:
+        def set_local(stack, locals):
+            locals[p] = stack.pop()
+            return nxt
+        return set_local
+    if op == O.tee_local:
+        def tee_local(stack, locals):
+            locals[p] = stack[-1]
+            return nxt
+        return tee_local
+    if op in (O.i32_const, O.i64_const, O.f32_const, O.f64_const):
+        def const(stack, locals):
+            stack.append(p)
+            return nxt
+        return const
+
+    fast = _FAST_BINARY.get(op)
+    if fast is not None:
+        return fast(nxt)
+    if op in BINARY_OPS:
+        fn = BINARY_OPS[op]
+        def binary(stack, locals):
+            b = stack.pop()
+            stack[-1] = fn(stack[-1], b)
+            return nxt
+        return binary
+    if op in UNARY_OPS:
+        fn = UNARY_OPS[op]
+        def unary(stack, locals):
+            stack[-1] = fn(stack[-1])
+            return nxt
+        return unary
+
+    if op in (O.br, O.br_if, O.return_):
+        if op == O.br_if:
+            height -= 1
+        target, adjust = _branch(p, height, index_map)
+        if op != O.br_if:
+            if adjust is None:
+                return lambda stack, locals: target
+            keep, arity = adjust
+            if arity:
+                def br_keep(stack, locals):
+                    stack[keep:] = stack[-1:]
+                    return target
+                return br_keep
+            def br(stack, locals):
+                del stack[keep:]
+                return target
+            return br
+        if adjust is None:
+            def br_if(stack, locals):
+                return target if stack.pop() else nxt
+            return br_if
+        keep, arity = adjust
+        def br_if_adjust(stack, locals):
+            if stack.pop():
+                if arity:
+                    stack[keep:] = stack[-1:]
+                else:
+                    del stack[keep:]
+                return target
+            return nxt
+        return br_if_adjust
+    if op == O.br_table:
+        blocks, default = p
+        height -= 1
+        branches = tuple(_branch(blk, height, index_map) for blk in blocks)
+        default_branch = _branch(default, height, index_map)
+        def br_table(stack, locals):
+            index = stack.pop()
+            target, adjust = branches[index] if index < len(branches) else default_branch
+            if adjust is not None:
+                keep, arity = adjust
+                if arity:
+                    stack[keep:] = stack[-1:]
+                else:
+                    del stack[keep:]
+            return target
+        return br_table
+    if op == O.if_:
+        else_target = index_map[(p.elseOffs if p.elseOffs != -1 else p.endOffs) + 1]
+        def if_(stack, locals):
+            return nxt if stack.pop() else else_target
+        return if_
+    if op == O.else_:
+        end_target = index_map[p.endOffs + 1]
+        return lambda stack, locals: end_target
+
+    if op == O.call:
+        callee = interp.functions[p]
+        argc = len(callee.params_types())
+        if callee.imported:
+            def call_import(stack, locals):
+                args = stack[len(stack) - argc:]
+                del stack[len(stack) - argc:]
+                res = callee.call(args)
+                if res is not None:
+                    stack.append(res)
+                return nxt
+            return call_import
+        if argc == 0:
+            def call0(stack, locals):
+                res = execute(callee, ())
+                if res is not None:
+                    stack.append(res)
+                return nxt
+            return call0
+        def call(stack, locals):
+            args = stack[-argc:]
+            del stack[-argc:]
+            res = execute(callee, args)
+            if res is not None:
+                stack.append(res)
+            return nxt
+        return call
+
+    if op == O.drop:
+        def drop(stack, locals):
+            stack.pop()
+            return nxt
+        return drop
+    if op == O.select:
+        def select(stack, locals):
+            cond = stack.pop()
+            val2 = stack.pop()
+            if cond == 0:
+                stack[-1] = val2
+            return nxt
+        return select
+    if op in memory.LOADS:
+        unpack_from, mask = memory.LOADS[op][0].unpack_from, memory.LOADS[op][1]
+        data = interp.memory.data
+        offset = p[1]
+        def load(stack, locals):
+            try:
+                value = unpack_from(data, stack[-1] + offset)[0]
+            except struct.error:
+                raise Trap(memory.OUT_OF_BOUNDS) from None
+            stack[-1] = value if mask is None else value & mask
+            return nxt
+        return load
+    if op in memory.STORES:
+        pack_into, mask = memory.STORES[op][0].pack_into, memory.STORES[op][1]
+        data, dirty = interp.memory.data, interp.memory.dirty
+        offset = p[1]
+        last = memory.STORES[op][0].size - 1
+        def store(stack, locals):
+            value = stack.pop()
+            addr = stack.pop() + offset
+            try:
+                pack_into(data, addr, value if mask is None else value & mask)
+            except struct.error:
+                raise Trap(memory.OUT_OF_BOUNDS) from None
+            dirty[addr >> 16] = dirty[(addr + last) >> 16] = 1
+            return nxt
+        return store
+    if op == O.current_memory:
+        mem = interp.memory
+        def current_memory(stack, locals):
+            stack.append(mem.pages)
+            return nxt
+        return current_memory
+    if op == O.grow_memory:
+        mem = interp.memory
+        def grow_memory(stack, locals):
+            stack[-1] = mem.grow(stack[-1])
+            return nxt
+        return grow_memory
+    if op == O.unreachable:
+        def unreachable(stack, locals):
+            raise Trap("unreachable executed")
+        return unreachable
+
+    def todo(stack, locals):
+        raise Exception("TODO implement")
+    return todo
+
+
+def _fast_add32(nxt):
+    def i32_add(stack, locals):
+        b = stack.pop()
+        stack[-1] = (stack[-1] + b) & MASK32
+        return nxt
+    return i32_add
+
+def _fast_sub32(nxt):
+    def i32_sub(stack, locals):
+        b = stack.pop()
+        stack[-1] = (stack[-1] - b) & MASK32
+        return nxt
+    return i32_sub
+
+def _fast_mul32(nxt):
+    def i32_mul(stack, locals):
+        b = stack.pop()
+        stack[-1] = (stack[-1] * b) & MASK32
+        return nxt
+    return i32_mul
+
+def _fast_add64(nxt):
+    def i64_add(stack, locals):
+        b = stack.pop()
+        stack[-1] = (stack[-1] + b) & MASK64
+        return nxt
+    return i64_add
+
+def _fast_sub64(nxt):
+    def i64_sub(stack, locals):
+        b = stack.pop()
+        stack[-1] = (stack[-1] - b) & MASK64
+        return nxt
+    return i64_sub
+
+def _fast_and(nxt):
+    def and_(stack, locals):
+        b = stack.pop()
+        stack[-1] &= b
+        return nxt
+    return and_
+
+def _fast_or(nxt):
+    def or_(stack, locals):
+        b = stack.pop()
+        stack[-1] |= b
+        return nxt
+    return or_
+
+def _fast_xor(nxt):
+    def xor(stack, locals):
+        b = stack.pop()
+        stack[-1] ^= b
+        return nxt
+    return xor
+
+def _fast_eq(nxt):
+    def eq(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] == b else 0
+        return nxt
+    return eq
+
+def _fast_ne(nxt):
+    def ne(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] != b else 0
+        return nxt
+    return ne
+
+def _fast_lt(nxt):
+    def lt(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] < b else 0
+        return nxt
+    return lt
+
+def _fast_gt(nxt):
+    def gt(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] > b else 0
+        return nxt
+    return gt
+
+def _fast_le(nxt):
+    def le(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] <= b else 0
+        return nxt
+    return le
+
+def _fast_ge(nxt):
+    def ge(stack, locals):
+        b = stack.pop()
+        stack[-1] = 1 if stack[-1] >= b else 0
+        return nxt
+    return ge
+
+def _fast_fadd(nxt):
+    def f64_add(stack, locals):
+        b = stack.pop()
+        stack[-1] += b
+        return nxt
+    return f64_add
+
+def _fast_fsub(nxt):
+    def f64_sub(stack, locals):
+        b = stack.pop()
+        stack[-1] -= b
+        return nxt
+    return f64_sub
+
+def _fast_fmul(nxt):
+    def f64_mul(stack, locals):
+        b = stack.pop()
+        stack[-1] *= b
+        return nxt
+    return f64_mul
+
+
+# unsigned and float comparisons map directly onto Python's operators
+_FAST_BINARY = {
+    O.i32_add: _fast_add32,
+    O.i32_sub: _fast_sub32,
+    O.i32_mul: _fast_mul32,
+    O.i64_add: _fast_add64,
+    O.i64_sub: _fast_sub64,
+    O.i32_and: _fast_and,
+    O.i32_or: _fast_or,
+    O.i32_xor: _fast_xor,
+    O.i64_and: _fast_and,
+    O.i64_or: _fast_or,
+    O.i64_xor: _fast_xor,
+    O.i32_eq: _fast_eq,
+    O.i32_ne: _fast_ne,
+    O.i32_lt_u: _fast_lt,
+    O.i32_gt_u: _fast_gt,
+    O.i32_le_u: _fast_le,
+    O.i32_ge_u: _fast_ge,
+    O.i64_eq: _fast_eq,
+    O.i64_ne: _fast_ne,
+    O.f64_eq: _fast_eq,
+    O.f64_ne: _fast_ne,
+    O.f64_lt: _fast_lt,
+    O.f64_gt: _fast_gt,
+    O.f64_le: _fast_le,
+    O.f64_ge: _fast_ge,
+    O.f64_add: _fast_fadd,
+    O.f64_sub: _fast_fsub,
+    O.f64_mul: _fast_fmul,
+}
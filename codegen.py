@@ -0,0 +1,467 @@
+import linecache
+import struct
+
+import analysis
+import memory
+import operations
+from opcodes import Opcode as O
+from operations import UNARY_OPS, BINARY_OPS
+
+# Ahead-of-time compiler from wasm functions to Python source.
+#
+# Wasm locals become Python locals l0, l1, ..., the operand stack value at
+# height h becomes s<h>. Pure, non-trapping expressions are kept on a
+# symbolic stack and folded into their consumer; anything that may trap or
+# has side effects is assigned to its stack variable right away. Blocks and
+# loops that are branch targets become `while True:` loops, so a branch is a
+# `break`/`continue`; branches crossing several Python loops set `_br` to the
+# target and are re-dispatched after each loop they leave.
+
+_M32 = "0xffffffff"
+_M64 = "0xffffffffffffffff"
+
+# (template, produces a Python bool)
+INLINE_BINARY = {
+    O.i32_add: ("(({a} + {b}) & " + _M32 + ")", False),
+    O.i32_sub: ("(({a} - {b}) & " + _M32 + ")", False),
+    O.i32_mul: ("(({a} * {b}) & " + _M32 + ")", False),
+    O.i64_add: ("(({a} + {b}) & " + _M64 + ")", False),
+    O.i64_sub: ("(({a} - {b}) & " + _M64 + ")", False),
+    O.i64_mul: ("(({a} * {b}) & " + _M64 + ")", False),
+    O.i32_and: ("({a} & {b})", False),
+    O.i32_or: ("({a} | {b})", False),
+    O.i32_xor: ("({a} ^ {b})", False),
+    O.i64_and: ("({a} & {b})", False),
+    O.i64_or: ("({a} | {b})", False),
+    O.i64_xor: ("({a} ^ {b})", False),
+    O.i32_shl: ("(({a} << ({b} & 31)) & " + _M32 + ")", False),
+    O.i32_shr_u: ("({a} >> ({b} & 31))", False),
+    O.i64_shl: ("(({a} << ({b} & 63)) & " + _M64 + ")", False),
+    O.i64_shr_u: ("({a} >> ({b} & 63))", False),
+    O.f64_add: ("({a} + {b})", False),
+    O.f64_sub: ("({a} - {b})", False),
+    O.f64_mul: ("({a} * {b})", False),
+    O.f32_add: ("f32({a} + {b})", False),
+    O.f32_sub: ("f32({a} - {b})", False),
+    O.f32_mul: ("f32({a} * {b})", False),
+    O.i32_lt_s: ("({a} ^ 0x80000000) < ({b} ^ 0x80000000)", True),
+    O.i32_gt_s: ("({a} ^ 0x80000000) > ({b} ^ 0x80000000)", True),
+    O.i32_le_s: ("({a} ^ 0x80000000) <= ({b} ^ 0x80000000)", True),
+    O.i32_ge_s: ("({a} ^ 0x80000000) >= ({b} ^ 0x80000000)", True),
+    O.i64_lt_s: ("({a} ^ 0x8000000000000000) < ({b} ^ 0x8000000000000000)", True),
+    O.i64_gt_s: ("({a} ^ 0x8000000000000000) > ({b} ^ 0x8000000000000000)", True),
+    O.i64_le_s: ("({a} ^ 0x8000000000000000) <= ({b} ^ 0x8000000000000000)", True),
+    O.i64_ge_s: ("({a} ^ 0x8000000000000000) >= ({b} ^ 0x8000000000000000)", True),
+}
+for _ops, _tmpl in (((O.i32_eq, O.i64_eq, O.f32_eq, O.f64_eq), "{a} == {b}"),
+                    ((O.i32_ne, O.i64_ne, O.f32_ne, O.f64_ne), "{a} != {b}"),
+                    ((O.i32_lt_u, O.i64_lt_u, O.f32_lt, O.f64_lt), "{a} < {b}"),
+                    ((O.i32_gt_u, O.i64_gt_u, O.f32_gt, O.f64_gt), "{a} > {b}"),
+                    ((O.i32_le_u, O.i64_le_u, O.f32_le, O.f64_le), "{a} <= {b}"),
+                    ((O.i32_ge_u, O.i64_ge_u, O.f32_ge, O.f64_ge), "{a} >= {b}")):
+    for _op in _ops:
+        INLINE_BINARY[_op] = (_tmpl, True)
+
+INLINE_UNARY = {
+    O.i32_wrap_i64: ("({a} & " + _M32 + ")", False),
+    O.i64_extend_u_i32: ("{a}", False),
+    O.f64_promote_f32: ("{a}", False),
+    O.f64_neg: ("(-{a})", False),
+    O.f32_neg: ("(-{a})", False),
+}
+
+# operations that raise Trap and therefore must not be deferred or dropped
+TRAPPING = {O.i32_div_s, O.i32_div_u, O.i32_rem_s, O.i32_rem_u,
+            O.i64_div_s, O.i64_div_u, O.i64_rem_s, O.i64_rem_u,
+            O.i32_trunc_s_f32, O.i32_trunc_u_f32, O.i32_trunc_s_f64, O.i32_trunc_u_f64,
+            O.i64_trunc_s_f32, O.i64_trunc_u_f32, O.i64_trunc_s_f64, O.i64_trunc_u_f64}
+
+SUPPORTED = (set(UNARY_OPS) | set(BINARY_OPS) |
+             {O.unreachable, O.nop, O.block, O.loop, O.if_, O.else_, O.end, O.br, O.br_if,
+              O.return_, O.call, O.drop, O.select, O.get_local, O.set_local, O.tee_local,
+              O.i32_const, O.i64_const, O.f32_const, O.f64_const,
+              O.current_memory, O.grow_memory} |
+             set(memory.LOADS) | set(memory.STORES))
+
+MAX_EXPR = 400  # longer expressions are spilled to a variable
+
+
+class Unsupported(Exception):
+    pass
+
+
+class _Expr:
+    def __init__(self, text, refs=(), is_bool=False):
+        self.text = text
+        self.refs = frozenset(refs)  # names of the variables read
+        self.is_bool = is_bool
+
+    def value(self):
+        return f"(1 if {self.text} else 0)" if self.is_bool else self.text
+
+    def cond(self):
+        return self.text
+
+
+class _Construct:
+    def __init__(self, blk, wrapped, indent):
+        self.blk = blk
+        self.wrapped = wrapped     # emitted as `while True:`
+        self.indent = indent       # indentation of the statement opening it
+        self.escapes = set()       # ids of outer targets branched to from inside
+        self.arm_start = 0         # line count at the start of the current if arm
+
+
+def _literal(value):
+    if isinstance(value, float):
+        if value != value:
+            return "nan"
+        if value in (float("inf"), float("-inf")):
+            return "inf" if value > 0 else "(-inf)"
+        return f"({value!r})"
+    return str(value)
+
+
+class _FunctionCompiler:
+    def __init__(self, interp, fn):
+        self.interp = interp
+        self.fn = fn
+        self.lines = []
+        self.indent = 1
+        self.vstack = []
+        self.constructs = []
+        self.uses_br = False
+        self.uses_memory = False
+        self.block_ids = {}
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def var(self, height):
+        return f"s{height}"
+
+    def block_id(self, blk):
+        return self.block_ids.setdefault(id(blk), len(self.block_ids))
+
+    def slot(self, height):
+        name = self.var(height)
+        return _Expr(name, (name,))
+
+    def store(self, height, text):
+        # pending expressions still reading the old value are evaluated first
+        name = self.var(height)
+        for h in range(len(self.vstack)):
+            if h != height and name in self.vstack[h].refs:
+                self.materialize(h)
+        self.emit(f"{name} = {text}")
+
+    def push(self, expr):
+        if len(expr.text) > MAX_EXPR:
+            self.assign_top(expr.value())
+        else:
+            self.vstack.append(expr)
+
+    def assign_top(self, text):
+        h = len(self.vstack)
+        self.store(h, text)
+        self.vstack.append(self.slot(h))
+
+    def materialize(self, height):
+        expr = self.vstack[height]
+        if expr.text != self.var(height):
+            self.store(height, expr.value())
+            self.vstack[height] = self.slot(height)
+
+    def materialize_all(self):
+        for h in range(len(self.vstack)):
+            self.materialize(h)
+
+    def unalias(self, local, keep_top):
+        name = f"l{local}"
+        end = len(self.vstack) - (1 if keep_top else 0)
+        for h in range(end):
+            if name in self.vstack[h].refs:
+                self.materialize(h)
+
+    def innermost_loop(self):
+        for c in reversed(self.constructs):
+            if c.wrapped:
+                return c
+        return None
+
+    def address(self, addr, offset):
+        return f"{addr.value()} + {offset}" if offset else addr.value()
+
+    def jump(self, blk):
+        # emit the statements transferring control to branch target `blk`;
+        # the branch value (if any) is already in s<blk.height>
+        if blk.parent is None:
+            self.emit(f"return {self.var(blk.height)}" if blk.arity else "return")
+            return
+        inner = self.innermost_loop()
+        if inner.blk is blk:
+            self.emit("continue" if blk.kind == O.loop else "break")
+            return
+        self.uses_br = True
+        target = self.block_id(blk)
+        for c in reversed(self.constructs):
+            if c.blk is blk:
+                break
+            if c.wrapped:
+                c.escapes.add(target)
+        self.emit(f"_br = {target}")
+        self.emit("break")
+
+    def branch(self, blk):
+        if blk.branch_arity():
+            name = self.var(blk.height)
+            top = self.vstack[-1]
+            if top.text != name:
+                self.emit(f"{name} = {top.value()}")
+        self.jump(blk)
+
+    def close_arm(self, construct):
+        if len(self.lines) == construct.arm_start:
+            self.emit("pass")
+
+    def close(self, construct, reachable):
+        blk = construct.blk
+        if blk.kind == O.if_:
+            self.close_arm(construct)
+            self.indent -= 1
+        if construct.wrapped:
+            if reachable:
+                self.emit("break")
+            self.indent -= 1
+        if construct.escapes:
+            # re-dispatch branches to targets outside this loop
+            outer = self.innermost_loop()
+            self.emit("if _br is not None:")
+            self.indent += 1
+            pending = set(construct.escapes)
+            own = self.block_id(outer.blk)
+            if own in pending:
+                pending.discard(own)
+                if pending:
+                    self.emit(f"if _br == {own}:")
+                    self.indent += 1
+                self.emit("_br = None")
+                self.emit("continue" if outer.blk.kind == O.loop else "break")
+                if pending:
+                    self.indent -= 1
+                    self.emit("break")
+            else:
+                self.emit("break")
+            self.indent -= 1
+            outer.escapes |= pending
+
+    def compile(self):
+        fn = self.fn
+        code = fn.code
+        for instr in code:
+            if instr.opcode not in SUPPORTED:
+                raise Unsupported(instr.opcode.name)
+        heights = analysis.stack_heights(fn, self.interp.fn_signature, self.interp.type_signature)
+        targeted = set()
+        for i, instr in enumerate(code):
+            if heights[i] is not None and instr.opcode in (O.br, O.br_if):
+                targeted.add(id(instr.payload))
+
+        nparams = len(fn.params_types())
+        for i, value in enumerate(fn.local_defaults):
+            self.emit(f"l{nparams + i} = {_literal(value)}")
+        header_len = len(self.lines)
+
+        for i, instr in enumerate(code):
+            op = instr.opcode
+            p = instr.payload
+            reachable = heights[i] is not None
+            if not reachable and op not in (O.else_, O.end):
+                continue
+
+            if op in (O.block, O.loop, O.if_):
+                if not reachable or p.height is None:
+                    continue
+                cond = self.vstack.pop() if op == O.if_ else None
+                self.materialize_all()
+                wrapped = id(p) in targeted
+                c = _Construct(p, wrapped, self.indent)
+                if wrapped:
+                    self.emit("while True:")
+                    self.indent += 1
+                if op == O.if_:
+                    self.emit(f"if {cond.cond()}:")
+                    self.indent += 1
+                    c.arm_start = len(self.lines)
+                self.constructs.append(c)
+            elif op == O.else_:
+                if p.height is None:
+                    continue
+                c = self.constructs[-1]
+                if reachable and p.arity:
+                    self.materialize(p.height)
+                self.close_arm(c)
+                self.indent -= 1
+                self.emit("else:")
+                self.indent += 1
+                c.arm_start = len(self.lines)
+                self.vstack = self.vstack[:p.height]
+            elif op == O.end:
+                if p.height is None:
+                    continue
+                if p.parent is None:
+                    break
+                if reachable and p.arity:
+                    self.materialize(p.height)
+                self.close(self.constructs.pop(), reachable)
+                self.vstack = self.vstack[:p.height] + [self.slot(p.height + k) for k in range(p.arity)]
+            elif op == O.get_local:
+                self.push(_Expr(f"l{p}", (f"l{p}",)))
+            elif op in (O.i32_const, O.i64_const, O.f32_const, O.f64_const):
+                self.push(_Expr(_literal(p)))
+            elif op == O.set_local:
+                self.unalias(p, True)
+                self.emit(f"l{p} = {self.vstack.pop().value()}")
+            elif op == O.tee_local:
+                self.unalias(p, True)
+                top = self.vstack[-1]
+                if top.text != f"l{p}":
+                    self.emit(f"l{p} = {top.value()}")
+                self.vstack[-1] = _Expr(f"l{p}", (f"l{p}",))
+            elif op in BINARY_OPS:
+                b = self.vstack.pop()
+                a = self.vstack.pop()
+                if op in INLINE_BINARY:
+                    tmpl, is_bool = INLINE_BINARY[op]
+                    text = tmpl.format(a=a.value(), b=b.value())
+                else:
+                    is_bool = False
+                    text = f"{BINARY_OPS[op].__name__}({a.value()}, {b.value()})"
+                if op in TRAPPING:
+                    self.assign_top(text)
+                else:
+                    self.push(_Expr(text, a.refs | b.refs, is_bool))
+            elif op in UNARY_OPS:
+                a = self.vstack.pop()
+                if op in (O.i32_eqz, O.i64_eqz):
+                    text = f"not ({a.cond()})" if a.is_bool else f"{a.text} == 0"
+                    self.push(_Expr(text, a.refs, True))
+                    continue
+                if op in INLINE_UNARY:
+                    tmpl, is_bool = INLINE_UNARY[op]
+                    text = tmpl.format(a=a.value())
+                else:
+                    text = f"{UNARY_OPS[op].__name__}({a.value()})"
+                if op in TRAPPING:
+                    self.assign_top(text)
+                else:
+                    self.push(_Expr(text, a.refs))
+            elif op == O.drop:
+                self.vstack.pop()
+            elif op == O.select:
+                cond = self.vstack.pop()
+                b = self.vstack.pop()
+                a = self.vstack.pop()
+                self.push(_Expr(f"({a.value()} if {cond.cond()} else {b.value()})",
+                                a.refs | b.refs | cond.refs))
+            elif op in (O.br, O.return_):
+                self.branch(p)
+            elif op == O.br_if:
+                cond = self.vstack.pop()
+                if p.branch_arity():
+                    self.materialize(len(self.vstack) - 1)
+                self.emit(f"if {cond.cond()}:")
+                self.indent += 1
+                self.branch(p)
+                self.indent -= 1
+            elif op == O.call:
+                callee = self.interp.functions[p]
+                argc = len(callee.params_types())
+                args = [self.vstack.pop().value() for _ in range(argc)][::-1]
+                call = f"{function_name(p)}({', '.join(args)})"
+                if callee.return_types():
+                    self.assign_top(call)
+                else:
+                    self.emit(call)
+            elif op in memory.LOADS:
+                # loads read mutable state and may trap: never deferred
+                self.uses_memory = True
+                addr = self.address(self.vstack.pop(), p[1])
+                mask = memory.LOADS[op][1]
+                text = f"mem_{op.name}(mem, {addr})[0]"
+                self.assign_top(text if mask is None else f"{text} & {mask:#x}")
+            elif op in memory.STORES:
+                self.uses_memory = True
+                value = self.vstack.pop().value()
+                addr = self.address(self.vstack.pop(), p[1])
+                mask = memory.STORES[op][1]
+                last = memory.STORES[op][0].size - 1
+                # the address is needed again to flag the pages written as dirty
+                self.emit(f"_a = {addr}")
+                self.emit(f"mem_{op.name}(mem, _a, {value if mask is None else f'{value} & {mask:#x}'})")
+                self.emit(f"dirty[_a >> 16] = dirty[(_a + {last}) >> 16] = 1" if last else "dirty[_a >> 16] = 1")
+            elif op == O.current_memory:
+                self.assign_top("memory.pages")
+            elif op == O.grow_memory:
+                self.assign_top(f"memory.grow({self.vstack.pop().value()})")
+            elif op == O.unreachable:
+                self.emit("raise Trap('unreachable executed')")
+            elif op == O.nop:
+                pass
+        else:
+            reachable = heights[len(code)] is not None
+        if reachable:
+            self.emit(f"return {self.vstack[-1].value()}" if fn.body.arity else "return")
+        if self.uses_br:
+            self.lines.insert(header_len, "    _br = None")
+        if self.uses_memory:
+            # an access past the end of memory makes the struct raise
+            self.lines = (["    try:"] + ["    " + line for line in self.lines] +
+                          ["    except struct_error:", "        raise Trap(OUT_OF_BOUNDS) from None"])
+        params = ", ".join(f"l{i}" for i in range(nparams))
+        return f"def {function_name(fn.id)}({params}):\n" + "\n".join(self.lines) + "\n"
+
+
+# the name of guest function `id` in the namespace, which also holds every
+# name of operations (f32, i32, ...)
+def function_name(id):
+    return f"_wf{id}"
+
+
+def new_namespace(interp):
+    namespace = {name: getattr(operations, name) for name in dir(operations) if not name.startswith("__")}
+    namespace["inf"] = float("inf")
+    namespace["nan"] = float("nan")
+    if interp.memory is not None:
+        namespace["memory"] = interp.memory
+        namespace["mem"] = interp.memory.data
+        namespace["dirty"] = interp.memory.dirty
+        for op, (s, mask) in memory.LOADS.items():
+            namespace[f"mem_{op.name}"] = s.unpack_from
+        for op, (s, mask) in memory.STORES.items():
+            namespace[f"mem_{op.name}"] = s.pack_into
+        namespace["struct_error"] = struct.error
+        namespace["OUT_OF_BOUNDS"] = memory.OUT_OF_BOUNDS
+    for fn in interp.functions:
+        if fn.imported:
+            fn.py = namespace[function_name(fn.id)] = lambda *args, fn=fn: fn.call(list(args))
+    return namespace
+
+
+# Compiles `fn` into `namespace`, where other compiled functions find it
+# under function_name(fn.id). Returns False if the function has to stay
+# interpreted.
+def compile_function(interp, fn, namespace, trace):
+    try:
+        source = _FunctionCompiler(interp, fn).compile()
+        filename = f"<wasm function {fn.id}>"
+        code = compile(source, filename, "exec")
+    except (Unsupported, SyntaxError, RecursionError, MemoryError) as e:
+        trace("codegen: function", fn.id, "not compiled:", type(e).__name__, e)
+        return False
+    # make the generated source visible to tracebacks and debuggers
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    exec(code, namespace)
+    fn.py_source = source
+    fn.py = namespace[function_name(fn.id)]
+    return True
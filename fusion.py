@@ -0,0 +1,112 @@
+import enum
+
+from opcodes import Op, Opcode as O
+from operations import BINARY_OPS
+
+# Superinstructions for the stack engine: common instruction sequences are
+# fused at load time into one instruction with its own handler, which saves
+# a trip through the instruction loop per instruction fused away. The set
+# was picked from the pair and triple frequencies of the executed
+# instructions over the examples (see `benchmark.py fusion`): most operands
+# of binary operators are locals and constants, and most conditional
+# branches compare a local with a constant.
+#
+# The fused instruction replaces the first one of its sequence. The others
+# stay in place and the handler skips them, so instruction indices (branch
+# targets, return addresses) do not change. Sequences only contain
+# instructions that execution cannot continue after other than by falling
+# through (no block, loop, if, else, end or call), so no branch ever lands
+# in the middle of one.
+
+
+class Fused(enum.Enum):
+    def __repr__(self):
+        return f"Op<{self.name}>"
+
+    local_local = 0x100             # get_local a; get_local b
+    local_local_binop = 0x101       # get_local a; get_local b; <binop>
+    local_const_binop = 0x102       # get_local a; <const>; <binop>
+    local_const_binop_br_if = 0x103 # get_local a; <const>; <binop>; br_if
+    local_binop = 0x104             # get_local a; <binop>
+    const_binop = 0x105             # <const>; <binop>
+    tee_local_get_local = 0x106     # tee_local a; get_local b
+    set_local_get_local = 0x107     # set_local a; get_local b
+
+
+class FusedOp(Op):
+    def __init__(self, opcode, payload, ops):
+        super().__init__(opcode, payload)
+        self.ops = ops # the instructions fused
+
+    def __repr__(self):
+        return "+".join(repr(op) for op in self.ops)
+
+
+LOCAL = {O.get_local}
+CONST = {O.i32_const, O.i64_const, O.f32_const, O.f64_const}
+BINOP = set(BINARY_OPS)
+
+# longer sequences first, which fuse is preferred on a tie
+PATTERNS = (
+    (Fused.local_const_binop_br_if, (LOCAL, CONST, BINOP, {O.br_if})),
+    (Fused.local_local_binop, (LOCAL, LOCAL, BINOP)),
+    (Fused.local_const_binop, (LOCAL, CONST, BINOP)),
+    (Fused.local_local, (LOCAL, LOCAL)),
+    (Fused.local_binop, (LOCAL, BINOP)),
+    (Fused.const_binop, (CONST, BINOP)),
+    (Fused.tee_local_get_local, ({O.tee_local}, LOCAL)),
+    (Fused.set_local_get_local, ({O.set_local}, LOCAL)),
+)
+
+# first opcode -> patterns starting with it
+_PATTERNS_BY_OP = {}
+for fused, pattern in PATTERNS:
+    for op in pattern[0]:
+        _PATTERNS_BY_OP.setdefault(op, []).append((fused, pattern))
+
+
+# what a handler needs of a fused instruction: the operator's function for
+# binary operators, the payload (local index, constant, block) otherwise
+def operand(instr):
+    fn = BINARY_OPS.get(instr.opcode)
+    return instr.payload if fn is None else fn
+
+
+# A copy of the prepared `code` with sequences of PATTERNS fused, chosen to
+# dispatch as few instructions as possible (a greedy match from the start
+# would, e.g., fuse a set_local with the get_local of a following compare
+# and branch).
+def fuse(code):
+    end = len(code)
+    # dispatches from i to the end, and the pattern to fuse at i
+    best = [0] * (end + 1)
+    choice = [None] * end
+    for i in range(end - 1, -1, -1):
+        best[i] = best[i + 1] + 1
+        for fused, pattern in _PATTERNS_BY_OP.get(code[i].opcode, ()):
+            n = len(pattern)
+            if i + n <= end and best[i + n] + 1 < best[i] and \
+                    all(code[i + k].opcode in ops for k, ops in enumerate(pattern)):
+                best[i] = best[i + n] + 1
+                choice[i] = fused, n
+    fused_code = list(code)
+    i = 0
+    while i < end:
+        if choice[i] is None:
+            i += 1
+            continue
+        fused, n = choice[i]
+        seq = code[i:i + n]
+        fused_code[i] = FusedOp(fused, tuple(operand(instr) for instr in seq), seq)
+        i += n
+    return fused_code
+
+
+# number of instructions the stack engine dispatches when running through
+# all of `code` once
+def dispatch_count(code):
+    count = i = 0
+    while i < len(code):
+        count += 1
+        i += len(code[i].ops) if isinstance(code[i], FusedOp) else 1
+    return count
@@ -1,107 +1,727 @@
-import opcode
+import analysis
+import asyncio
+import inspect
+import opcodes
+import optimizer
 import parser
-from opcode import Opcode as O
+import profiler
+import closures
+import codegen
+import fusion
+import memory
+import registers
+import struct
+import threading
+import time
+import validation
+from fusion import Fused as F
+from opcodes import Opcode as O
 from operations import *
-
-
+from tracing import TraceLevel, NO_TRACE
+
+
+# A parsed module prepared for execution. It is not changed after
+# construction (bodies of a lazily parsed module are prepared on first use,
+# under a lock), so one Module can back any number of instances, also from
+# several threads. Sections keep the names and layout of parser.ParseData,
+# except that the code section is replaced by `bodies`. With `validate`, the
+# module is validated (see validation.py; function bodies when they are
+# prepared) and raises ValidationError if it is invalid. Function bodies are
+# optimized at `opt_level` (see optimizer.py).
+class Module:
+    def __init__(self, parse_res, validate=False, opt_level=optimizer.DEFAULT_LEVEL):
+        if validate:
+            validation.validate_module(parse_res)
+        self.validated = validate
+        self.opt_level = opt_level
+        self.custom_sections = tuple(parse_res.custom_sections)
+        self.name_section = parse_res.name_section
+        self.type_section = tuple(parse_res.type_section or ())
+        self.import_section = tuple(parse_res.import_section or ())
+        self.function_section = tuple(parse_res.function_section or ())
+        self.table_section = parse_res.table_section
+        self.memory_section = parse_res.memory_section
+        self.global_section = parse_res.global_section
+        self.export_section = tuple(parse_res.export_section or ())
+        self.start_section = parse_res.start_section
+        self.element_section = parse_res.element_section
+        self.data_section = tuple(parse_res.data_section or ())
+        code_section = parse_res.code_section or ()
+        assert len(self.function_section) == len(code_section)
+
+        types = self.type_section
+        # imported functions occupy the first indices of the function space
+        self.imports = tuple((module, field, types[type_idx]) for module, field, kind, type_idx in self.import_section
+                             if kind == parser.ExternalKind.Func)
+        self.function_types = tuple(types[type_idx] for type_idx in self.function_section)
+        for fn_type in self.function_types:
+            assert fn_type[0] == parser.Type.func or fn_type[0] == parser.Type.anyfunc
+        self.exports = {name: id for name, type, id in self.export_section if type is parser.ExternalKind.Func}
+        # (params, results) of every function, imports first
+        self.signatures = tuple(fn_type[1] for module, field, fn_type in self.imports) + \
+            tuple(fn_type[1] for fn_type in self.function_types)
+        # (type, mutability) of every global, imports first
+        self.globals = tuple(type for module, field, kind, type in self.import_section
+                             if kind == parser.ExternalKind.Global) + \
+            tuple(type for type, init in self.global_section or ())
+        self.has_memory = bool(self.memory_section) or \
+            any(kind == parser.ExternalKind.Memory for module, field, kind, type in self.import_section)
+        self.has_table = bool(self.table_section) or \
+            any(kind == parser.ExternalKind.Table for module, field, kind, type in self.import_section)
+        self.bodies = list(code_section)
+        if validate and any(isinstance(body, Interpreter.PreparedBody) and not body.validated for body in self.bodies):
+            raise Exception("Function bodies were prepared without validation")
+        if any(isinstance(body, Interpreter.PreparedBody) and body.opt_level != opt_level for body in self.bodies):
+            raise Exception(f"Function bodies were prepared at another optimization level than {opt_level}")
+        self.lock = threading.Lock()
+        # lazily parsed bodies are decoded (and validated) on first use,
+        # everything else now
+        self.lazy = bool(code_section) and isinstance(code_section[0], parser.LazyBody)
+        if not self.lazy:
+            for index in range(len(self.bodies)):
+                self.body(index)
+
+    # the prepared body of the defined function `index` (not counting imports)
+    def body(self, index):
+        body = self.bodies[index]
+        if isinstance(body, Interpreter.PreparedBody):
+            return body
+        with self.lock:
+            body = self.bodies[index]
+            if not isinstance(body, Interpreter.PreparedBody):
+                body = Interpreter.prepare_body(self.function_types[index], body, len(self.imports) + index, self)
+                self.bodies[index] = body
+            return body
+
+    # the code of the defined function `index` with superinstructions (see
+    # fusion.py), fused once and shared by the instances
+    def fused_code(self, index):
+        body = self.body(index)
+        if body.fused_code is None:
+            with self.lock:
+                if body.fused_code is None:
+                    body.fused_code = fusion.fuse(body.code)
+        return body.fused_code
+
+    # instruction count of every function before and after each optimizer
+    # pass, and in total
+    def opt_report(self):
+        names = {id: name for name, id in self.exports.items()}
+        passes = [name for name, count in self.body(0).opt_counts] if self.bodies else ["input"]
+        lines = [f"{'id':>4}  {'name':24}  " + "  ".join(f"{name:>18}" for name in passes)]
+        totals = [0] * len(passes)
+        for index in range(len(self.bodies)):
+            id = len(self.imports) + index
+            counts = [count for name, count in self.body(index).opt_counts]
+            totals = [total + count for total, count in zip(totals, counts)]
+            lines.append(f"{id:>4}  {names.get(id, ''):24}  " + "  ".join(f"{count:>18}" for count in counts))
+        lines.append(f"{'':>4}  {'total':24}  " + "  ".join(f"{total:>18}" for total in totals))
+        return "\n".join(lines)
+
+    # a name for every function (imports first): from the name section, else
+    # the export or import name, else its index
+    def function_names(self):
+        names = dict(self.name_section[1] or ()) if self.name_section else {}
+        exports = {id: name for name, id in self.exports.items()}
+        imports = {id: f"{module}.{field}" for id, (module, field, type) in enumerate(self.imports)}
+        return tuple(names.get(id) or exports.get(id) or imports.get(id) or f"function {id}"
+                     for id in range(len(self.signatures)))
+
+    def fn_signature(self, id):
+        return self.signatures[id]
+
+    def type_signature(self, idx):
+        return self.type_section[idx][1]
+
+    # a new instance running on `engine`, see Interpreter
+    def instantiate(self, tracer=NO_TRACE, engine="stack", hot_calls=100, hot_loops=1000, imports=None, fuse=True):
+        interp = Interpreter(self, tracer, engine, hot_calls, hot_loops, imports, fuse)
+        interp.initialize()
+        return interp
+
+
+# An instance of a Module: its memory, call stack and the functions prepared
+# for one engine. `module` may also be a parse result, which is wrapped in a
+# Module first.
 class Interpreter:
-    def __init__(self, parse_res):
-        self.parse_res = parse_res
+    ENGINES = ("stack", "closure", "register", "python", "tiered")
+
+    def __init__(self, module, tracer=NO_TRACE, engine="stack", hot_calls=100, hot_loops=1000, imports=None,
+                 fuse=True):
+        if engine not in self.ENGINES:
+            raise Exception(f"Unknown engine {engine}")
+        self.module = module if isinstance(module, Module) else Module(module)
+        self.engine = engine
+        # tiered engine: a function is compiled on the first call after it was
+        # called more than hot_calls times or took more than hot_loops loop back-edges
+        self.hot_calls = hot_calls
+        self.hot_loops = hot_loops
+        # host functions by module and field name: {module: {field: callable}}
+        self.imports = imports or {}
+        # run the stack engine on code with superinstructions, see fusion.py
+        self.fuse = fuse
         self.functions = []
-        self.stack = self.Stack()
+        # The stack engine keeps the locals and operands of all active
+        # functions in one value stack: a function's locals (parameters
+        # first) start at its base pointer `bp`, its operands follow them.
+        # A call saves the caller's (fn, code, instr_ptr, bp) in `frames`.
+        self.stack = []
+        self.frames = []
+        self.fn = None # function running in the stack engine
+        self.code = None # and its code
         self.instr_ptr = 0
-        self.InstrPtrStack = []
-        self.BlockStackSizes = []
-        self.ST = None # current stack top
-        self.opFns = dict()
-        self.init_op_fns()
-        self.jump_offset = 0
+        self.bp = 0
+        self.awaiting = None # awaitable returned by a host function, see run_slice
+        self.fuel = None # fuel left after the last metered call
+        self.memory = None
+        self.op_profile = None # see profile_ops
+        self.call_profile = None # see profile_calls
         self.exp_fn = {}
+        self.tracer = tracer
+        self.trace = tracer.channel(TraceLevel.info, "interp")
+        self.trace_call = tracer.channel(TraceLevel.calls, "call")
+        self.calls_traced = tracer.enabled(TraceLevel.calls)
+        if not self.module.validated:
+            self.leave_function = self.leave_function_checked
+        # pick the instruction loop once; the plain loop carries no tracing code
+        if tracer.enabled(TraceLevel.instr):
+            self.trace_instr = tracer.channel(TraceLevel.instr, "instr")
+            self.run_code = self.run_code_traced
 
     def initialize(self):
-        data = self.parse_res
-        if data.function_section is None:
-            print("No function section .. exiting")
+        module = self.module
+        self.memory = memory.instantiate(module)
+        if self.memory is not None:
+            self.trace("memory:", self.memory)
+        if not module.function_section:
+            self.trace("No function section .. exiting")
             return
-        assert len(data.function_section) == len(data.code_section)
-        fns = data.function_section
-        types = data.type_section
-        bodies = data.code_section
-        for id in range(len(data.function_section)):
-            fn_type_idx = fns[id]
-            fn_type = types[fn_type_idx]
-            assert fn_type[0] == parser.Type.func or fn_type[0] == parser.Type.anyfunc
-            locals, fn_code = bodies[id]
-            body = self.InstrBlock()
-            body.createInnerBlocks(fn_code)
-            fn = self.Function(id, fn_type, locals, body, fn_code)
-            self.functions.append(fn)
+        for id, (module_name, field, fn_type) in enumerate(module.imports):
+            host = self.imports.get(module_name, {}).get(field)
+            self.functions.append(self.ImportedFunction(id, fn_type, module_name, field, host))
+        fn_offset = len(self.functions)
+        for index, fn_type in enumerate(module.function_types):
+            self.functions.append(self.Function(fn_offset + index, fn_type, index, self.prepare_function))
+        self.exp_fn = module.exports
+
+        if self.engine == "closure":
+            self.run_function = self.run_function_closure
+        elif self.engine == "register":
+            self.run_function = self.run_function_register
+        elif self.engine in ("python", "tiered"):
+            self.namespace = codegen.new_namespace(self)
+            for fn in self.functions[fn_offset:]:
+                # until compiled, calls from generated code go through run_function
+                self.namespace[codegen.function_name(fn.id)] = lambda *args, id=fn.id: self.run_function(id, list(args))
+            if self.engine == "python":
+                self.run_function = self.run_function_python
+            else:
+                self.opFns = self.tieredOpFns
+                self.run_function = self.run_function_tiered
+
+        # lazily parsed bodies are prepared on first use, everything else now
+        if not module.lazy:
+            self.warm_up()
+
+    # Decodes (if parsed lazily) and prepares all or the given functions now
+    # instead of on first use.
+    def warm_up(self, ids=None):
+        start = time.perf_counter()
+        stack_instrs = engine_instrs = dispatched = 0
+        # counting dispatches takes about as long as fusing, only for the trace
+        counted = self.tracer.enabled(TraceLevel.info)
+        for id in range(len(self.functions)) if ids is None else ids:
+            fn = self.functions[id]
+            if fn.imported:
+                continue
+            stack_instrs += len(fn.code)  # prepares the function
+            if self.engine == "register":
+                engine_instrs += len(fn.reg_code)
+            if counted:
+                dispatched += fusion.dispatch_count(fn.stack_code)
+        self.trace("prepared", stack_instrs, "instructions in", f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        if counted and dispatched != stack_instrs:
+            self.trace("superinstructions:", stack_instrs, "instructions ->", dispatched, "dispatched")
+        if self.engine == "register":
+            self.trace("register IR:", stack_instrs, "stack instructions ->", engine_instrs, "register instructions")
+
+    # Decodes a body if needed, canonicalises its constants, optimizes it and
+    # resolves its blocks and branches, on a copy of the decoded code. This
+    # part does not depend on the engine (see Module and cache.py). `id` is
+    # the function's index, `module` provides the signatures of call targets,
+    # whether to validate the body first and the optimization level.
+    @staticmethod
+    def prepare_body(fn_type, source, id, module):
+        locals, fn_code = source.decode() if isinstance(source, parser.LazyBody) else source
+        if module.validated:
+            validation.validate_function(module, id, fn_type, locals, fn_code)
+        fn_code = list(fn_code)
+        for i, op in enumerate(fn_code):
+            if op.opcode in (O.i32_const, O.i64_const):
+                fn_code[i] = opcodes.Op(op.opcode, const_value(op.opcode, op.payload))
+        return_types = fn_type[1][1]
+        body = Interpreter.InstrBlock(return_types[0] if return_types else parser.Type.empty_block)
+        body.createInnerBlocks(fn_code)
+        for instr in fn_code:
+            if instr.opcode == O.loop:
+                instr.payload.function = id # back-edges are counted per function
+        prepared = Interpreter.PreparedBody(locals, fn_code, body)
+        prepared.validated = module.validated
+        prepared.opt_level = module.opt_level
+        prepared.opt_counts = optimizer.optimize(fn_code, body, module.opt_level)
+        analysis.stack_heights(prepared, module.fn_signature, module.type_signature)
+        frame_size = len(fn_type[1][0]) + len(prepared.local_defaults)
+        body.resolve(frame_size)
+        for instr in fn_code:
+            if instr.opcode in (O.block, O.loop, O.if_):
+                instr.payload.resolve(frame_size)
+        return prepared
+
+    # Takes the function's prepared body from the module and compiles it for
+    # the selected engine. Called on first access to the function's code, see
+    # Function.__getattr__.
+    def prepare_function(self, fn):
+        index = fn.__dict__.pop("index")
+        source = self.module.body(index)
+        fn.locals = source.locals
+        fn.body = source.body
+        fn.code = fn_code = source.code
+        fn.local_defaults = source.local_defaults
+        # values below the operand stack in the function's frame
+        fn.frame_size = fn.argc + len(fn.local_defaults)
+        # what the instruction loop runs (the compilers work on fn.code)
+        fn.stack_code = fn_code
+        if self.fuse and self.engine in ("stack", "tiered"):
+            fn.stack_code = self.module.fused_code(index)
+
+        if self.engine == "closure":
+            fn.closures = closures.compile_function(self, fn)
+            fn.tier = "closure"
+        elif self.engine == "register":
+            registers.compile_function(self, fn)
+            fn.tier = "register"
+        elif self.engine == "python":
+            if codegen.compile_function(self, fn, self.namespace, self.trace):
+                fn.tier = "compiled"
+            else:
+                # fall back to the stack interpreter for this function
+                fn.py = self.namespace[codegen.function_name(fn.id)] = lambda *args, id=fn.id: self.call_interpreted(id, args)
+        elif self.engine == "tiered":
+            fn.py = self.namespace[codegen.function_name(fn.id)]
 
-        for name, type, id in data.export_section:
-            if type is parser.ExternalKind.Func:
-                self.exp_fn[name] = id
+    def fn_signature(self, id):
+        return self.functions[id].type[1]
 
+    def type_signature(self, idx):
+        return self.module.type_section[idx][1]
 
 
+    # The stack engine does not recurse for calls between interpreted
+    # functions: opCall pushes a frame and switches to the callee's code,
+    # and the loop in run_code pops it again when the callee's code ends.
+    # Frames below `depth` belong to callers further out (e.g. the host).
     def run_function(self, id, params):
         fn = self.functions[id]
-        assert fn is not None
-        assert len(params) == len(fn.params_types())
-        print(" ### Executing function", fn.type, "with parameters", params)
-        frame = self.stack.push(len(params))
-        self.ST = frame
-        frame.setupCall(params, fn.locals)
-        print(f"Current stack: {repr(self.stack)}")
-
-        codelen = len(fn.code)
-        print(fn.code)
-        while self.instr_ptr < codelen:
-            print(f"\n@{self.instr_ptr}")
-            self.execute_instr(fn.code[self.instr_ptr])
-            print(f"Current stack: {repr(self.stack)}")
-            self.instr_ptr += 1
+        if fn.imported:
+            return fn.call(params)
+        assert len(params) == fn.argc
+        depth, height = len(self.frames), len(self.stack)
+        self.stack.extend(params)
+        self.enter_function(fn)
+        try:
+            return self.run_code(depth)
+        except BaseException:
+            self.unwind(depth, height)
+            raise
+
+    # Sets up a frame for `fn`, whose arguments are on top of the stack.
+    def enter_function(self, fn):
+        stack = self.stack
+        bp = len(stack) - fn.argc
+        if self.calls_traced:
+            self.trace_call(" ### Executing function", fn.type, "with parameters", stack[bp:])
+        self.frames.append((self.fn, self.code, self.instr_ptr, self.bp))
+        stack.extend(fn.local_defaults)
+        self.bp = bp
+        self.fn = fn
+        self.code = fn.stack_code
+        self.instr_ptr = 0
 
-        # handle return
-        returntype = fn.type[1][1]
-        if len(returntype) > 0:
-            assert self.ST.size() == 1
-            type = returntype[0]
-            return_val = self.ST.pop()
-            assert type == return_val.type
-        else:
-            assert self.ST.size() == 0
-            return_val = None
+    # Pops the frame of the function whose code just ended. If its caller
+    # runs in the same loop (above `depth`), the result goes onto the
+    # caller's stack and execution continues after the call.
+    def leave_function(self, depth):
+        fn = self.fn
+        stack = self.stack
+        return_val = stack[-1] if fn.body.arity > 0 else None
+        del stack[self.bp:]
+        self.fn, self.code, self.instr_ptr, self.bp = self.frames.pop()
+        if self.calls_traced:
+            self.trace_call(" +++ Done executing function", fn.type, "returning", return_val)
+        if len(self.frames) > depth:
+            if return_val is not None:
+                stack.append(return_val)
+            self.instr_ptr += 1
+        return return_val
 
+    # Instances of modules that were not validated check that a function
+    # leaves exactly its results (a validated module always does).
+    def leave_function_checked(self, depth):
+        assert len(self.stack) - self.bp - self.fn.frame_size == self.fn.body.arity
+        return Interpreter.leave_function(self, depth)
+
+    # Drops the frames and values of a call that raised (e.g. trapped), so
+    # that a caller catching the exception continues where it was.
+    def unwind(self, depth, height):
+        if len(self.frames) > depth:
+            self.fn, self.code, self.instr_ptr, self.bp = self.frames[depth]
+            del self.frames[depth:]
+        del self.stack[height:]
+
+    # From now on, records every call of a guest function and of an imported
+    # one in `profile` (a new profiler.CallProfile, its functions named from
+    # the name section, if not given), which is returned. Like profile_ops,
+    # this swaps the instance's function entry, exit and unwinding, so that
+    # instances that are not profiled pay nothing. `filename` names the
+    # module in pstats output.
+    def profile_calls(self, profile=None, filename="wasm"):
+        if self.engine != "stack":
+            raise Exception("profiling calls needs the stack engine")
+        profile = self.call_profile = profile or profiler.CallProfile(self.module.function_names(), filename)
+        self.leave_function_unprofiled = self.leave_function
+        self.enter_function = self.enter_function_profiled
+        self.leave_function = self.leave_function_profiled
+        self.unwind = self.unwind_profiled
+
+        def profiled(call, id):
+            def call_profiled(params):
+                profile.enter(id)
+                try:
+                    return call(params)
+                finally:
+                    profile.leave()
+            return call_profiled
+        for fn in self.functions:
+            if fn.imported:
+                fn.call = profiled(fn.call, fn.id)
+        return profile
+
+    def enter_function_profiled(self, fn):
+        self.call_profile.enter(fn.id)
+        Interpreter.enter_function(self, fn)
+
+    def leave_function_profiled(self, depth):
+        self.call_profile.leave()
+        return self.leave_function_unprofiled(depth)
+
+    def unwind_profiled(self, depth, height):
+        self.call_profile.unwind(len(self.frames) - depth)
+        Interpreter.unwind(self, depth, height)
+
+    def run_function_closure(self, id, params):
+        fn = self.functions[id]
+        if fn.imported:
+            return fn.call(params)
+        assert len(params) == len(fn.params_types())
+        self.trace_call(" ### Executing function", fn.type, "with parameters", params)
+        return_val = closures.execute(fn, params)
+        self.trace_call(" +++ Done executing function", fn.type, "returning", return_val)
+        return return_val
 
-        self.stack.pop()
-        self.ST = self.stack.top()
-        print(" +++ Done executing function", fn.type)
+    def run_function_register(self, id, params):
+        fn = self.functions[id]
+        if fn.imported:
+            return fn.call(params)
+        assert len(params) == len(fn.params_types())
+        self.trace_call(" ### Executing function", fn.type, "with parameters", params)
+        return_val = registers.execute(fn, params)
+        self.trace_call(" +++ Done executing function", fn.type, "returning", return_val)
+        return return_val
 
-        print("returning", return_val)
+    def run_function_python(self, id, params):
+        fn = self.functions[id]
+        assert len(params) == len(fn.params_types())
+        self.trace_call(" ### Executing function", fn.type, "with parameters", params)
+        return_val = fn.py(*params)
+        self.trace_call(" +++ Done executing function", fn.type, "returning", return_val)
         return return_val
 
-    def run_exported_fn(self, name, args):
+    def run_function_tiered(self, id, params):
+        fn = self.functions[id]
+        if fn.tier == "compiled":
+            return fn.py(*params)
+        if fn.imported:
+            return fn.call(params)
+        fn.calls += 1
+        if fn.tier == "interpreted" and (fn.calls > self.hot_calls or fn.backedges > self.hot_loops):
+            self.promote(fn)
+            if fn.tier == "compiled":
+                return fn.py(*params)
+        return self.call_interpreted(id, params)
+
+    def promote(self, fn):
+        if codegen.compile_function(self, fn, self.namespace, self.trace):
+            fn.tier = "compiled"
+        else:
+            fn.tier = "uncompilable"
+        self.trace("tier: function", fn.id, fn.tier, "after", fn.calls, "calls,", fn.backedges, "back-edges")
+
+    def tier_report(self):
+        names = {id: name for name, id in self.exp_fn.items()}
+        lines = [f"{'id':>4}  {'name':24}  {'tier':12}  {'calls':>8}  {'back-edges':>10}"]
+        for fn in self.functions:
+            if fn.imported:
+                continue
+            lines.append(f"{fn.id:>4}  {names.get(fn.id, ''):24}  {fn.tier:12}  {fn.calls:>8}  {fn.backedges:>10}")
+        return "\n".join(lines)
+
+    # runs a function on the stack interpreter, e.g. when it could not be compiled
+    def call_interpreted(self, id, params):
+        return Interpreter.run_function(self, id, list(params))
+
+    def generated_source(self):
+        return "\n".join(fn.py_source for fn in self.functions if getattr(fn, "py_source", None))
+
+    # The instance state a request can change, to be passed to restore: the
+    # linear memory (tables and globals are not implemented). Typically taken
+    # right after initialize.
+    def snapshot(self):
+        return self.memory.snapshot() if self.memory is not None else None
+
+    # Resets the instance to `snapshot`, copying back only the memory pages
+    # written since it was taken if it is the latest one, all of the memory
+    # otherwise. Compiled code and tier counters are kept.
+    def restore(self, snapshot):
+        self.stack.clear()
+        self.frames.clear()
+        self.fn = None
+        self.code = None
+        self.instr_ptr = 0
+        self.bp = 0
+        self.awaiting = None
+        if snapshot is not None:
+            copied = self.memory.restore(snapshot)
+            self.trace("restored", copied, "of", self.memory.pages, "pages")
+
+    # Runs until the frames above `depth` have returned and returns the
+    # result of the last one. A handler returns True when it switched to
+    # other code (entered a function).
+    def run_code(self, depth):
+        frames = self.frames
+        opFns = self.opFns
+        while True:
+            code = self.code
+            codelen = len(code)
+            while self.instr_ptr < codelen:
+                instr = code[self.instr_ptr]
+                if opFns[instr.opcode](self, instr.payload):
+                    break
+                self.instr_ptr += 1
+            else:
+                return_val = self.leave_function(depth)
+                if len(frames) == depth:
+                    return return_val
+
+    def run_code_traced(self, depth):
+        frames = self.frames
+        while True:
+            code = self.code
+            codelen = len(code)
+            self.trace_instr("code", code)
+            while self.instr_ptr < codelen:
+                pc = self.instr_ptr
+                instr = code[pc]
+                if self.execute_instr(instr):
+                    break
+                # structured record: pc, instruction, operand stack after it ran
+                self.trace_instr(pc, instr, self.stack[self.bp + self.fn.frame_size:])
+                self.instr_ptr += 1
+            else:
+                return_val = self.leave_function(depth)
+                if len(frames) == depth:
+                    return return_val
+
+    # run_code counting and timing every instruction, see profile_ops
+    def run_code_profiled(self, depth):
+        frames = self.frames
+        opFns = self.opFns
+        profile = self.op_profile
+        counts, pairs, times = profile.counts, profile.pairs, profile.times
+        clock = time.perf_counter
+        last = profile.last
+        try:
+            while True:
+                code = self.code
+                codelen = len(code)
+                while self.instr_ptr < codelen:
+                    instr = code[self.instr_ptr]
+                    op = instr.opcode
+                    counts[op] += 1
+                    pairs[last, op] += 1
+                    last = op
+                    start = clock()
+                    switched = opFns[op](self, instr.payload)
+                    times[op] += clock() - start
+                    if switched:
+                        break
+                    self.instr_ptr += 1
+                else:
+                    return_val = self.leave_function(depth)
+                    if len(frames) == depth:
+                        return return_val
+        finally:
+            profile.last = last
+
+    # From now on, counts the executions of every opcode and opcode pair and
+    # the time in its handler in `profile` (a new profiler.OpProfile if not
+    # given), which is returned. Only the profiled instance pays for it: the
+    # instruction loop is swapped, like for tracing.
+    def profile_ops(self, profile=None):
+        if self.engine not in ("stack", "tiered"):
+            raise Exception("profiling opcodes needs the stack or tiered engine")
+        if self.run_code == self.run_code_traced:
+            raise Exception("profiling opcodes and tracing instructions cannot be combined")
+        self.op_profile = profile or profiler.OpProfile()
+        self.run_code = self.run_code_profiled
+        return self.op_profile
+
+    # Like run_code, but returns (False, None) after `budget` instructions or
+    # when a host function returned an awaitable (left in self.awaiting), and
+    # (True, result) once the frames above `depth` have returned.
+    def run_slice(self, depth, budget):
+        frames = self.frames
+        opFns = self.asyncOpFns
+        while True:
+            code = self.code
+            codelen = len(code)
+            while self.instr_ptr < codelen:
+                if budget == 0:
+                    return False, None
+                budget -= 1
+                instr = code[self.instr_ptr]
+                if opFns[instr.opcode](self, instr.payload):
+                    break
+                self.instr_ptr += 1
+            else:
+                return_val = self.leave_function(depth)
+                if len(frames) == depth:
+                    return True, return_val
+                continue
+            if self.awaiting is not None:
+                return False, None
+
+    # function id, function and canonical parameters of a call of an export
+    def exported_call(self, name, args):
         fnId = self.exp_fn.get(name)
         if fnId is None:
             raise Exception(f"Unknown function {name}")
-        params = []
-        param_types = self.functions[fnId].params_types()
+        fn = self.functions[fnId]
+        param_types = fn.params_types()
         assert len(param_types) == len(args)
-        for i in range(len(args)):
-            a = args[i]
-            type = param_types[i]
-            if type in (Type.i32, Type.i64):
-                params.append(StackValue(type, int(a)))
-            else:
-                params.append(StackValue(type, float(a)))
-        result = self.run_function(fnId, params)
-        print(f"#### Result = {result.load()} ####")
+        return fnId, fn, [from_host(type, a) for type, a in zip(param_types, args)]
+
+    # With `fuel`, the call traps once it has executed about that many
+    # instructions, and self.fuel holds what is left afterwards.
+    def run_exported_fn(self, name, args, fuel=None):
+        fnId, fn, params = self.exported_call(name, args)
+        self.instr_ptr = 0
+        if fuel is None:
+            result = self.run_function(fnId, params)
+        else:
+            result = self.run_function_metered(fnId, params, fuel)
+        if result is None:
+            return None
+        return to_host(fn.return_types()[0], result)
+
+    # Like run_exported_fn, but without blocking the event loop: the guest
+    # runs in slices of `slice` instructions with other tasks in between,
+    # and host functions may be coroutine functions, which suspend the guest
+    # until they are done. Only the stack engine can be suspended, and an
+    # instance runs one call at a time.
+    async def run_exported_fn_async(self, name, args, slice=10000):
+        if self.engine != "stack":
+            raise Exception("asynchronous execution needs the stack engine")
+        fnId, fn, params = self.exported_call(name, args)
+        result = await self.run_function_async(fnId, params, slice)
+        if result is None:
+            return None
+        return to_host(fn.return_types()[0], result)
+
+    # Fuel is paid for a whole block (see InstrBlock.cost) when it is
+    # entered and at every loop back-edge, by the handlers of fuelOpFns, so
+    # that unmetered calls run the plain handlers. A branch out of a block
+    # forfeits the fuel paid for the rest of it. The handlers compare and
+    # subtract inline, a call to a helper costs about as much as the check.
+    # Metering costs about 2-6% on calls of a few instructions and 5-9% on
+    # tight loops, which pay at every back-edge (`benchmark.py fuel`).
+    def run_function_metered(self, id, params, fuel):
+        if self.engine != "stack":
+            raise Exception("fuel metering needs the stack engine")
+        fn = self.functions[id]
+        self.fuel = fuel
+        if fn.imported:
+            return fn.call(params)
+        cost = fn.body.cost
+        if cost > fuel:
+            raise Trap(OUT_OF_FUEL)
+        self.fuel = fuel - cost
+        assert len(params) == fn.argc
+        # as in run_function, with the metered handlers for this call
+        # (calls back into the guest from host functions included)
+        plain = self.opFns
+        self.opFns = self.fuelOpFns
+        depth, height = len(self.frames), len(self.stack)
+        self.stack.extend(params)
+        self.enter_function(fn)
+        try:
+            return self.run_code(depth)
+        except BaseException:
+            self.unwind(depth, height)
+            raise
+        finally:
+            self.opFns = plain
+
+    async def run_function_async(self, id, params, slice):
+        fn = self.functions[id]
+        if fn.imported:
+            return_val = fn.call_host(params)
+            return await return_val if inspect.isawaitable(return_val) else return_val
+        assert len(params) == fn.argc
+        depth, height = len(self.frames), len(self.stack)
+        self.stack.extend(params)
+        self.enter_function(fn)
+        try:
+            while True:
+                done, return_val = self.run_slice(depth, slice)
+                if done:
+                    return return_val
+                if self.awaiting is not None:
+                    awaitable, self.awaiting = self.awaiting, None
+                    return_val = await awaitable
+                    if return_val is not None:
+                        self.stack.append(return_val)
+                    self.instr_ptr += 1 # past the call
+                else:
+                    await asyncio.sleep(0)
+        except BaseException:
+            self.awaiting = None
+            self.unwind(depth, height)
+            raise
+
+    # Runs an exported function once per element of `arrays`, one array of
+    # arguments per parameter, lane-parallel with NumPy (see lanes.py).
+    # Returns the results as an array.
+    def run_exported_fn_batch(self, name, arrays):
+        fnId = self.exp_fn.get(name)
+        if fnId is None:
+            raise Exception(f"Unknown function {name}")
+        import lanes  # NumPy is only needed for batches
+        return lanes.run_batch(self, fnId, arrays)
 
     def execute_instr(self, instr):
         opFn = self.opFns[instr.opcode]
         assert opFn is not None
-        print("executing", instr)
-        opFn(instr.payload)
+        return opFn(self, instr.payload)
 
     class InstrBlock:
         def __init__(self, type = None, parent = None):
@@ -112,49 +732,130 @@ class Interpreter:
             self.endOffs = -1
             self.parent = parent
             self.depth = -1
-
-        def createInnerBlocks(self, instrList, startOffset = 0, depth = 0):
+            self.arity = 0 if type in (None, parser.Type.empty_block) else 1
+            # branches to the block, see resolve
+            self.target = -1
+            self.keep = 0
+            self.results = 0
+            # fuel metering: instructions of the block itself (of the 'then'
+            # arm for an if), including its 'end', excluding nested blocks
+            self.cost = 0
+            self.else_cost = 0
+
+        # The function body itself is the outermost block: it starts at the
+        # virtual offset -1 and ends one past the last instruction.
+        def createInnerBlocks(self, instrList, startOffset = -1, depth = 0):
             self.depth = depth
             self.startOffs = startOffset
             i = startOffset + 1
             end = len(instrList)
-            self.kind = instrList[startOffset].opcode
+            self.kind = instrList[startOffset].opcode if startOffset >= 0 else O.block
+            cost = 0
             while i < end:
                 op = instrList[i]
+                cost += 1
                 if op.opcode in (O.if_, O.loop, O.block): # nested even more
                     blk = Interpreter.InstrBlock(op.payload, self)
-                    instrList[i] = opcode.Op(op.opcode, blk) # replace instr.
+                    instrList[i] = opcodes.Op(op.opcode, blk) # replace instr.
                     i = blk.createInnerBlocks(instrList, i, depth + 1) # skip over the instrs.
                 elif op.opcode == O.end:
                     self.endOffs = i
-                    instrList[i] = opcode.Op(op.opcode, self)
+                    instrList[i] = opcodes.Op(op.opcode, self)
+                    self.set_cost(cost)
                     return i
                 elif self.kind == O.if_ and op.opcode == O.else_:
                     assert self.elseOffs == -1 # can only be there once
-                    instrList[i] = opcode.Op(op.opcode, self) # replace instr.
+                    instrList[i] = opcodes.Op(op.opcode, self) # replace instr.
                     self.elseOffs = i
+                    self.cost = cost
+                    cost = 0
                 elif op.opcode in (O.br, O.br_if):
-                    break_depth = op.payload
-                    break_blk = self
-                    for i in range(break_depth):
-                        break_blk = break_depth.parent
-                        assert break_blk is not None
-                    instrList[i] = opcode.Op(op.opcode, break_blk)
+                    instrList[i] = opcodes.Op(op.opcode, self.outer(op.payload))
+                elif op.opcode == O.br_table:
+                    count, table, default = op.payload
+                    instrList[i] = opcodes.Op(op.opcode, (tuple(self.outer(depth) for depth in table),
+                                                          self.outer(default)))
                 elif op.opcode == O.return_:
-                    instrList[i] = opcode.Op(op.opcode, len(instrList) - 1)
+                    fn_blk = self
+                    while fn_blk.parent is not None:
+                        fn_blk = fn_blk.parent
+                    instrList[i] = opcodes.Op(op.opcode, fn_blk)
                 i += 1
+            assert startOffset == -1 # only the function body may end without an 'end'
+            self.endOffs = i
+            self.set_cost(cost)
             return i
 
+        # the block `depth` levels out from this one
+        def outer(self, depth):
+            blk = self
+            for _ in range(depth):
+                blk = blk.parent
+                assert blk is not None
+            return blk
+
+        # Resolves what a branch to this block does, once its entry height
+        # is known (see analysis.stack_heights): continue after `target`
+        # with the value stack cut to `keep` values above the base pointer,
+        # plus the top `results` values. Unreachable blocks are left alone.
+        def resolve(self, frame_size):
+            if self.height is not None:
+                self.target = analysis.branch_target(self) - 1
+                self.keep = frame_size + self.height
+                self.results = self.branch_arity()
+
+        def set_cost(self, cost):
+            if self.elseOffs != -1:
+                self.else_cost = cost
+            else:
+                self.cost = cost
+
+        def branch_arity(self):
+            return 0 if self.kind == O.loop else self.arity
+
         def __repr__(self):
             return f"[Block depth={self.depth}, len={self.endOffs - self.startOffs}]"
 
+    # a function body after prepare_body: locals as in the code section, code
+    # with constants canonicalised, optimized and blocks resolved, body the
+    # root block, opt_counts its instruction count after each optimizer pass,
+    # fused_code the code with superinstructions once Module.fused_code made it
+    class PreparedBody:
+        def __init__(self, locals, code, body):
+            self.locals = locals
+            self.code = code
+            self.body = body
+            self.local_defaults = [default_value(t) for count, t in locals for _ in range(count)]
+            self.validated = False
+            self.opt_level = 0
+            self.opt_counts = [("input", len(code))]
+            self.fused_code = None
+
     class Function:
-        def __init__(self, id, type, locals, body, code):
+        imported = False
+
+        # `index` is the function's body in the module (not counting
+        # imports); `prepare` turns it into the attributes below
+        def __init__(self, id, type, index, prepare):
             self.id = id
             self.type = type
-            self.locals = locals
-            self.body = body # necessary?
-            self.code = code
+            self.argc = len(type[1][0])
+            self.index = index
+            self.prepare = prepare
+            self.tier = "interpreted"
+            self.calls = 0 # counted by the tiered engine while interpreted
+            self.backedges = 0
+
+        # locals, body, code, local_defaults and the engine's compiled form
+        # are only set up when one of them is first needed
+        def __getattr__(self, name):
+            if name.startswith("__"):
+                raise AttributeError(name)
+            prepare = self.__dict__.pop("prepare", None)
+            if prepare is None:
+                raise AttributeError(name)
+            prepare(self)
+            return getattr(self, name)
 
         def __repr__(self):
             return f"<FN type:{self.type} body: {self.body}>"
@@ -165,350 +866,428 @@ class Interpreter:
         def return_types(self):
             return self.type[1][1]
 
-    class Stack:
-        def __init__(self):
-            self.frames = []
+    class ImportedFunction:
+        imported = True
 
-        def push(self, local_cnt):
-            frame = Interpreter.StackFrame(local_cnt)
-            self.frames.append(frame)
-            return frame
-
-        def pop(self):
-            self.frames.pop()
-
-        def top(self):
-            if len(self.frames) > 0:
-                return self.frames[-1]
-            return None
+        def __init__(self, id, type, module, field, host):
+            self.id = id
+            self.type = type
+            self.argc = len(type[1][0])
+            self.module = module
+            self.field = field
+            self.host = host
+            self.code = None
+            self.tier = "import"
 
         def __repr__(self):
-            return f"Size: {len(self.frames)}; Top Entry -> {self.frames[-1]}"
-
-    class StackFrame:
-        def __init__(self, local_cnt):
-            self.locals = []
-            self.stack = []
-
-        def setupCall(self, params, locals):
-            for i in range(len(params)):
-                self.locals.append(params[i])
-            for l in locals:
-                count = l[0]
-                type = l[1]
-                for i in range(count):
-                    self.locals.append(StackValue(type))
-
-        def load(self, localNr):
-            local = self.locals[localNr]
-            self.stack.append(local)
-
-        def store(self, localNr):
-            val = self.stack.pop()
-            self.locals[localNr] = val
+            return f"<IMPORT {self.module}.{self.field} type:{self.type}>"
+
+        def call(self, params):
+            return_val = self.invoke(params)
+            if inspect.isawaitable(return_val):
+                if inspect.iscoroutine(return_val):
+                    return_val.close()
+                raise Exception(f"Host function {self.module}.{self.field} is a coroutine, "
+                                "use run_exported_fn_async")
+            return self.from_host(return_val)
+
+        # canonical result of the host function, or an awaitable of it
+        # if the host function is a coroutine function
+        def call_host(self, params):
+            return_val = self.invoke(params)
+            if inspect.isawaitable(return_val):
+                return self.converted(return_val)
+            return self.from_host(return_val)
+
+        def invoke(self, params):
+            if self.host is None:
+                raise Exception(f"Unresolved import {self.module}.{self.field}")
+            return self.host(*[to_host(type, p) for type, p in zip(self.params_types(), params)])
+
+        async def converted(self, awaitable):
+            return self.from_host(await awaitable)
+
+        def from_host(self, return_val):
+            return_types = self.return_types()
+            return from_host(return_types[0], return_val) if return_types else None
 
-        def tee(self, localNr):
-            val = self.stack[-1]
-            self.locals[localNr] = val
-
-        def push(self, val):
-            self.stack.append(val)
-
-        def push_new(self, type, val):
-            self.stack.append(StackValue(type, val))
-
-        def pop(self):
-            return self.stack.pop()
-
-        def size(self):
-            return len(self.stack)
-
-        def pop_upto(self, size):
-            if size > self.size():
-                print("#### pruning OpStack ####")
-                self.stack = self.stack[:size]
-
-        def __repr__(self):
-            return f"Locals: {self.locals}, OpStack: {self.stack}"
+        def params_types(self):
+            return self.type[1][0]
 
-    # TODO: define operations
+        def return_types(self):
+            return self.type[1][1]
 
     def opTODO(self, payload):
         raise Exception("TODO implement")
 
-    def unaryOp(self, calledFn, signed=True):
-        val = self.ST.pop()
-        res = calledFn(val, signed)
-        self.ST.push(res)
-
-    def binOp(self, calledFn, signed=True):
-        val2 = self.ST.pop()
-        val1 = self.ST.pop()
-        assert val1.type == val2.type
-        res = calledFn(val1, val2, signed)
-        self.ST.push(res)
-        print (f"{val1} {calledFn.__name__} {val2} = {res}")
-
-    def binOpDiffType(self, calledFn, signed=True):
-        val2 = self.ST.pop()
-        val1 = self.ST.pop()
-        res = calledFn(val1, val2, signed)
-        self.ST.push(res)
-        print (f"{val1} {calledFn.__name__} {val2} = {res}")
+    def opUnreachable(self, payload):
+        raise Trap("unreachable executed")
+
+    @staticmethod
+    def unaryOp(calledFn):
+        def op(self, payload):
+            stack = self.stack
+            stack[-1] = calledFn(stack[-1])
+        return op
+
+    @staticmethod
+    def binOp(calledFn):
+        def op(self, payload):
+            stack = self.stack
+            val2 = stack.pop()
+            stack[-1] = calledFn(stack[-1], val2)
+        return op
+
+    def opDrop(self, payload):
+        self.stack.pop()
+
+    def opSelect(self, payload):
+        stack = self.stack
+        cond = stack.pop()
+        val2 = stack.pop()
+        if cond == 0:
+            stack[-1] = val2
 
+    # Operand stack heights and branch targets are resolved at load time
+    # (see InstrBlock.resolve), so entering and leaving a block costs nothing
+    # and a branch is a jump plus one slice.
     def opIf(self, block):
-        do_branch = self.ST.pop()
-        assert do_branch.type == Type.i32
-        if do_branch.load() == 0:
-            self.instr_ptr = block.elseOffs
+        if self.stack.pop() == 0:
+            self.instr_ptr = block.elseOffs if block.elseOffs != -1 else block.endOffs
 
     def opElse(self, block):
+        # reached the end of the 'then' arm
         self.instr_ptr = block.endOffs
-        self.adjust_opstack()
 
+    # the arguments stay where they are and become the callee's first locals
     def opCall(self, fnid):
         fn = self.functions[fnid]
-        param_types = fn.params_types()
-        args = []
-        for pt in param_types:
-            p = self.ST.pop()
-            assert p.type == pt
-            args.append(p)
-        args.reverse() # TODO is this the right order or backwards?
-        self.InstrPtrStack.append(self.instr_ptr)
-        self.instr_ptr = 0
-        return_val = self.run_function(fnid, tuple(args))
-        self.instr_ptr = self.InstrPtrStack.pop()
-        self.ST.push(return_val)
+        if fn.imported:
+            stack = self.stack
+            argc = fn.argc
+            args = stack[len(stack) - argc:]
+            del stack[len(stack) - argc:]
+            return_val = fn.call(args)
+            if return_val is not None:
+                stack.append(return_val)
+            return
+        self.enter_function(fn)
+        return True
+
+    # asynchronous execution: a host function returning an awaitable
+    # suspends the guest, see run_slice
+    def opCallAsync(self, fnid):
+        fn = self.functions[fnid]
+        if not fn.imported:
+            return self.opCall(fnid)
+        stack = self.stack
+        argc = fn.argc
+        args = stack[len(stack) - argc:]
+        del stack[len(stack) - argc:]
+        return_val = fn.call_host(args)
+        if inspect.isawaitable(return_val):
+            self.awaiting = return_val
+            return True
+        if return_val is not None:
+            stack.append(return_val)
+
+    # tiered engine: calls go through run_function, which picks the callee's tier
+    def opCallNested(self, fnid):
+        fn = self.functions[fnid]
+        stack = self.stack
+        argc = fn.argc
+        args = stack[len(stack) - argc:]
+        del stack[len(stack) - argc:]
+        return_val = self.run_function(fnid, args)
+        if return_val is not None:
+            stack.append(return_val)
 
     def opBr(self, block):
-        self.instr_ptr = block.endOffs
-        self.adjust_opstack()
+        stack = self.stack
+        if block.results:
+            stack[self.bp + block.keep:] = stack[-1:]
+        else:
+            del stack[self.bp + block.keep:]
+        self.instr_ptr = block.target
 
     def opBrIf(self, block):
-        do_branch = self.ST.pop()
-        assert do_branch.type == Type.i32
-        if do_branch.load() != 0:
+        if self.stack.pop() != 0:
             self.opBr(block)
 
-    def opEnd(self, block):
-        print("Block kind:", block.kind, end=" ")
+    # tiered engine: branches to a loop count as back-edges of its function
+    def opBrCounting(self, block):
         if block.kind == O.loop:
-            self.instr_ptr = block.startOffs
-            print("-> looping")
-        else:
-            print("-> leaving the block -> pop operands")
-            self.adjust_opstack()
+            self.functions[block.function].backedges += 1
+        self.opBr(block)
 
-    def opBlockStart(self, payload):
-        self.save_opstack()
+    def opBrIfCounting(self, block):
+        if self.stack.pop() != 0:
+            self.opBrCounting(block)
 
-    def opReturn(self, target):
-        print("Jump to the End")
-        self.instr_ptr = target
+    def opBrTable(self, payload):
+        targets, default = payload
+        index = self.stack.pop()
+        self.opBr(targets[index] if index < len(targets) else default)
+
+    def opGetLocal(self, index):
+        stack = self.stack
+        stack.append(stack[self.bp + index])
+
+    def opSetLocal(self, index):
+        stack = self.stack
+        stack[self.bp + index] = stack.pop()
+
+    def opTeeLocal(self, index):
+        stack = self.stack
+        stack[self.bp + index] = stack[-1]
+
+    def opReturn(self, fn_block):
+        self.opBr(fn_block)
 
     def opNothing(self, payload):
-        print("Doing Nothing")
         pass
 
-    def save_opstack(self):
-        self.BlockStackSizes.append(self.ST.size())
+    # superinstructions (see fusion.py): each does the work of its sequence
+    # and skips the rest of it
+    def opLocalLocal(self, payload):
+        a, b = payload
+        stack = self.stack
+        bp = self.bp
+        stack.append(stack[bp + a])
+        stack.append(stack[bp + b])
+        self.instr_ptr += 1
+
+    def opLocalLocalBinop(self, payload):
+        a, b, fn = payload
+        stack = self.stack
+        bp = self.bp
+        stack.append(fn(stack[bp + a], stack[bp + b]))
+        self.instr_ptr += 2
+
+    def opLocalConstBinop(self, payload):
+        a, value, fn = payload
+        stack = self.stack
+        stack.append(fn(stack[self.bp + a], value))
+        self.instr_ptr += 2
+
+    def opLocalBinop(self, payload):
+        a, fn = payload
+        stack = self.stack
+        stack[-1] = fn(stack[-1], stack[self.bp + a])
+        self.instr_ptr += 1
+
+    def opConstBinop(self, payload):
+        value, fn = payload
+        stack = self.stack
+        stack[-1] = fn(stack[-1], value)
+        self.instr_ptr += 1
+
+    def opTeeLocalGetLocal(self, payload):
+        a, b = payload
+        stack = self.stack
+        bp = self.bp
+        stack[bp + a] = stack[-1]
+        stack.append(stack[bp + b])
+        self.instr_ptr += 1
+
+    def opSetLocalGetLocal(self, payload):
+        a, b = payload
+        stack = self.stack
+        bp = self.bp
+        stack[bp + a] = stack.pop()
+        stack.append(stack[bp + b])
+        self.instr_ptr += 1
+
+    # with the branch handler of the dispatch table (counting, fuel)
+    @staticmethod
+    def localConstBinopBrIf(branch):
+        def op(self, payload):
+            a, value, fn, block = payload
+            if fn(self.stack[self.bp + a], value) != 0:
+                branch(self, block)
+            else:
+                self.instr_ptr += 3
+        return op
+
+    # fuel metering, see run_function_metered
+    def opBlockStartFuel(self, block):
+        fuel = self.fuel - block.cost
+        if fuel < 0:
+            raise Trap(OUT_OF_FUEL)
+        self.fuel = fuel
+
+    def opIfFuel(self, block):
+        if self.stack.pop() != 0:
+            fuel = self.fuel - block.cost
+        else:
+            fuel = self.fuel - block.else_cost
+            self.instr_ptr = block.elseOffs if block.elseOffs != -1 else block.endOffs
+        if fuel < 0:
+            raise Trap(OUT_OF_FUEL)
+        self.fuel = fuel
+
+    # a back-edge pays for the next iteration
+    def opBrFuel(self, block):
+        if block.kind == O.loop:
+            fuel = self.fuel - block.cost
+            if fuel < 0:
+                raise Trap(OUT_OF_FUEL)
+            self.fuel = fuel
+            del self.stack[self.bp + block.keep:]
+            self.instr_ptr = block.target
+        else:
+            self.opBr(block)
 
-    def adjust_opstack(self):
-        self.ST.pop_upto(self.BlockStackSizes.pop())
+    def opBrIfFuel(self, block):
+        if self.stack.pop() != 0:
+            if block.kind == O.loop:
+                fuel = self.fuel - block.cost
+                if fuel < 0:
+                    raise Trap(OUT_OF_FUEL)
+                self.fuel = fuel
+                del self.stack[self.bp + block.keep:]
+                self.instr_ptr = block.target
+            else:
+                self.opBr(block)
 
+    def opBrTableFuel(self, payload):
+        targets, default = payload
+        index = self.stack.pop()
+        self.opBrFuel(targets[index] if index < len(targets) else default)
 
-    def init_op_fns(self):
-        S = self.ST
-        self.opFns = {
-            O.unreachable: self.opTODO,
-            O.nop: self.opTODO,
-            O.block: self.opBlockStart,
-            O.loop: self.opBlockStart,
-            O.if_: self.opIf,
-            O.else_: self.opElse,
-            O.end: self.opEnd,
-            O.br: self.opTODO,
-            O.br_if: self.opBrIf,
-            O.br_table: self.opTODO,
-            O.return_: self.opReturn,
+    # the callee's body is paid for with the call
+    def opCallFuel(self, fnid):
+        fn = self.functions[fnid]
+        if fn.imported:
+            return self.opCall(fnid)
+        fuel = self.fuel - fn.body.cost
+        if fuel < 0:
+            raise Trap(OUT_OF_FUEL)
+        self.fuel = fuel
+        self.enter_function(fn)
+        return True
+
+    @staticmethod
+    def memLoad(op):
+        unpack_from, mask = memory.LOADS[op][0].unpack_from, memory.LOADS[op][1]
+        def load(self, payload):
+            stack = self.stack
+            try:
+                value = unpack_from(self.memory.data, stack[-1] + payload[1])[0]
+            except struct.error:
+                raise Trap(memory.OUT_OF_BOUNDS) from None
+            stack[-1] = value if mask is None else value & mask
+        return load
+
+    @staticmethod
+    def memStore(op):
+        pack_into, mask = memory.STORES[op][0].pack_into, memory.STORES[op][1]
+        size = memory.STORES[op][0].size
+        def store(self, payload):
+            stack = self.stack
+            value = stack.pop()
+            addr = stack.pop() + payload[1]
+            mem = self.memory
+            try:
+                pack_into(mem.data, addr, value if mask is None else value & mask)
+            except struct.error:
+                raise Trap(memory.OUT_OF_BOUNDS) from None
+            mem.dirty[addr >> 16] = mem.dirty[(addr + size - 1) >> 16] = 1
+        return store
+
+    def opCurrentMemory(self, payload):
+        self.stack.append(self.memory.size())
+
+    def opGrowMemory(self, payload):
+        stack = self.stack
+        stack[-1] = self.memory.grow(stack[-1])
+
+
+    # The dispatch tables map opcodes to handler(interp, payload). They are
+    # built once per class: here for Interpreter, in __init_subclass__ for
+    # subclasses, so that instances are cheap to create.
+    @classmethod
+    def init_op_fns(cls):
+        cls.opFns = {
+            O.unreachable: cls.opUnreachable,
+            O.nop: cls.opNothing,
+            O.block: cls.opNothing,
+            O.loop: cls.opNothing,
+            O.if_: cls.opIf,
+            O.else_: cls.opElse,
+            O.end: cls.opNothing,
+            O.br: cls.opBr,
+            O.br_if: cls.opBrIf,
+            O.br_table: cls.opBrTable,
+            O.return_: cls.opReturn,
 
             # call operators
-            O.call: self.opCall,
-            O.call_indirect: self.opTODO,
+            O.call: cls.opCall,
+            O.call_indirect: cls.opTODO,
 
             # parametric operators
-            O.drop: self.opTODO,
-            O.select: self.opTODO,
+            O.drop: cls.opDrop,
+            O.select: cls.opSelect,
 
             # variable access
-            O.get_local: lambda p: self.ST.load(p),
-            O.set_local: lambda p: self.ST.store(p),
-            O.tee_local: lambda p: self.ST.tee(p),
-            O.get_global: self.opTODO,
-            O.set_global: self.opTODO,
+            O.get_local: cls.opGetLocal,
+            O.set_local: cls.opSetLocal,
+            O.tee_local: cls.opTeeLocal,
+            O.get_global: cls.opTODO,
+            O.set_global: cls.opTODO,
 
             # memory related operators
-            O.i32_load: self.opTODO,
-            O.i64_load: self.opTODO,
-            O.f32_load: self.opTODO,
-            O.f64_load: self.opTODO,
-            O.i32_load8_s: self.opTODO,
-            O.i32_load8_u: self.opTODO,
-            O.i32_load16_s: self.opTODO,
-            O.i32_load16_u: self.opTODO,
-            O.i64_load8_s: self.opTODO,
-            O.i64_load8_u: self.opTODO,
-            O.i64_load16_s: self.opTODO,
-            O.i64_load16_u: self.opTODO,
-            O.i64_load32_s: self.opTODO,
-            O.i64_load32_u: self.opTODO,
-            O.i32_store: self.opTODO,
-            O.i64_store: self.opTODO,
-            O.f32_store: self.opTODO,
-            O.f64_store: self.opTODO,
-            O.i32_store8: self.opTODO,
-            O.i32_store16: self.opTODO,
-            O.i64_store8: self.opTODO,
-            O.i64_store16: self.opTODO,
-            O.i64_store32: self.opTODO,
-            O.current_memory: self.opTODO,
-            O.grow_memory: self.opTODO,
-
-            # Constants
-            O.i32_const: lambda p: self.ST.push_new(parser.Type.i32, p),
-            O.i64_const: lambda p: self.ST.push_new(parser.Type.i64, p),
-            O.f32_const: lambda p: self.ST.push_new(parser.Type.f32, p),
-            O.f64_const: lambda p: self.ST.push_new(parser.Type.f64, p),
-
-            # comparison operators
-            O.i32_eqz: lambda p: self.unaryOp(eqz),
-            O.i64_eq: lambda p: self.binOp(eq),
-            O.i64_ne: lambda p: self.binOp(ne),
-            O.i32_lt_s: lambda p: self.binOp(lt),
-            O.i32_lt_u: lambda p: self.binOp(lt, False),
-            O.i32_gt_s: lambda p: self.binOp(gt),
-            O.i32_gt_u: lambda p: self.binOp(gt, False),
-            O.i32_le_s: lambda p: self.binOp(le),
-            O.i32_le_u: self.opTODO,
-            O.i32_ge_s: lambda p: self.binOp(ge),
-            O.i32_ge_u: self.opTODO,
-            O.i64_eqz: lambda p: self.unaryOp(eqz),
-            O.i64_eq: lambda p: self.binOp(eq),
-            O.i64_ne: lambda p: self.binOp(ne),
-            O.i64_lt_s: lambda p: self.binOp(lt),
-            O.i64_lt_u: self.opTODO,
-            O.i64_gt_s: lambda p: self.binOp(gt),
-            O.i64_gt_u: self.opTODO,
-            O.i64_le_s: lambda p: self.binOp(le),
-            O.i64_le_u: self.opTODO,
-            O.i64_ge_s: lambda p: self.binOp(ge),
-            O.i64_ge_u: self.opTODO,
-            O.f32_eq: lambda p: self.binOp(eq),
-            O.f32_ne: lambda p: self.binOp(ne),
-            O.f32_lt: lambda p: self.binOp(lt),
-            O.f32_gt: lambda p: self.binOp(gt),
-            O.f32_le: lambda p: self.binOp(le),
-            O.f32_ge: lambda p: self.binOp(ge),
-            O.f64_eq: lambda p: self.binOp(eq),
-            O.f64_ne: lambda p: self.binOp(ne),
-            O.f64_lt: lambda p: self.binOp(lt),
-            O.f64_gt: lambda p: self.binOp(gt),
-            O.f64_le: lambda p: self.binOp(le),
-            O.f64_ge: lambda p: self.binOp(ge),
-
-            # numeric operators
-            O.i32_clz: self.opTODO,
-            O.i32_ctz: self.opTODO,
-            O.i32_popcnt: self.opTODO,
-            O.i32_add: lambda p: self.binOp(add),
-            O.i32_sub: lambda p: self.binOp(sub),
-            O.i32_mul: lambda p: self.binOp(mul),
-            O.i32_div_s: lambda p: self.binOp(div_i),
-            O.i32_div_u: self.opTODO,
-            O.i32_rem_s: lambda p: self.binOp(rem),
-            O.i32_rem_u: self.opTODO,
-            O.i32_and: lambda p: self.binOp(and_),
-            O.i32_or: lambda p: self.binOp(or_),
-            O.i32_xor: lambda p: self.binOp(xor),
-            O.i32_shl: lambda p: self.binOpDiffType(shl),
-            O.i32_shr_s: lambda p: self.binOpDiffType(shr_s),
-            O.i32_shr_u: lambda p: self.binOpDiffType(shr_u_32),
-            O.i32_rotl: self.opTODO,
-            O.i32_rotr: self.opTODO,
-            O.i64_clz: self.opTODO,
-            O.i64_ctz: self.opTODO,
-            O.i64_popcnt: self.opTODO,
-            O.i64_add: lambda p: self.binOp(add),
-            O.i64_sub: lambda p: self.binOp(sub),
-            O.i64_mul: lambda p: self.binOp(mul),
-            O.i64_div_s: lambda p: self.binOp(div_i),
-            O.i64_div_u: self.opTODO,
-            O.i64_rem_s: lambda p: self.binOp(rem),
-            O.i64_rem_u: self.opTODO,
-            O.i64_and: lambda p: self.binOp(and_),
-            O.i64_or: lambda p: self.binOp(or_),
-            O.i64_xor: lambda p: self.binOp(xor),
-            O.i64_shl: lambda p: self.binOpDiffType(shl),
-            O.i64_shr_s: lambda p: self.binOpDiffType(shr_s),
-            O.i64_shr_u: lambda p: self.binOpDiffType(shr_u_64),
-            O.i64_rotl: self.opTODO,
-            O.i64_rotr: self.opTODO,
-            O.f32_abs: lambda p: self.unaryOp(abs_),
-            O.f32_neg: lambda p: self.unaryOp(neg),
-            O.f32_ceil: lambda p: self.unaryOp(ceil_),
-            O.f32_floor: lambda p: self.unaryOp(floor_),
-            O.f32_trunc: lambda p: self.unaryOp(trunc_),
-            O.f32_nearest: self.opTODO,
-            O.f32_sqrt: lambda p: self.unaryOp(sqrt_),
-            O.f32_add: lambda p: self.binOp(add),
-            O.f32_sub: lambda p: self.binOp(sub),
-            O.f32_mul: lambda p: self.binOp(mul),
-            O.f32_div: lambda p: self.binOp(div_f),
-            O.f32_min: lambda p: self.binOp(min_),
-            O.f32_max: lambda p: self.binOp(max_),
-            O.f32_copysign: self.opTODO,
-            O.f64_abs: lambda p: self.unaryOp(abs_),
-            O.f64_neg: lambda p: self.unaryOp(neg),
-            O.f64_ceil: lambda p: self.unaryOp(ceil_),
-            O.f64_floor: lambda p: self.unaryOp(floor_),
-            O.f64_trunc: lambda p: self.unaryOp(trunc_),
-            O.f64_nearest: self.opTODO,
-            O.f64_sqrt: lambda p: self.unaryOp(sqrt_),
-            O.f64_add: lambda p: self.binOp(add),
-            O.f64_sub: lambda p: self.binOp(sub),
-            O.f64_mul: lambda p: self.binOp(mul),
-            O.f64_div: lambda p: self.binOp(div_f),
-            O.f64_min: lambda p: self.binOp(min_),
-            O.f64_max: lambda p: self.binOp(max_),
-            O.f64_copysign: self.opTODO,
-
-            # conversions
-            O.i32_wrap_i64: lambda p: self.unaryOp(wrap32),
-            O.i32_trunc_s_f32: self.opTODO,
-            O.i32_trunc_u_f32: self.opTODO,
-            O.i32_trunc_s_f64: self.opTODO,
-            O.i32_trunc_u_f64: self.opTODO,
-            O.i64_extend_s_i32: self.opNothing,
-            O.i64_extend_u_i32: self.opNothing,
-            O.i64_trunc_s_f32: self.opTODO,
-            O.i64_trunc_u_f32: self.opTODO,
-            O.i64_trunc_s_f64: self.opTODO,
-            O.i64_trunc_u_f64: self.opTODO,
-            O.f32_convert_s_i32: self.opTODO,
-            O.f32_convert_u_i32: self.opTODO,
-            O.f32_convert_s_i64: self.opTODO,
-            O.f32_convert_u_i64: self.opTODO,
-            O.f32_demote_f64: self.opTODO,
-            O.f64_convert_s_i32: self.opTODO,
-            O.f64_convert_u_i32: self.opTODO,
-            O.f64_convert_s_i64: self.opTODO,
-            O.f64_convert_u_i64: self.opTODO,
-            O.f64_promote_f32: self.opTODO,
-
-            # reinterpretations
-            O.i32_reinterpret_f32: self.opTODO,
-            O.i64_reinterpret_f64: self.opTODO,
-            O.f32_reinterpret_i32: self.opTODO,
-            O.f64_reinterpret_i64: self.opTODO,
+            O.current_memory: cls.opCurrentMemory,
+            O.grow_memory: cls.opGrowMemory,
+
+            # Constants (payloads are already canonical, see const_value)
+            O.i32_const: lambda self, p: self.stack.append(p),
+            O.i64_const: lambda self, p: self.stack.append(p),
+            O.f32_const: lambda self, p: self.stack.append(p),
+            O.f64_const: lambda self, p: self.stack.append(p),
         }
+        # numeric, comparison and conversion operators
+        for op, fn in UNARY_OPS.items():
+            cls.opFns[op] = cls.unaryOp(fn)
+        for op, fn in BINARY_OPS.items():
+            cls.opFns[op] = cls.binOp(fn)
+        # loads and stores
+        for op in memory.LOADS:
+            cls.opFns[op] = cls.memLoad(op)
+        for op in memory.STORES:
+            cls.opFns[op] = cls.memStore(op)
+        # superinstructions
+        cls.opFns.update({
+            F.local_local: cls.opLocalLocal,
+            F.local_local_binop: cls.opLocalLocalBinop,
+            F.local_const_binop: cls.opLocalConstBinop,
+            F.local_const_binop_br_if: cls.localConstBinopBrIf(cls.opBr),
+            F.local_binop: cls.opLocalBinop,
+            F.const_binop: cls.opConstBinop,
+            F.tee_local_get_local: cls.opTeeLocalGetLocal,
+            F.set_local_get_local: cls.opSetLocalGetLocal,
+        })
+        # the tiered engine counts loop back-edges while interpreting
+        cls.tieredOpFns = dict(cls.opFns)
+        cls.tieredOpFns[O.br] = cls.opBrCounting
+        cls.tieredOpFns[O.br_if] = cls.opBrIfCounting
+        cls.tieredOpFns[O.call] = cls.opCallNested
+        cls.tieredOpFns[F.local_const_binop_br_if] = cls.localConstBinopBrIf(cls.opBrCounting)
+        cls.asyncOpFns = dict(cls.opFns)
+        cls.asyncOpFns[O.call] = cls.opCallAsync
+        cls.fuelOpFns = dict(cls.opFns)
+        cls.fuelOpFns[O.block] = cls.opBlockStartFuel
+        cls.fuelOpFns[O.loop] = cls.opBlockStartFuel
+        cls.fuelOpFns[O.if_] = cls.opIfFuel
+        cls.fuelOpFns[O.br] = cls.opBrFuel
+        cls.fuelOpFns[O.br_if] = cls.opBrIfFuel
+        cls.fuelOpFns[O.br_table] = cls.opBrTableFuel
+        cls.fuelOpFns[O.call] = cls.opCallFuel
+        cls.fuelOpFns[F.local_const_binop_br_if] = cls.localConstBinopBrIf(cls.opBrFuel)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.init_op_fns()
+
+
+Interpreter.init_op_fns()
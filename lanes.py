@@ -0,0 +1,429 @@
+import numpy as np
+
+from opcodes import Opcode as O
+from operations import Trap
+from parser import Type
+
+# Lane-parallel execution of a function over many argument tuples at once
+# (Interpreter.run_exported_fn_batch). Every operand stack value and local is
+# a NumPy array with one lane per argument tuple; integers are kept canonical
+# as unsigned arrays like in the scalar engines. Control flow is structured:
+# a boolean mask tells which lanes are executing, a branch moves the lanes
+# taking it out of the mask until control reaches the branch target, and
+# blocks, ifs and loops merge the values of lanes that got there in
+# different ways with np.where. An operation that may trap checks the active
+# lanes only; if one of them traps, the whole batch does. Functions that use
+# memory, globals or tables are not supported.
+
+DTYPES = {
+    Type.i32: np.uint32,
+    Type.i64: np.uint64,
+    Type.f32: np.float32,
+    Type.f64: np.float64,
+}
+# the signed view of the integers when handing results back (see to_host)
+HOST_DTYPES = {
+    Type.i32: np.int32,
+    Type.i64: np.int64,
+    Type.f32: np.float32,
+    Type.f64: np.float64,
+}
+CONSTS = {
+    O.i32_const: np.uint32,
+    O.i64_const: np.uint64,
+    O.f32_const: np.float32,
+    O.f64_const: np.float64,
+}
+
+
+def _bool(a):
+    return a.astype(np.uint32)
+
+
+# bit length of uint32 lanes: exact through float64
+def _bit_length32(a):
+    return np.frexp(a.astype(np.float64))[1]
+
+
+def _bit_length64(a):
+    hi = (a >> np.uint64(32)).astype(np.uint32)
+    return np.where(hi != 0, _bit_length32(hi) + 32, _bit_length32(a.astype(np.uint32)))
+
+
+def _clz(bits, bit_length, dtype):
+    return lambda a: (bits - bit_length(a)).astype(dtype)
+
+
+def _ctz(bits, bit_length, dtype):
+    def ctz(a):
+        low = a & (~a + dtype(1))  # lowest set bit
+        return np.where(a == 0, bits, bit_length(low) - 1).astype(dtype)
+    return ctz
+
+
+def _trap_lanes(failed, message):
+    if failed.any():
+        raise Trap(message)
+
+
+def _int_div(unsigned, signed, minimum, rem):
+    def div_s(a, b, active):
+        sa, sb = a.view(signed), b.view(signed)
+        _trap_lanes(active & (b == 0), "integer divide by zero")
+        overflow = (sa == minimum) & (sb == -1)
+        if not rem:
+            _trap_lanes(active & overflow, "integer overflow")
+        sb = np.where((b == 0) | overflow, signed(1), sb)
+        r = np.fmod(sa, sb)  # truncating, like the scalar _rem_s
+        return r.view(unsigned) if rem else ((sa - r) // sb).view(unsigned)
+
+    def div_u(a, b, active):
+        _trap_lanes(active & (b == 0), "integer divide by zero")
+        b = np.where(b == 0, unsigned(1), b)
+        return a % b if rem else a // b
+    return div_s, div_u
+
+
+# float -> integer truncation: valid for lo < a < hi, bounds exact in float64
+def _trunc(lo, hi, target, unsigned):
+    def trunc(a, active):
+        wide = a.astype(np.float64)
+        bad = active & ~((wide > lo) & (wide < hi))
+        if bad.any():
+            first = np.argmax(bad)
+            raise Trap("invalid conversion to integer" if np.isnan(wide[first]) else "integer overflow")
+        return np.where((wide > lo) & (wide < hi), wide, 0).astype(target).view(unsigned)
+    return trunc
+
+
+def _shift(unsigned, signed, bits):
+    mask = unsigned(bits - 1)
+    def shr_s(a, b):
+        return (a.view(signed) >> (b & mask).astype(signed)).view(unsigned)
+
+    def rotl(a, b):
+        k = b & mask
+        return (a << k) | (a >> ((unsigned(bits) - k) & mask))
+
+    def rotr(a, b):
+        k = b & mask
+        return (a >> k) | (a << ((unsigned(bits) - k) & mask))
+    return (lambda a, b: a << (b & mask)), shr_s, (lambda a, b: a >> (b & mask)), rotl, rotr
+
+
+def _f_min(a, b):
+    return np.where(a == b, np.where(np.signbit(a), a, b), np.minimum(a, b))
+
+
+def _f_max(a, b):
+    return np.where(a == b, np.where(np.signbit(a), b, a), np.maximum(a, b))
+
+
+UNARY = {
+    O.i32_eqz: lambda a: _bool(a == 0),
+    O.i64_eqz: lambda a: _bool(a == 0),
+    O.i32_clz: _clz(32, _bit_length32, np.uint32),
+    O.i32_ctz: _ctz(32, _bit_length32, np.uint32),
+    O.i32_popcnt: lambda a: np.bitwise_count(a).astype(np.uint32),
+    O.i64_clz: _clz(64, _bit_length64, np.uint64),
+    O.i64_ctz: _ctz(64, _bit_length64, np.uint64),
+    O.i64_popcnt: lambda a: np.bitwise_count(a).astype(np.uint64),
+
+    # conversions (int -> float through float64 like f32(float(x)))
+    O.i32_wrap_i64: lambda a: a.astype(np.uint32),
+    O.i64_extend_s_i32: lambda a: a.view(np.int32).astype(np.int64).view(np.uint64),
+    O.i64_extend_u_i32: lambda a: a.astype(np.uint64),
+    O.f32_convert_s_i32: lambda a: a.view(np.int32).astype(np.float32),
+    O.f32_convert_u_i32: lambda a: a.astype(np.float32),
+    O.f32_convert_s_i64: lambda a: a.view(np.int64).astype(np.float64).astype(np.float32),
+    O.f32_convert_u_i64: lambda a: a.astype(np.float64).astype(np.float32),
+    O.f64_convert_s_i32: lambda a: a.view(np.int32).astype(np.float64),
+    O.f64_convert_u_i32: lambda a: a.astype(np.float64),
+    O.f64_convert_s_i64: lambda a: a.view(np.int64).astype(np.float64),
+    O.f64_convert_u_i64: lambda a: a.astype(np.float64),
+    O.f32_demote_f64: lambda a: a.astype(np.float32),
+    O.f64_promote_f32: lambda a: a.astype(np.float64),
+
+    # reinterpretations
+    O.i32_reinterpret_f32: lambda a: a.view(np.uint32),
+    O.i64_reinterpret_f64: lambda a: a.view(np.uint64),
+    O.f32_reinterpret_i32: lambda a: a.view(np.float32),
+    O.f64_reinterpret_i64: lambda a: a.view(np.float64),
+}
+for _t in ("f32", "f64"):
+    UNARY[O[f"{_t}_abs"]] = np.abs
+    UNARY[O[f"{_t}_neg"]] = np.negative
+    UNARY[O[f"{_t}_ceil"]] = np.ceil
+    UNARY[O[f"{_t}_floor"]] = np.floor
+    UNARY[O[f"{_t}_trunc"]] = np.trunc
+    UNARY[O[f"{_t}_nearest"]] = np.rint
+    UNARY[O[f"{_t}_sqrt"]] = np.sqrt
+
+# unary operations that may trap: (a, active) -> result
+UNARY_TRAPPING = {
+    O.i32_trunc_s_f32: _trunc(-2147483649.0, 2147483648.0, np.int32, np.uint32),
+    O.i32_trunc_s_f64: _trunc(-2147483649.0, 2147483648.0, np.int32, np.uint32),
+    O.i32_trunc_u_f32: _trunc(-1.0, 4294967296.0, np.uint32, np.uint32),
+    O.i32_trunc_u_f64: _trunc(-1.0, 4294967296.0, np.uint32, np.uint32),
+    # no float lies strictly between -2**63 - 1 and -2**63
+    O.i64_trunc_s_f32: _trunc(-9223372036854777856.0, 9223372036854775808.0, np.int64, np.uint64),
+    O.i64_trunc_s_f64: _trunc(-9223372036854777856.0, 9223372036854775808.0, np.int64, np.uint64),
+    O.i64_trunc_u_f32: _trunc(-1.0, 18446744073709551616.0, np.uint64, np.uint64),
+    O.i64_trunc_u_f64: _trunc(-1.0, 18446744073709551616.0, np.uint64, np.uint64),
+}
+
+BINARY = {}
+for _t, _unsigned, _signed, _bits in (("i32", np.uint32, np.int32, 32), ("i64", np.uint64, np.int64, 64)):
+    BINARY[O[f"{_t}_add"]] = np.add
+    BINARY[O[f"{_t}_sub"]] = np.subtract
+    BINARY[O[f"{_t}_mul"]] = np.multiply
+    BINARY[O[f"{_t}_and"]] = np.bitwise_and
+    BINARY[O[f"{_t}_or"]] = np.bitwise_or
+    BINARY[O[f"{_t}_xor"]] = np.bitwise_xor
+    (BINARY[O[f"{_t}_shl"]], BINARY[O[f"{_t}_shr_s"]], BINARY[O[f"{_t}_shr_u"]],
+     BINARY[O[f"{_t}_rotl"]], BINARY[O[f"{_t}_rotr"]]) = _shift(_unsigned, _signed, _bits)
+    BINARY[O[f"{_t}_eq"]] = lambda a, b: _bool(a == b)
+    BINARY[O[f"{_t}_ne"]] = lambda a, b: _bool(a != b)
+    BINARY[O[f"{_t}_lt_u"]] = lambda a, b: _bool(a < b)
+    BINARY[O[f"{_t}_gt_u"]] = lambda a, b: _bool(a > b)
+    BINARY[O[f"{_t}_le_u"]] = lambda a, b: _bool(a <= b)
+    BINARY[O[f"{_t}_ge_u"]] = lambda a, b: _bool(a >= b)
+    BINARY[O[f"{_t}_lt_s"]] = lambda a, b, s=_signed: _bool(a.view(s) < b.view(s))
+    BINARY[O[f"{_t}_gt_s"]] = lambda a, b, s=_signed: _bool(a.view(s) > b.view(s))
+    BINARY[O[f"{_t}_le_s"]] = lambda a, b, s=_signed: _bool(a.view(s) <= b.view(s))
+    BINARY[O[f"{_t}_ge_s"]] = lambda a, b, s=_signed: _bool(a.view(s) >= b.view(s))
+for _t in ("f32", "f64"):
+    BINARY[O[f"{_t}_add"]] = np.add
+    BINARY[O[f"{_t}_sub"]] = np.subtract
+    BINARY[O[f"{_t}_mul"]] = np.multiply
+    BINARY[O[f"{_t}_div"]] = np.divide
+    BINARY[O[f"{_t}_min"]] = _f_min
+    BINARY[O[f"{_t}_max"]] = _f_max
+    BINARY[O[f"{_t}_copysign"]] = np.copysign
+    BINARY[O[f"{_t}_eq"]] = lambda a, b: _bool(a == b)
+    BINARY[O[f"{_t}_ne"]] = lambda a, b: _bool(a != b)
+    BINARY[O[f"{_t}_lt"]] = lambda a, b: _bool(a < b)
+    BINARY[O[f"{_t}_gt"]] = lambda a, b: _bool(a > b)
+    BINARY[O[f"{_t}_le"]] = lambda a, b: _bool(a <= b)
+    BINARY[O[f"{_t}_ge"]] = lambda a, b: _bool(a >= b)
+
+# binary operations that may trap: (a, b, active) -> result
+BINARY_TRAPPING = {}
+(BINARY_TRAPPING[O.i32_div_s], BINARY_TRAPPING[O.i32_div_u]) = _int_div(np.uint32, np.int32, -0x80000000, False)
+(BINARY_TRAPPING[O.i32_rem_s], BINARY_TRAPPING[O.i32_rem_u]) = _int_div(np.uint32, np.int32, -0x80000000, True)
+(BINARY_TRAPPING[O.i64_div_s], BINARY_TRAPPING[O.i64_div_u]) = _int_div(np.uint64, np.int64, -0x8000000000000000, False)
+(BINARY_TRAPPING[O.i64_rem_s], BINARY_TRAPPING[O.i64_rem_u]) = _int_div(np.uint64, np.int64, -0x8000000000000000, True)
+
+
+# Runs function `id` of `interp` once per element of the host argument
+# arrays (one array per parameter, all of the same length). Returns the
+# results as an array of the host dtype, or None for a function without result.
+def run_batch(interp, id, arrays):
+    fn = interp.functions[id]
+    param_types = fn.params_types()
+    assert len(param_types) == len(arrays)
+    arrays = [np.asarray(a) for a in arrays]
+    if len({len(a) for a in arrays}) > 1:
+        raise Exception(f"Argument arrays differ in length: {[len(a) for a in arrays]}")
+    args = [a.astype(DTYPES[t]) for t, a in zip(param_types, arrays)]
+    lanes = len(args[0]) if args else 1
+    with np.errstate(all="ignore"):  # inactive lanes may compute anything
+        result = execute(interp, id, args, lanes)
+    if not fn.return_types():
+        return None
+    type = fn.return_types()[0]
+    return result.view(HOST_DTYPES[type]) if type in (Type.i32, Type.i64) else result
+
+
+# Runs function `id` on `lanes` lanes of the argument arrays `args`
+# (canonical dtypes). Returns the result array or None.
+def execute(interp, id, args, lanes):
+    fn = interp.functions[id]
+    if fn.imported:
+        raise Exception(f"Imported function {fn.module}.{fn.field} is not supported in batch mode")
+    result = _Run(interp, fn, args, lanes).run()
+    if result is None and fn.return_types():  # no lanes, or all of them trapped
+        result = np.zeros(lanes, dtype=DTYPES[fn.return_types()[0]])
+    return result
+
+
+class _Run:
+    def __init__(self, interp, fn, args, lanes):
+        self.interp = interp
+        self.fn = fn
+        self.lanes = lanes
+        self.active = np.ones(lanes, dtype=bool)
+        self.live = lanes > 0  # some lane is active
+        self.all = self.live   # every lane is active
+        self.locals = list(args)
+        for count, t in fn.locals:
+            self.locals.extend(np.zeros(self.lanes, dtype=DTYPES[t]) for _ in range(count))
+        self.stack = []
+        # branch target block -> [lanes that branched to it, their value]
+        self.targets = {}
+
+    def set_active(self, mask):
+        self.active = mask
+        self.live = bool(mask.any())
+        self.all = self.live and bool(mask.all())
+
+    def run(self):
+        body = self.fn.body
+        self.targets[body] = [np.zeros(self.lanes, dtype=bool), None]
+        self.run_region(self.fn.code, 0, len(self.fn.code))
+        return self.merge(body, 0)
+
+    # The block's value for the lanes that reached its end, falling through
+    # (active, value on top of the stack above `height`) or by a branch.
+    # The stack is cut back to `height`; the lanes that got there are active.
+    def merge(self, blk, height):
+        exit_mask, exit_value = self.targets.pop(blk)
+        value = None
+        if blk.arity:
+            if self.live and len(self.stack) > height:
+                value = self.stack[-1]
+                if exit_value is not None:
+                    value = np.where(exit_mask, exit_value, value)
+            else:
+                value = exit_value
+        del self.stack[height:]
+        self.set_active(exit_mask | self.active if self.live else exit_mask)
+        return value
+
+    def branch(self, blk, mask):
+        target = self.targets[blk]
+        target[0] = target[0] | mask
+        if blk.branch_arity():
+            top = self.stack[-1]
+            target[1] = top if target[1] is None else np.where(mask, top, target[1])
+
+    def run_region(self, code, i, end):
+        stack = self.stack
+        while i < end and self.live:
+            instr = code[i]
+            op = instr.opcode
+            p = instr.payload
+            if op in BINARY:
+                b = stack.pop()
+                stack[-1] = BINARY[op](stack[-1], b)
+            elif op in UNARY:
+                stack[-1] = UNARY[op](stack[-1])
+            elif op == O.get_local:
+                stack.append(self.locals[p])
+            elif op == O.set_local or op == O.tee_local:
+                value = stack.pop() if op == O.set_local else stack[-1]
+                self.locals[p] = value if self.all else np.where(self.active, value, self.locals[p])
+            elif op in CONSTS:
+                stack.append(np.full(self.lanes, p, dtype=CONSTS[op]))
+            elif op in BINARY_TRAPPING:
+                b = stack.pop()
+                stack[-1] = BINARY_TRAPPING[op](stack[-1], b, self.active)
+            elif op in UNARY_TRAPPING:
+                stack[-1] = UNARY_TRAPPING[op](stack[-1], self.active)
+            elif op in (O.block, O.loop, O.if_):
+                i = self.run_block(code, i, p)
+                continue
+            elif op == O.br or op == O.return_:
+                self.branch(p, self.active)
+                self.set_active(np.zeros(self.lanes, dtype=bool))
+            elif op == O.br_if:
+                taken = self.active & (stack.pop() != 0)
+                if taken.any():
+                    self.branch(p, taken)
+                    self.set_active(self.active & ~taken)
+            elif op == O.br_table:
+                blocks, default = p
+                # entry len(blocks) stands for the default
+                chosen = np.minimum(stack.pop(), len(blocks))
+                for k, blk in enumerate(blocks + (default,)):
+                    taken = self.active & (chosen == k)
+                    if taken.any():
+                        self.branch(blk, taken)
+                self.set_active(np.zeros(self.lanes, dtype=bool))
+            elif op == O.call:
+                self.call(p)
+            elif op == O.drop:
+                stack.pop()
+            elif op == O.select:
+                cond = stack.pop()
+                b = stack.pop()
+                stack[-1] = np.where(cond != 0, stack[-1], b)
+            elif op == O.unreachable:
+                raise Trap("unreachable executed")
+            elif op not in (O.nop, O.end):  # the end of the function body
+                raise Exception(f"{op.name} is not supported in batch mode")
+            i += 1
+
+    # runs the block, loop or if starting at i; returns where execution goes on
+    def run_block(self, code, i, blk):
+        stack = self.stack
+        if blk.kind == O.if_:
+            cond = stack.pop() != 0
+            height = len(stack)
+            self.targets[blk] = [np.zeros(self.lanes, dtype=bool), None]
+            entry = self.active
+            arms = []  # (lanes falling out of the arm, their value)
+            then_end = blk.elseOffs if blk.elseOffs != -1 else blk.endOffs
+            for start, end, mask in ((i + 1, then_end, entry & cond), (then_end + 1, blk.endOffs, entry & ~cond)):
+                self.set_active(mask)
+                if start < end:
+                    self.run_region(code, start, end)
+                if self.live:
+                    arms.append((self.active, stack[-1] if blk.arity else None))
+                del stack[height:]
+            # both arms fall through to the end as if they were one block
+            if len(arms) == 2:
+                (then_mask, then_value), (else_mask, else_value) = arms
+                self.set_active(then_mask | else_mask)
+                if blk.arity:
+                    stack.append(np.where(then_mask, then_value, else_value))
+            elif arms:
+                self.set_active(arms[0][0])
+                if blk.arity:
+                    stack.append(arms[0][1])
+            else:
+                self.set_active(np.zeros(self.lanes, dtype=bool))
+            value = self.merge(blk, height)
+        elif blk.kind == O.loop:
+            height = len(stack)
+            fallen = np.zeros(self.lanes, dtype=bool)
+            value = None
+            while True:
+                self.targets[blk] = [np.zeros(self.lanes, dtype=bool), None]
+                self.run_region(code, i + 1, blk.endOffs)
+                if self.live:
+                    fallen = fallen | self.active
+                    if blk.arity:
+                        value = stack[-1] if value is None else np.where(self.active, stack[-1], value)
+                del stack[height:]
+                again = self.targets.pop(blk)[0]
+                if not again.any():
+                    break
+                self.set_active(again)
+            self.set_active(fallen)
+        else:
+            height = len(stack)
+            self.targets[blk] = [np.zeros(self.lanes, dtype=bool), None]
+            self.run_region(code, i + 1, blk.endOffs)
+            value = self.merge(blk, height)
+        if value is not None:
+            stack.append(value)
+        return blk.endOffs + 1
+
+    # calls run on the active lanes only
+    def call(self, id):
+        callee = self.interp.functions[id]
+        argc = len(callee.params_types())
+        args = self.stack[len(self.stack) - argc:]
+        del self.stack[len(self.stack) - argc:]
+        if self.all:
+            result = execute(self.interp, id, args, self.lanes)
+        else:
+            lanes = np.flatnonzero(self.active)
+            result = execute(self.interp, id, [a[lanes] for a in args], len(lanes))
+            if result is not None:
+                full = np.zeros(self.lanes, dtype=result.dtype)
+                full[lanes] = result
+                result = full
+        if result is not None:
+            self.stack.append(result)
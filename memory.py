@@ -0,0 +1,226 @@
+import itertools
+import mmap
+import struct
+
+import parser
+from opcodes import Opcode as O
+from operations import Trap, MASK32, MASK64, const_value
+
+# Linear memory: one bytearray, grown in place in 64 KiB pages so that
+# engines may keep a reference to it. Loads and stores go through
+# precompiled structs reading and writing the buffer directly; an access
+# past the end makes the struct raise, which is turned into a trap.
+# Every store also sets the flags of the pages it wrote in `dirty`, so that
+# a snapshot can be restored by copying back only those pages.
+# The flags only tell what changed since the latest snapshot, so every
+# snapshot is stamped with a generation and an older one is restored by
+# copying all of the memory.
+
+PAGE_SIZE = 0x10000
+PAGE_SHIFT = 16
+MAX_PAGES = 0x10000  # 4 GiB
+COPY_CHUNK = 0x400000
+
+# generations of snapshots, unique over all memories
+_generations = itertools.count(1)
+
+# opcode -> (struct, mask applied to the unpacked value or None)
+LOADS = {
+    O.i32_load: (struct.Struct('<I'), None),
+    O.i64_load: (struct.Struct('<Q'), None),
+    O.f32_load: (struct.Struct('<f'), None),
+    O.f64_load: (struct.Struct('<d'), None),
+    O.i32_load8_s: (struct.Struct('<b'), MASK32),
+    O.i32_load8_u: (struct.Struct('<B'), None),
+    O.i32_load16_s: (struct.Struct('<h'), MASK32),
+    O.i32_load16_u: (struct.Struct('<H'), None),
+    O.i64_load8_s: (struct.Struct('<b'), MASK64),
+    O.i64_load8_u: (struct.Struct('<B'), None),
+    O.i64_load16_s: (struct.Struct('<h'), MASK64),
+    O.i64_load16_u: (struct.Struct('<H'), None),
+    O.i64_load32_s: (struct.Struct('<i'), MASK64),
+    O.i64_load32_u: (struct.Struct('<I'), None),
+}
+
+# opcode -> (struct, mask applied to the value before packing or None)
+STORES = {
+    O.i32_store: (struct.Struct('<I'), None),
+    O.i64_store: (struct.Struct('<Q'), None),
+    O.f32_store: (struct.Struct('<f'), None),
+    O.f64_store: (struct.Struct('<d'), None),
+    O.i32_store8: (struct.Struct('<B'), 0xff),
+    O.i32_store16: (struct.Struct('<H'), 0xffff),
+    O.i64_store8: (struct.Struct('<B'), 0xff),
+    O.i64_store16: (struct.Struct('<H'), 0xffff),
+    O.i64_store32: (struct.Struct('<I'), MASK32),
+}
+
+OUT_OF_BOUNDS = "out of bounds memory access"
+
+
+class LinearMemory:
+    def __init__(self, initial, maximum=None):
+        if initial > MAX_PAGES:
+            raise Exception(f"Memory of {initial} pages exceeds the 4 GiB limit")
+        self.data = bytearray(initial * PAGE_SIZE)
+        self.pages = initial
+        # one flag per page, set by stores (which shift by PAGE_SHIFT inline);
+        # grown in place like data so that engines may keep a reference
+        self.dirty = bytearray(initial)
+        self.generation = None  # of the snapshot the dirty flags are relative to
+        self.maximum = MAX_PAGES if maximum is None else min(maximum, MAX_PAGES)
+
+    def __repr__(self):
+        return f"<LinearMemory pages={self.pages} max={self.maximum}>"
+
+    # current_memory
+    def size(self):
+        return self.pages
+
+    # grow_memory: returns the old size in pages, or -1 (as u32) on failure
+    def grow(self, delta):
+        old = self.pages
+        if delta > self.maximum - old:
+            return MASK32
+        if delta:
+            self.data.extend(bytes(delta * PAGE_SIZE))
+            self.dirty.extend(bytes(delta))
+            self.pages = old + delta
+        return old
+
+    def write(self, addr, data):
+        if addr + len(data) > len(self.data):
+            raise Trap(OUT_OF_BOUNDS)
+        with memoryview(self.data) as dest:
+            dest[addr:addr + len(data)] = data
+        if data:
+            first, last = addr >> PAGE_SHIFT, (addr + len(data) - 1) >> PAGE_SHIFT
+            self.dirty[first:last + 1] = b"\x01" * (last - first + 1)
+
+    def read(self, addr, size):
+        if addr + size > len(self.data):
+            raise Trap(OUT_OF_BOUNDS)
+        return bytes(self.data[addr:addr + size])
+
+    # The current contents as (generation, pages, bytes), to be passed to
+    # restore. Taking it copies the memory once and clears the dirty flags.
+    def snapshot(self):
+        self.dirty[:] = bytes(self.pages)
+        self.generation = next(_generations)
+        return self.generation, self.pages, bytes(self.data)
+
+    # Returns the memory to a snapshot of it. For the latest snapshot, pages
+    # grown since are dropped and the pages written since are copied back,
+    # in time proportional to their number; any other snapshot is copied
+    # back whole. Returns how many pages were copied.
+    def restore(self, snapshot):
+        generation, pages, saved = snapshot
+        data, dirty = self.data, self.dirty
+        if generation != self.generation:
+            # in place, engines keep references to data and dirty
+            data[:] = saved
+            dirty[:] = bytes(pages)
+            self.pages = pages
+            self.generation = generation
+            return pages
+        if self.pages > pages:
+            del data[pages * PAGE_SIZE:]
+            del dirty[pages:]
+            self.pages = pages
+        assert self.pages == pages  # memory never shrinks
+        copied = 0
+        with memoryview(data) as dest:
+            page = dirty.find(1)
+            while page != -1:
+                start = page * PAGE_SIZE
+                dest[start:start + PAGE_SIZE] = saved[start:start + PAGE_SIZE]
+                dirty[page] = 0
+                copied += 1
+                page = dirty.find(1, page + 1)
+        return copied
+
+
+# The memory of a module: defined in its memory section or imported (the
+# host side of imports is not implemented, so an imported memory is created
+# from its declared limits). Data segments are copied in. Returns None if
+# the module has no memory.
+def instantiate(parse_res):
+    limits = None
+    for module, field, kind, type in parse_res.import_section or ():
+        if kind == parser.ExternalKind.Memory:
+            limits = type
+    if parse_res.memory_section:
+        assert limits is None and len(parse_res.memory_section) == 1
+        limits = parse_res.memory_section[0]
+    if limits is None:
+        assert not parse_res.data_section
+        return None
+    flags, initial, maximum = limits
+    memory = LinearMemory(initial, maximum)
+    for i, (index, offset, size, data) in enumerate(parse_res.data_section or ()):
+        assert index == 0
+        if offset.opcode != O.i32_const:
+            raise Exception(f"TODO implement data segment offset {offset}")
+        addr = const_value(O.i32_const, offset.payload)
+        if addr + size > len(memory.data):
+            raise Exception(f"Data segment {i} does not fit in memory")
+        copy_segment(memory, addr, data)
+    return memory
+
+
+# Copies a data segment into memory. Segments parsed from a mapped file are
+# memoryviews of the mapping; they are copied in chunks and the mapped pages
+# dropped after each one, so the file does not stay resident next to memory.
+def copy_segment(memory, addr, data):
+    mapping = data.obj if isinstance(data, memoryview) else None
+    # through a memoryview: slice assignment into the bytearray would copy the source first.
+    # The view is released again so that the memory can still grow.
+    with memoryview(memory.data) as dest:
+        if not isinstance(mapping, mmap.mmap) or not hasattr(mmap, "MADV_DONTNEED"):
+            dest[addr:addr + len(data)] = data
+            return
+        for start in range(0, len(data), COPY_CHUNK):
+            chunk = data[start:start + COPY_CHUNK]
+            dest[addr + start:addr + start + len(chunk)] = chunk
+            mapping.madvise(mmap.MADV_DONTNEED)
+
+
+# addr -> value for load instruction `op` with a static offset
+def load_function(memory, op, offset):
+    unpack_from, mask = LOADS[op][0].unpack_from, LOADS[op][1]
+    data = memory.data
+    if mask is None:
+        def load(addr):
+            try:
+                return unpack_from(data, addr + offset)[0]
+            except struct.error:
+                raise Trap(OUT_OF_BOUNDS) from None
+    else:
+        def load(addr):
+            try:
+                return unpack_from(data, addr + offset)[0] & mask
+            except struct.error:
+                raise Trap(OUT_OF_BOUNDS) from None
+    return load
+
+
+# (addr, value) -> None for store instruction `op` with a static offset
+def store_function(memory, op, offset):
+    pack_into, mask = STORES[op][0].pack_into, STORES[op][1]
+    last = STORES[op][0].size - 1 + offset
+    data, dirty = memory.data, memory.dirty
+    if mask is None:
+        def store(addr, value):
+            try:
+                pack_into(data, addr + offset, value)
+            except struct.error:
+                raise Trap(OUT_OF_BOUNDS) from None
+            dirty[(addr + offset) >> 16] = dirty[(addr + last) >> 16] = 1
+    else:
+        def store(addr, value):
+            try:
+                pack_into(data, addr + offset, value & mask)
+            except struct.error:
+                raise Trap(OUT_OF_BOUNDS) from None
+            dirty[(addr + offset) >> 16] = dirty[(addr + last) >> 16] = 1
+    return store
@@ -201,5 +201,9 @@ class Op:
             self.opcode = opcode
             self.payload = payload
 
+        # pickled as a constructor call rather than an instance dict (module cache)
+        def __reduce__(self):
+            return Op, (self.opcode, self.payload)
+
         def __repr__(self):
             return f"{self.opcode.name}" + (f"<{self.payload}>" if self.payload is not None else "")
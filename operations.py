@@ -1,79 +1,369 @@
 from parser import Type
+from opcodes import Opcode as O
 import math
 import struct
-import enum
-
-
-def typeToStruct(type, signed):
-    if signed:
-        return {Type.i32: ('i', 31), Type.i64: ('q', 63), Type.f32: ('f', -1), Type.f64: ('d', -1)}[type]
-    return {Type.i32: ('I', 32), Type.i64: ('Q', 64), Type.f32: ('f', -1), Type.f64: ('d', -1)}[type]
-
-class StackValue:
-    def __init__(self, type, val=None, signed=True):
-        assert type in (Type.i32, Type.i64, Type.f32, Type.f64)
-        self.type = type
-        if val is not None:
-            self.store(val, signed)
-        else:
-            if type in (Type.i32, Type.i64):
-                self.store(0)
-            else:
-                self.store(0.0)
-
-
-    def load(self, signed=True):
-        struct_type, _ = typeToStruct(self.type, signed)
-        return struct.unpack(struct_type, self.val)[0]
-
-    def store(self, val, signed=True):
-        struct_type, bits = typeToStruct(self.type, signed)
-        if bits != -1:
-            if val >= 0:
-                val = val & ((2 ** bits) - 1) # truncate
-            else:
-                val = ~(~val & ((2 ** bits) - 1)) # truncate
-        self.val = struct.pack(struct_type, val)
-
-    def __repr__(self):
-        return f"{self.type.name}({self.load()})"
+
+# Values are plain Python numbers. Integers are kept canonical as unsigned
+# ints (0 <= v < 2**bits); the signed view is only computed where an
+# operation needs it. f32 values are floats already rounded to single
+# precision, f64 values are plain floats.
+
+MASK32 = 0xffffffff
+MASK64 = 0xffffffffffffffff
+SIGN32 = 0x80000000
+SIGN64 = 0x8000000000000000
+
+_f32 = struct.Struct('<f')
+_f64 = struct.Struct('<d')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+
+class Trap(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+OUT_OF_FUEL = "all fuel consumed"
+
+
+def s32(v): return v - 0x100000000 if v & SIGN32 else v
+def s64(v): return v - 0x10000000000000000 if v & SIGN64 else v
+
+def f32(v):
+    try:
+        return _f32.unpack(_f32.pack(v))[0]
+    except OverflowError:
+        return math.copysign(math.inf, v)
+
+
+def default_value(type):
+    return 0.0 if type in (Type.f32, Type.f64) else 0
+
+def from_host(type, val):
+    if type == Type.i32:
+        return int(val) & MASK32
+    if type == Type.i64:
+        return int(val) & MASK64
+    if type == Type.f32:
+        return f32(float(val))
+    return float(val)
+
+def to_host(type, val):
+    if type == Type.i32:
+        return s32(val)
+    if type == Type.i64:
+        return s64(val)
+    return val
+
+# canonical form of a decoded constant payload (the parser yields signed ints)
+def const_value(op, payload):
+    if op == O.i32_const:
+        return payload & MASK32
+    if op == O.i64_const:
+        return payload & MASK64
+    return payload
 
 # unary
-def eqz(v, sgn): return StackValue(Type.i32, int(v.load(sgn) == 0))
-def abs_(v, sgn): return StackValue(v.type, abs(v.load(sgn)))
-def neg(v, sgn): return StackValue(v.type, -v.load(sgn))
-def ceil_(v, sgn): return StackValue(v.type, math.ceil(v.load(sgn)))
-def floor_(v, sgn): return StackValue(v.type, math.floor(v.load(sgn)))
-def trunc_(v, sgn): return StackValue(v.type, math.trunc(v.load(sgn)))
-def sqrt_(v, sgn): return StackValue(v.type, math.sqrt(v.load(sgn)))
+def i32_eqz(a): return 1 if a == 0 else 0
+def i32_clz(a): return 32 - a.bit_length()
+def i32_ctz(a): return (a & -a).bit_length() - 1 if a else 32
+def i32_popcnt(a): return bin(a).count("1")
+def i64_eqz(a): return 1 if a == 0 else 0
+def i64_clz(a): return 64 - a.bit_length()
+def i64_ctz(a): return (a & -a).bit_length() - 1 if a else 64
+def i64_popcnt(a): return bin(a).count("1")
+
+def _fround(fn, a):
+    if a != a or a == math.inf or a == -math.inf:
+        return a
+    return math.copysign(float(fn(a)), a)
+
+def f_abs(a): return abs(a)
+def f_neg(a): return -a
+def f_ceil(a): return _fround(math.ceil, a)
+def f_floor(a): return _fround(math.floor, a)
+def f_trunc(a): return _fround(math.trunc, a)
+def f_nearest(a): return _fround(round, a)
+def f64_sqrt(a): return math.sqrt(a) if a >= 0 else math.nan
+def f32_sqrt(a): return f32(math.sqrt(a)) if a >= 0 else math.nan
 
 # binary
-def add(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) + v2.load(sgn), sgn)
-def sub(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) - v2.load(sgn), sgn)
-def mul(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) * v2.load(sgn), sgn)
-def div_i(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) // v2.load(sgn), sgn)
-def div_f(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) / v2.load(sgn), sgn)
-def rem(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) % v2.load(sgn), sgn)
-
-def and_(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) & v2.load(sgn), sgn)
-def or_(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) | v2.load(sgn), sgn)
-def xor(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) ^ v2.load(sgn), sgn)
-def shl(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) << v2.load(sgn), sgn)
-def shr_s(v1, v2, sgn): return StackValue(v1.type, v1.load(sgn) >> v2.load(sgn), sgn)
-def _shr_u_impl(v1, v2, bits, sgn):
-    val1 = v1.load(False); val2 = v2.load(False)
-    return StackValue(v1.type, val1>>val2 if val1 >= 0 else (val1+(2**bits))>>val2, sgn)
-def shr_u_32(v1, v2, sgn): return _shr_u_impl(v1, v2, 32, sgn)
-def shr_u_64(v1, v2, sgn): return _shr_u_impl(v1, v2, 64, sgn)
-
-def wrap32(v, sgn): return StackValue(Type.i32, v.load(sgn) & 0xffffffff, sgn)
-
-def min_(v1, v2, sgn): return StackValue(Type.i32, min(v1.load(sgn), v2.load(sgn)), sgn)
-def max_(v1, v2, sgn): return StackValue(Type.i32, max(v1.load(sgn), v2.load(sgn)), sgn)
-
-def lt(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) < v2.load(sgn)))
-def gt(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) > v2.load(sgn)))
-def le(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) <= v2.load(sgn)))
-def ge(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) >= v2.load(sgn)))
-def eq(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) == v2.load(sgn)))
-def ne(v1, v2, sgn): return StackValue(Type.i32, int(v1.load(sgn) != v2.load(sgn)))
+def i32_add(a, b): return (a + b) & MASK32
+def i32_sub(a, b): return (a - b) & MASK32
+def i32_mul(a, b): return (a * b) & MASK32
+def i64_add(a, b): return (a + b) & MASK64
+def i64_sub(a, b): return (a - b) & MASK64
+def i64_mul(a, b): return (a * b) & MASK64
+
+def _div_s(a, b, mask, min_val):
+    if b == 0:
+        raise Trap("integer divide by zero")
+    if a == min_val and b == -1:
+        raise Trap("integer overflow")
+    q = abs(a) // abs(b)
+    return (q if (a < 0) == (b < 0) else -q) & mask
+
+def _rem_s(a, b, mask):
+    if b == 0:
+        raise Trap("integer divide by zero")
+    r = abs(a) % abs(b)
+    return (-r if a < 0 else r) & mask
+
+def div_u(a, b):
+    if b == 0:
+        raise Trap("integer divide by zero")
+    return a // b
+
+def rem_u(a, b):
+    if b == 0:
+        raise Trap("integer divide by zero")
+    return a % b
+
+def i32_div_s(a, b): return _div_s(s32(a), s32(b), MASK32, -0x80000000)
+def i64_div_s(a, b): return _div_s(s64(a), s64(b), MASK64, -0x8000000000000000)
+def i32_rem_s(a, b): return _rem_s(s32(a), s32(b), MASK32)
+def i64_rem_s(a, b): return _rem_s(s64(a), s64(b), MASK64)
+
+def and_(a, b): return a & b
+def or_(a, b): return a | b
+def xor(a, b): return a ^ b
+
+def i32_shl(a, b): return (a << (b & 31)) & MASK32
+def i32_shr_s(a, b): return (s32(a) >> (b & 31)) & MASK32
+def i32_shr_u(a, b): return a >> (b & 31)
+def i32_rotl(a, b):
+    k = b & 31
+    return ((a << k) | (a >> (32 - k))) & MASK32
+def i32_rotr(a, b):
+    k = b & 31
+    return ((a >> k) | (a << (32 - k))) & MASK32
+def i64_shl(a, b): return (a << (b & 63)) & MASK64
+def i64_shr_s(a, b): return (s64(a) >> (b & 63)) & MASK64
+def i64_shr_u(a, b): return a >> (b & 63)
+def i64_rotl(a, b):
+    k = b & 63
+    return ((a << k) | (a >> (64 - k))) & MASK64
+def i64_rotr(a, b):
+    k = b & 63
+    return ((a >> k) | (a << (64 - k))) & MASK64
+
+def eq(a, b): return 1 if a == b else 0
+def ne(a, b): return 1 if a != b else 0
+def lt(a, b): return 1 if a < b else 0
+def gt(a, b): return 1 if a > b else 0
+def le(a, b): return 1 if a <= b else 0
+def ge(a, b): return 1 if a >= b else 0
+# flipping the sign bit maps the signed order onto the unsigned one
+def i32_lt_s(a, b): return 1 if (a ^ SIGN32) < (b ^ SIGN32) else 0
+def i32_gt_s(a, b): return 1 if (a ^ SIGN32) > (b ^ SIGN32) else 0
+def i32_le_s(a, b): return 1 if (a ^ SIGN32) <= (b ^ SIGN32) else 0
+def i32_ge_s(a, b): return 1 if (a ^ SIGN32) >= (b ^ SIGN32) else 0
+def i64_lt_s(a, b): return 1 if (a ^ SIGN64) < (b ^ SIGN64) else 0
+def i64_gt_s(a, b): return 1 if (a ^ SIGN64) > (b ^ SIGN64) else 0
+def i64_le_s(a, b): return 1 if (a ^ SIGN64) <= (b ^ SIGN64) else 0
+def i64_ge_s(a, b): return 1 if (a ^ SIGN64) >= (b ^ SIGN64) else 0
+
+def f64_add(a, b): return a + b
+def f64_sub(a, b): return a - b
+def f64_mul(a, b): return a * b
+def f64_div(a, b):
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a != a or a == 0:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+def f32_add(a, b): return f32(a + b)
+def f32_sub(a, b): return f32(a - b)
+def f32_mul(a, b): return f32(a * b)
+def f32_div(a, b): return f32(f64_div(a, b))
+
+def f_min(a, b):
+    if a != a or b != b:
+        return math.nan
+    if a == b:
+        return a if math.copysign(1.0, a) < 0 else b  # min(-0, +0) == -0
+    return a if a < b else b
+def f_max(a, b):
+    if a != a or b != b:
+        return math.nan
+    if a == b:
+        return b if math.copysign(1.0, a) < 0 else a  # max(-0, +0) == +0
+    return a if a > b else b
+def f_copysign(a, b): return math.copysign(a, b)
+
+# conversions
+def i32_wrap_i64(a): return a & MASK32
+def i64_extend_s_i32(a): return s32(a) & MASK64
+def i64_extend_u_i32(a): return a
+
+def _trunc(a, lo, hi, mask):
+    if a != a:
+        raise Trap("invalid conversion to integer")
+    if not (lo - 1 < a < hi):
+        raise Trap("integer overflow")
+    return math.trunc(a) & mask
+
+def i32_trunc_s(a): return _trunc(a, -0x80000000, 0x80000000, MASK32)
+def i32_trunc_u(a): return _trunc(a, 0, 0x100000000, MASK32)
+def i64_trunc_s(a): return _trunc(a, -0x8000000000000000, 0x8000000000000000, MASK64)
+def i64_trunc_u(a): return _trunc(a, 0, 0x10000000000000000, MASK64)
+
+def f32_convert_s_i32(a): return f32(float(s32(a)))
+def f32_convert_u_i32(a): return f32(float(a))
+def f32_convert_s_i64(a): return f32(float(s64(a)))
+def f32_convert_u_i64(a): return f32(float(a))
+def f64_convert_s_i32(a): return float(s32(a))
+def f64_convert_u_i32(a): return float(a)
+def f64_convert_s_i64(a): return float(s64(a))
+def f64_convert_u_i64(a): return float(a)
+def f32_demote_f64(a): return f32(a)
+def f64_promote_f32(a): return a
+
+# reinterpretations
+def i32_reinterpret_f32(a): return _u32.unpack(_f32.pack(a))[0]
+def i64_reinterpret_f64(a): return _u64.unpack(_f64.pack(a))[0]
+def f32_reinterpret_i32(a): return _f32.unpack(_u32.pack(a))[0]
+def f64_reinterpret_i64(a): return _f64.unpack(_u64.pack(a))[0]
+
+
+UNARY_OPS = {
+    O.i32_eqz: i32_eqz,
+    O.i64_eqz: i64_eqz,
+
+    O.i32_clz: i32_clz,
+    O.i32_ctz: i32_ctz,
+    O.i32_popcnt: i32_popcnt,
+    O.i64_clz: i64_clz,
+    O.i64_ctz: i64_ctz,
+    O.i64_popcnt: i64_popcnt,
+    O.f32_abs: f_abs,
+    O.f32_neg: f_neg,
+    O.f32_ceil: f_ceil,
+    O.f32_floor: f_floor,
+    O.f32_trunc: f_trunc,
+    O.f32_nearest: f_nearest,
+    O.f32_sqrt: f32_sqrt,
+    O.f64_abs: f_abs,
+    O.f64_neg: f_neg,
+    O.f64_ceil: f_ceil,
+    O.f64_floor: f_floor,
+    O.f64_trunc: f_trunc,
+    O.f64_nearest: f_nearest,
+    O.f64_sqrt: f64_sqrt,
+
+    # conversions
+    O.i32_wrap_i64: i32_wrap_i64,
+    O.i32_trunc_s_f32: i32_trunc_s,
+    O.i32_trunc_u_f32: i32_trunc_u,
+    O.i32_trunc_s_f64: i32_trunc_s,
+    O.i32_trunc_u_f64: i32_trunc_u,
+    O.i64_extend_s_i32: i64_extend_s_i32,
+    O.i64_extend_u_i32: i64_extend_u_i32,
+    O.i64_trunc_s_f32: i64_trunc_s,
+    O.i64_trunc_u_f32: i64_trunc_u,
+    O.i64_trunc_s_f64: i64_trunc_s,
+    O.i64_trunc_u_f64: i64_trunc_u,
+    O.f32_convert_s_i32: f32_convert_s_i32,
+    O.f32_convert_u_i32: f32_convert_u_i32,
+    O.f32_convert_s_i64: f32_convert_s_i64,
+    O.f32_convert_u_i64: f32_convert_u_i64,
+    O.f32_demote_f64: f32_demote_f64,
+    O.f64_convert_s_i32: f64_convert_s_i32,
+    O.f64_convert_u_i32: f64_convert_u_i32,
+    O.f64_convert_s_i64: f64_convert_s_i64,
+    O.f64_convert_u_i64: f64_convert_u_i64,
+    O.f64_promote_f32: f64_promote_f32,
+
+    # reinterpretations
+    O.i32_reinterpret_f32: i32_reinterpret_f32,
+    O.i64_reinterpret_f64: i64_reinterpret_f64,
+    O.f32_reinterpret_i32: f32_reinterpret_i32,
+    O.f64_reinterpret_i64: f64_reinterpret_i64,
+}
+
+BINARY_OPS = {
+    # comparison operators
+    O.i32_eq: eq,
+    O.i32_ne: ne,
+    O.i32_lt_s: i32_lt_s,
+    O.i32_lt_u: lt,
+    O.i32_gt_s: i32_gt_s,
+    O.i32_gt_u: gt,
+    O.i32_le_s: i32_le_s,
+    O.i32_le_u: le,
+    O.i32_ge_s: i32_ge_s,
+    O.i32_ge_u: ge,
+    O.i64_eq: eq,
+    O.i64_ne: ne,
+    O.i64_lt_s: i64_lt_s,
+    O.i64_lt_u: lt,
+    O.i64_gt_s: i64_gt_s,
+    O.i64_gt_u: gt,
+    O.i64_le_s: i64_le_s,
+    O.i64_le_u: le,
+    O.i64_ge_s: i64_ge_s,
+    O.i64_ge_u: ge,
+    O.f32_eq: eq,
+    O.f32_ne: ne,
+    O.f32_lt: lt,
+    O.f32_gt: gt,
+    O.f32_le: le,
+    O.f32_ge: ge,
+    O.f64_eq: eq,
+    O.f64_ne: ne,
+    O.f64_lt: lt,
+    O.f64_gt: gt,
+    O.f64_le: le,
+    O.f64_ge: ge,
+
+    # numeric operators
+    O.i32_add: i32_add,
+    O.i32_sub: i32_sub,
+    O.i32_mul: i32_mul,
+    O.i32_div_s: i32_div_s,
+    O.i32_div_u: div_u,
+    O.i32_rem_s: i32_rem_s,
+    O.i32_rem_u: rem_u,
+    O.i32_and: and_,
+    O.i32_or: or_,
+    O.i32_xor: xor,
+    O.i32_shl: i32_shl,
+    O.i32_shr_s: i32_shr_s,
+    O.i32_shr_u: i32_shr_u,
+    O.i32_rotl: i32_rotl,
+    O.i32_rotr: i32_rotr,
+    O.i64_add: i64_add,
+    O.i64_sub: i64_sub,
+    O.i64_mul: i64_mul,
+    O.i64_div_s: i64_div_s,
+    O.i64_div_u: div_u,
+    O.i64_rem_s: i64_rem_s,
+    O.i64_rem_u: rem_u,
+    O.i64_and: and_,
+    O.i64_or: or_,
+    O.i64_xor: xor,
+    O.i64_shl: i64_shl,
+    O.i64_shr_s: i64_shr_s,
+    O.i64_shr_u: i64_shr_u,
+    O.i64_rotl: i64_rotl,
+    O.i64_rotr: i64_rotr,
+    O.f32_add: f32_add,
+    O.f32_sub: f32_sub,
+    O.f32_mul: f32_mul,
+    O.f32_div: f32_div,
+    O.f32_min: f_min,
+    O.f32_max: f_max,
+    O.f32_copysign: f_copysign,
+    O.f64_add: f64_add,
+    O.f64_sub: f64_sub,
+    O.f64_mul: f64_mul,
+    O.f64_div: f64_div,
+    O.f64_min: f_min,
+    O.f64_max: f_max,
+    O.f64_copysign: f_copysign,
+}
@@ -0,0 +1,209 @@
+import opcodes
+from opcodes import Opcode as O
+from operations import Trap, UNARY_OPS, BINARY_OPS
+from validation import CONSTS, NUMERIC
+
+# Load-time optimizations of a function's code, run by prepare_body after
+# createInnerBlocks (so blocks, branches and returns refer to InstrBlocks)
+# and before its stack heights and branches are resolved. Every engine runs
+# the optimized code.
+#
+# A pass works on the code in place: it replaces instructions, and deletes
+# them by setting them to None, so that the offsets of the blocks stay
+# valid while passes run. compact() then removes the deleted instructions
+# and moves the blocks' offsets. Passes only combine instructions within a
+# straight-line run of code (never across an instruction a branch can
+# continue after), and never delete a block, loop, if, else or end that is
+# reachable.
+#
+# Fuel costs of blocks are computed before optimizing, so a call takes the
+# same fuel at every level.
+
+DEFAULT_LEVEL = 2
+
+# instructions that end a straight-line run of code
+CONTROL = {O.block, O.loop, O.if_, O.else_, O.end, O.br, O.br_if, O.br_table, O.return_, O.unreachable}
+# instructions after which the rest of the block is unreachable
+UNCONDITIONAL = {O.br, O.br_table, O.return_, O.unreachable}
+RESULT_CONSTS = {t: op for op, t in CONSTS.items()}
+
+
+def const(opcode, value):
+    return opcodes.Op(RESULT_CONSTS[NUMERIC[opcode][1]], value)
+
+
+# Folds numeric instructions on constants into constants, with the
+# interpreter's own operators (so wrapping and rounding are the same as at
+# run time; an operation that would trap is left alone), and conditional
+# branches on constants into a branch or nothing.
+def fold_constants(code):
+    run = [] # offsets of the instructions of the current run of code
+    for i, instr in enumerate(code):
+        if instr is None:
+            continue
+        op = instr.opcode
+        if op in UNARY_OPS and run and code[run[-1]].opcode in CONSTS:
+            try:
+                value = UNARY_OPS[op](code[run[-1]].payload)
+            except Trap:
+                run.append(i)
+                continue
+            code[run.pop()] = None
+            code[i] = const(op, value)
+        elif op in BINARY_OPS and len(run) >= 2 and code[run[-1]].opcode in CONSTS and code[run[-2]].opcode in CONSTS:
+            try:
+                value = BINARY_OPS[op](code[run[-2]].payload, code[run[-1]].payload)
+            except Trap:
+                run.append(i)
+                continue
+            code[run.pop()] = code[run.pop()] = None
+            code[i] = const(op, value)
+        elif op == O.br_if and run and code[run[-1]].opcode == O.i32_const:
+            cond = run.pop()
+            code[i] = opcodes.Op(O.br, instr.payload) if code[cond].payload != 0 else None
+            code[cond] = None
+            run.clear()
+            continue
+        elif op in CONTROL:
+            run.clear()
+            continue
+        run.append(i)
+
+
+# Deletes the code after an unconditional branch, return or unreachable up
+# to the end (or else) of the enclosing block, nested blocks included.
+def remove_unreachable(code):
+    i = 0
+    while i < len(code):
+        instr = code[i]
+        i += 1
+        if instr is None or instr.opcode not in UNCONDITIONAL:
+            continue
+        depth = 0
+        while i < len(code):
+            dead = code[i]
+            if dead is not None:
+                if dead.opcode in (O.block, O.loop, O.if_):
+                    depth += 1
+                elif dead.opcode in (O.end, O.else_) and depth == 0:
+                    break
+                elif dead.opcode == O.end:
+                    depth -= 1
+                code[i] = None
+            i += 1
+
+
+# Within a straight-line run of code, reads of a local that holds a copy of
+# another one (after get_local a; set_local b or tee_local b) read the
+# original instead, which may leave the copy unread (see remove_dead_stores).
+def propagate_copies(code):
+    copies = {} # local -> the local it is a copy of
+    prev = None
+    for i, instr in enumerate(code):
+        if instr is None:
+            continue
+        op = instr.opcode
+        if op in CONTROL:
+            copies.clear()
+        elif op == O.get_local and instr.payload in copies:
+            code[i] = instr = opcodes.Op(O.get_local, copies[instr.payload])
+        elif op in (O.set_local, O.tee_local):
+            local = instr.payload
+            copies.pop(local, None)
+            for copy in [copy for copy, source in copies.items() if source == local]:
+                del copies[copy]
+            if prev is not None and prev.opcode == O.get_local and prev.payload != local:
+                copies[local] = prev.payload
+        prev = instr
+
+
+# Writes to locals that are never read are dropped: set_local becomes drop,
+# tee_local goes away.
+def remove_dead_stores(code):
+    read = {instr.payload for instr in code if instr is not None and instr.opcode == O.get_local}
+    for i, instr in enumerate(code):
+        if instr is None or instr.opcode not in (O.set_local, O.tee_local) or instr.payload in read:
+            continue
+        code[i] = opcodes.Op(O.drop, None) if instr.opcode == O.set_local else None
+
+
+# Removes redundant local traffic between neighbouring instructions:
+#   get_local x; set_local x    -> (nothing)
+#   set_local x; get_local x    -> tee_local x
+#   tee_local x; set_local x    -> set_local x
+#   tee_local x; drop           -> set_local x
+#   get_local x / <const>; drop -> (nothing)
+def simplify_locals(code):
+    run = []
+    for i, instr in enumerate(code):
+        if instr is None:
+            continue
+        op = instr.opcode
+        if op in CONTROL:
+            run.clear()
+            continue
+        prev = code[run[-1]] if run else None
+        if prev is None:
+            pass
+        elif op == O.drop and (prev.opcode == O.get_local or prev.opcode in CONSTS):
+            code[run.pop()] = code[i] = None
+            continue
+        elif op == O.drop and prev.opcode == O.tee_local:
+            code[run[-1]] = opcodes.Op(O.set_local, prev.payload)
+            code[i] = None
+            continue
+        elif op == O.set_local and prev.opcode == O.get_local and prev.payload == instr.payload:
+            code[run.pop()] = code[i] = None
+            continue
+        elif op == O.get_local and prev.opcode == O.set_local and prev.payload == instr.payload:
+            code[run[-1]] = opcodes.Op(O.tee_local, prev.payload)
+            code[i] = None
+            continue
+        elif op == O.set_local and prev.opcode == O.tee_local and prev.payload == instr.payload:
+            code[run.pop()] = None
+        run.append(i)
+
+
+# (name, lowest optimization level that runs it, pass), in the order they run
+PASSES = [
+    ("fold-constants", 1, fold_constants),
+    ("remove-unreachable", 1, remove_unreachable),
+    ("propagate-copies", 2, propagate_copies),
+    ("remove-dead-stores", 2, remove_dead_stores),
+    ("simplify-locals", 2, simplify_locals),
+]
+
+
+# Removes the deleted instructions from `code` (in place) and moves the
+# offsets of `body` and the blocks in it accordingly.
+def compact(code, body):
+    offsets = []
+    kept = 0
+    for instr in code:
+        offsets.append(kept)
+        if instr is not None:
+            kept += 1
+    offsets.append(kept)
+    blocks = [body] + [instr.payload for instr in code
+                       if instr is not None and instr.opcode in (O.block, O.loop, O.if_)]
+    for blk in blocks:
+        if blk.startOffs >= 0:
+            blk.startOffs = offsets[blk.startOffs]
+        if blk.elseOffs != -1:
+            blk.elseOffs = offsets[blk.elseOffs]
+        blk.endOffs = offsets[blk.endOffs]
+    code[:] = [instr for instr in code if instr is not None]
+
+
+# Runs the passes of `level` over `code` (whose root block is `body`) and
+# returns the instruction count before and after each pass that ran.
+def optimize(code, body, level=DEFAULT_LEVEL):
+    counts = [("input", len(code))]
+    if level <= 0:
+        return counts
+    for name, min_level, run in PASSES:
+        if level >= min_level:
+            run(code)
+            counts.append((name, sum(instr is not None for instr in code)))
+    compact(code, body)
+    return counts
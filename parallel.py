@@ -0,0 +1,65 @@
+import collections
+import concurrent.futures
+import itertools
+import os
+
+import parser
+from interpreter import Module
+
+# Many invocations of one export spread over a pool of worker processes
+# (threads would serialize on the GIL). Every worker instantiates the module
+# once and restores the instance's snapshot after each invocation, so a
+# result does not depend on which worker ran the row or what ran before.
+# Rows are sent in chunks, a bounded number of chunks ahead, and results
+# come back in input order.
+
+# the instance of the worker process and its state after initialization
+_instance = None
+_snapshot = None
+
+
+def _init_worker(path, engine):
+    global _instance, _snapshot
+    with open(path, "rb") as f:
+        module = Module(parser.Parser(f).parse())
+    _instance = module.instantiate(engine=engine)
+    _snapshot = _instance.snapshot()
+
+
+# a row that fails (traps, has the wrong number of arguments, runs an
+# unsupported instruction, ...) gets its exception as result
+def _run_chunk(name, rows):
+    results = []
+    for row in rows:
+        try:
+            results.append(_instance.run_exported_fn(name, row))
+        except Exception as e:
+            results.append(e)
+        finally:
+            _instance.restore(_snapshot)
+    return results
+
+
+# Yields the result of export `name` of the module at `path` for every row of
+# arguments (as accepted by run_exported_fn, e.g. strings), in order. A row
+# that fails yields its exception instead of a result: a Trap, or any other
+# error running it.
+def map_exported_fn(path, name, rows, workers=None, chunk_size=256, engine="stack"):
+    workers = workers or os.cpu_count() or 1
+    rows = iter(rows)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(path, engine)) as pool:
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_run_chunk, name, chunk))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -1,9 +1,12 @@
 #!/usr/bin/python3
+import concurrent.futures
 import os
 import math
+import mmap
 import struct
 
-from opcode import *
+from opcodes import *
+from tracing import TraceLevel, NO_TRACE
 
 
 class VersionError(Exception):
@@ -69,76 +72,156 @@ class ParseData:
         self.data_section = None
 
 
+_f32 = struct.Struct('<f')
+_f64 = struct.Struct('<d')
+
+# opcode byte -> Opcode (None for bytes that are no opcode)
+_OPCODES = [None] * 256
+for _op in Opcode:
+    _OPCODES[_op.value] = _op
+
+
+# opcodes whose only immediate is a varuint32 index
+_INDEX_OPS = frozenset(op.value for op in (Opcode.br, Opcode.br_if, Opcode.call, Opcode.get_local, Opcode.set_local,
+                                           Opcode.tee_local, Opcode.get_global, Opcode.set_global))
+
+
+# A function body that has not been decoded yet: where it is in the source.
+class LazyBody:
+    def __init__(self, parser, offset, size):
+        self.parser = parser
+        self.offset = offset
+        self.size = size
+
+    def __repr__(self):
+        return f"<LazyBody offset={self.offset} size={self.size}>"
+
+    # (locals, code) like an eagerly parsed body
+    def decode(self):
+        return self.parser.decode_body(self.offset, self.size)
+
+
+# Worker side of parallel code section decoding: decodes the bodies at the
+# (offset, size) ranges of `data`, a copy of part of the section.
+def _decode_bodies(data, ranges):
+    p = Parser(data)
+    return [p.decode_body(offset, size) for offset, size in ranges]
+
+
 class Parser:
     magic_num = 0x6d736100
     supported_version = 0x1
     endOpcode = 0x0b
 
-    resData = ParseData()
-
-    def __init__(self, in_file):
-        self.file = in_file
-        self.file_offset = 0
+    # `source` is the module as bytes, bytearray, memoryview or mmap, or a file
+    # opened in binary mode, which is read in one go. With use_mmap a file is
+    # mapped read-only instead. Data segments are memoryview slices of the
+    # source rather than copies.
+    # With lazy the code section only records where each body is (LazyBody).
+    # With workers > 1 function bodies are decoded in a process pool.
+    def __init__(self, source, tracer=NO_TRACE, use_mmap=False, lazy=False, workers=1):
+        pos = 0
+        if hasattr(source, "read"):
+            if use_mmap and os.fstat(source.fileno()).st_size > 0:
+                pos = source.tell()
+                source = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = source.read()
+        self.data = source
+        self.view = memoryview(source)
+        self.pos = pos
+        self.end = len(source)
+        self.lazy = lazy
+        self.workers = workers
+        self.resData = ParseData()
+        self.trace = tracer.channel(TraceLevel.info, "parse")
         self.initOpcodeFn()
 
     def get_current_offset(self):
-        return self.file_offset
+        return self.pos
 
     def get_read_len(self, old):
-        return self.get_current_offset() - old
+        return self.pos - old
 
     def fileIsEof(self):
-        file_len = os.fstat(self.file.fileno()).st_size
-        return self.file.tell() == file_len
+        return self.pos >= self.end
 
     def readBytes(self, l):
-        self.file_offset += l
-        return self.file.read(l)
+        pos = self.pos
+        if pos + l > self.end:
+            raise Exception(f"unexpected end of module at offset {pos}")
+        self.pos = pos + l
+        return bytes(self.data[pos:pos + l])
+
+    # like readBytes, but a view into the source instead of a copy
+    def readView(self, l):
+        pos = self.pos
+        if pos + l > self.end:
+            raise Exception(f"unexpected end of module at offset {pos}")
+        self.pos = pos + l
+        return self.view[pos:pos + l]
 
     def readUTF8(self, l):
         return self.readBytes(l).decode("utf-8")
 
     def readUInt(self, l):
+        if l == 1:
+            byte = self.data[self.pos]
+            self.pos += 1
+            return byte
         return int.from_bytes(self.readBytes(l), byteorder='little')
 
     def readF32(self):
-        return struct.unpack('<f', self.readBytes(4))[0]
+        val = _f32.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return val
 
     def readF64(self):
-        return struct.unpack('<d', self.readBytes(8))[0]
+        val = _f64.unpack_from(self.data, self.pos)[0]
+        self.pos += 8
+        return val
 
     def readVarUintLen(self, l):
-        res = 0
-        shift = 0
-        len = 0
-        while True:
-            len += 1
-            byte = self.readUInt(1)
-            res |= (0x7f & byte) << shift
-            if (byte & 0x80) == 0:
-                break
+        data = self.data
+        start = pos = self.pos
+        byte = data[pos]
+        pos += 1
+        res = byte & 0x7f
+        shift = 7
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            res |= (byte & 0x7f) << shift
             shift += 7
-        assert len <= math.ceil(l / 7)
-        return res, len
+        self.pos = pos
+        assert pos - start <= math.ceil(l / 7)
+        return res, pos - start
 
     def readVarUint(self, l):
+        data = self.data
+        pos = self.pos
+        byte = data[pos]
+        if byte < 0x80:  # single byte, by far the most common case
+            self.pos = pos + 1
+            return byte
         return self.readVarUintLen(l)[0]
 
     def readVarIntLen(self, l):
+        data = self.data
+        start = pos = self.pos
         res = 0
         shift = 0
-        len = 0
         while True:
-            len += 1
-            byte = self.readUInt(1)
+            byte = data[pos]
+            pos += 1
             res |= (0x7f & byte) << shift
             shift += 7
             if (byte & 0x80) == 0:
                 break
         if shift < l and (byte & 0x40) != 0:
             res |= (~0 << shift)
-        assert math.ceil(l / 7) <= l
-        return res, len
+        self.pos = pos
+        return res, pos - start
 
     def readVarInt(self, l):
         return self.readVarIntLen(l)[0]
@@ -201,18 +284,15 @@ class Parser:
     # section parsing
 
     def parse_preamble(self):
-        print("Parsing WASM header ...", end="")
         magic = self.readUInt(4)
         if magic != Parser.magic_num:
-            print("%02x != %02x" % (magic, Parser.magic_num))
-            raise Exception("not a wasm file!")
+            raise Exception("not a wasm file! (magic %02x != %02x)" % (magic, Parser.magic_num))
         version = self.readUInt(4)
         if version != Parser.supported_version:
             raise VersionError("only version 1 is supported currently")
-        print(" OK")
+        self.trace("WASM header OK")
 
     def parse_section(self):
-        print(" ## Parsing section ...", end="")
         sec_id = self.readVarUint(7)
         payload_len = self.readVarUint(32)
         name_len_size = 0
@@ -221,9 +301,9 @@ class Parser:
         if sec_id == 0:
             name_len, name_len_size = self.readVarUintLen(32)
             name = self.readUTF8(name_len)
-            print("[name = '%s']" % name)
+            self.trace(" ## Parsing section name =", name)
         else:
-            print("[id = %d]" % sec_id)
+            self.trace(" ## Parsing section id =", sec_id)
         payload_data_len = payload_len - name_len - name_len_size
         if sec_id == 0x0:
             if name == "name":
@@ -267,11 +347,11 @@ class Parser:
                 payload_data_len)
         else:
             raise Exception("Unknown Section ID" + str(sec_id))
-        print(" ++ Done parsing section")
+        self.trace(" ++ Done parsing section")
 
     def parse_name_custom_section(self, payload_len):
-        print("  # Parsing name custom section")
-        print(payload_len)
+        self.trace("  # Parsing name custom section")
+        self.trace(payload_len)
         init_offset = self.get_current_offset()
         name_module_section = None
         name_function_section = None
@@ -308,20 +388,19 @@ class Parser:
         assert self.get_read_len(init_offset) == payload_len
         result = (name_module_section, name_function_section,
                   name_local_section, name_subsections)
-        print(result)
-        print("  + Parsing name custom section done")
+        self.trace(result)
+        self.trace("  + Parsing name custom section done")
         return result
 
     def parse_custom_section(self, name, payload_len):
-        print("  # Parsing custom section")
+        self.trace("  # Parsing custom section")
         payload = self.readBytes(payload_len)
-        print("Custom Section Data [len={:d}] = {}...".format(
-            payload_len, payload[:32]))
-        print("  + Parsing custom section done")
+        self.trace("Custom Section Data len =", payload_len, payload[:32])
+        self.trace("  + Parsing custom section done")
         return name, payload
 
     def parse_import_section(self, payload_len):
-        print("  # Parsing import section")
+        self.trace("  # Parsing import section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -344,12 +423,12 @@ class Parser:
             import_entry = (module_str, field_str, kind, type)
             entries.append(import_entry)
         assert self.get_read_len(init_offset) == payload_len
-        print(entries)
-        print("  + Parsing import section done")
+        self.trace(entries)
+        self.trace("  + Parsing import section done")
         return entries
 
     def parse_type_section(self, payload_len):
-        print("  # Parsing type section")
+        self.trace("  # Parsing type section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         types = []
@@ -357,8 +436,8 @@ class Parser:
             fnType = self.read_fn_type()
             types.append(fnType)
         assert self.get_read_len(init_offset) == payload_len
-        print(types)
-        print("  + Parsing type section done")
+        self.trace(types)
+        self.trace("  + Parsing type section done")
         return types
 
     def parse_value_type(self):
@@ -367,7 +446,7 @@ class Parser:
         return param_type
 
     def parse_function_section(self, payload_len):
-        print("  # Parsing function section")
+        self.trace("  # Parsing function section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         types = []
@@ -375,12 +454,12 @@ class Parser:
             type = self.readVarUint(32)
             types.append(type)
         assert self.get_read_len(init_offset) == payload_len
-        print(types)
-        print("  + Parsing function section done")
+        self.trace(types)
+        self.trace("  + Parsing function section done")
         return types
 
     def parse_table_section(self, payload_len):
-        print("  # Parsing table section")
+        self.trace("  # Parsing table section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -388,12 +467,12 @@ class Parser:
             entry = self.read_table_type()
             entries.append(entry)
         assert self.get_read_len(init_offset) == payload_len
-        print(entries)
-        print("  + Parsing table section done")
+        self.trace(entries)
+        self.trace("  + Parsing table section done")
         return entries
 
     def parse_memory_section(self, payload_len):
-        print("  # Parsing memory section")
+        self.trace("  # Parsing memory section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -401,12 +480,12 @@ class Parser:
             memtype = self.read_memory_type()
             entries.append(memtype)
         assert self.get_read_len(init_offset) == payload_len
-        print(entries)
-        print("  + Parsing memory section done")
+        self.trace(entries)
+        self.trace("  + Parsing memory section done")
         return entries
 
     def parse_global_section(self, payload_len):
-        print("  # Parsing global section")
+        self.trace("  # Parsing global section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         globals = []
@@ -414,8 +493,8 @@ class Parser:
             global_var = self.parse_global_variable()
             globals.append(global_var)
         assert self.get_read_len(init_offset) == payload_len
-        print(globals)
-        print("  + Parsing global section done")
+        self.trace(globals)
+        self.trace("  + Parsing global section done")
         return globals
 
     def parse_global_variable(self):
@@ -534,22 +613,75 @@ class Parser:
         self.opFn.set(Opcode.f32_const, (self.readF32,))
         self.opFn.set(Opcode.f64_const, (self.readF64,))
 
+        # payload parser per opcode byte, for read_opcode
+        self.payloadFns = [entry[0] if entry is not None else None for entry in self.opFn.fn_array]
+        self.payloadFns.extend([None] * (256 - len(self.payloadFns)))
+        # instructions without immediates are immutable and shared
+        self.simpleOps = [Op(op, None) if op is not None and self.payloadFns[byte] is None else None
+                          for byte, op in enumerate(_OPCODES)]
+
     def read_opcode(self):
-        byte = self.readUInt(1)
-        op = Opcode(byte)
-        payloadFn = self.opFn.get_parser(op)
+        byte = self.data[self.pos]
+        self.pos += 1
+        op = _OPCODES[byte]
+        if op is None:
+            op = Opcode(byte)  # raises for an unknown opcode
+        payloadFn = self.payloadFns[byte]
         if payloadFn is None:
             return Op(op, None)
         else:
             return Op(op, payloadFn())
 
+    # Decodes `codelen` bytes of instructions. This is where parsing spends its
+    # time, so the common encodings are decoded inline on a local cursor.
+    def read_code(self, codelen):
+        data = self.data
+        pos = self.pos
+        end = pos + codelen
+        simple = self.simpleOps
+        payloadFns = self.payloadFns
+        opcodes = []
+        append = opcodes.append
+        while pos < end:
+            byte = data[pos]
+            pos += 1
+            instr = simple[byte]
+            if instr is not None:
+                append(instr)
+                continue
+            op = _OPCODES[byte]
+            if op is None:
+                op = Opcode(byte)  # raises for an unknown opcode
+            if byte in _INDEX_OPS and data[pos] < 0x80:
+                append(Op(op, data[pos]))
+                pos += 1
+            elif byte == 0x41 or byte == 0x42:  # i32.const, i64.const: signed LEB128
+                val = 0
+                shift = 0
+                while True:
+                    b = data[pos]
+                    pos += 1
+                    val |= (b & 0x7f) << shift
+                    shift += 7
+                    if b < 0x80:
+                        break
+                if b & 0x40 and shift < (32 if byte == 0x41 else 64):
+                    val |= ~0 << shift
+                append(Op(op, val))
+            else:
+                self.pos = pos
+                append(Op(op, payloadFns[byte]()))
+                pos = self.pos
+        self.pos = pos
+        return opcodes
+
     def read_global_type(self):
         content_type = self.parse_value_type()
         mutability = self.readVarUint(1)
         return content_type, mutability
 
     def parse_export_section(self, payload_len):
-        print("  # Parsing export section")
+        self.trace("  # Parsing export section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -560,20 +692,20 @@ class Parser:
             index = self.readVarUint(32)
             entries.append((field_str, kind, index))
         assert self.get_read_len(init_offset) == payload_len
-        print(entries)
-        print("  + Parsing export section done")
+        self.trace(entries)
+        self.trace("  + Parsing export section done")
         return entries
 
     def parse_start_section(self, payload_len):
-        print("  # Parsing start section")
+        self.trace("  # Parsing start section")
         index, len = self.readVarUintLen(32)
         assert len == payload_len
-        print(index)
-        print("  + Parsing start section done")
+        self.trace(index)
+        self.trace("  + Parsing start section done")
         return index
 
     def parse_element_section(self, payload_len):
-        print("  # Parsing element section")
+        self.trace("  # Parsing element section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -588,45 +720,97 @@ class Parser:
             entry = (index, offset, num_elem, elems)
             entries.append(entry)
         assert self.get_read_len(init_offset) == payload_len
-        print(entries)
-        print("  + Parsing element section done")
+        self.trace(entries)
+        self.trace("  + Parsing element section done")
         return entries
 
     def parse_code_section(self, payload_len):
-        print("  # Parsing code section")
+        self.trace("  # Parsing code section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
+        if self.workers > 1 and not self.lazy and count >= self.workers:
+            bodies = self.decode_parallel(count)
+            assert self.get_read_len(init_offset) == payload_len
+            self.trace("  + Parsing code section done")
+            return bodies
         bodies = []
         for i in range(count):
             body_size = self.readVarUint(32)
-            body_head_offset = self.get_current_offset()
-            local_count = self.readVarUint(32)
-            locals = []
-            for j in range(local_count):
-                var_count = self.readVarUint(32)
-                var_type = self.parse_value_type()
-                local_entry = (var_count, var_type)
-                locals.append(local_entry)
-            body_head_size = self.get_read_len(body_head_offset)
-            codelen = body_size - body_head_size - 1
-            opcodes = []
-            code_offset = self.get_current_offset()
-            while self.get_read_len(code_offset) < codelen:
-                opcode = self.read_opcode()
-                opcodes.append(opcode)
-            end = self.readUInt(1)
-            assert end == Parser.endOpcode
-            body = (locals, opcodes)
-            print((locals, opcodes[:2], "etc."))
+            if self.lazy:
+                bodies.append(LazyBody(self, self.pos, body_size))
+                self.readView(body_size)  # checks that the body is there
+                continue
+            body = self.read_body(body_size)
+            self.trace((body[0], body[1][:2], "etc."))
             bodies.append(body)
         assert self.get_read_len(init_offset) == payload_len
-        print("  + Parsing code section done")
+        self.trace("  + Parsing code section done")
         return bodies
 
+    def read_body(self, body_size):
+        body_head_offset = self.get_current_offset()
+        local_count = self.readVarUint(32)
+        locals = []
+        for j in range(local_count):
+            var_count = self.readVarUint(32)
+            var_type = self.parse_value_type()
+            local_entry = (var_count, var_type)
+            locals.append(local_entry)
+        body_head_size = self.get_read_len(body_head_offset)
+        codelen = body_size - body_head_size - 1
+        opcodes = self.read_code(codelen)
+        end = self.readUInt(1)
+        assert end == Parser.endOpcode
+        return locals, opcodes
+
+    # Decodes `count` bodies in a process pool. The bodies are split into
+    # contiguous ranges of about equal size, a few per worker to even out the
+    # load; each worker gets a copy of its range and results are merged in order.
+    def decode_parallel(self, count):
+        ranges = []
+        for i in range(count):
+            body_size = self.readVarUint(32)
+            ranges.append((self.pos, body_size))
+            self.pos += body_size
+        start = ranges[0][0]
+        chunk_size = (self.pos - start) // (self.workers * 4) + 1
+        chunks = []
+        i = 0
+        while i < count:
+            first = ranges[i][0]
+            j = i + 1
+            while j < count and ranges[j][0] + ranges[j][1] - first <= chunk_size:
+                j += 1
+            end = ranges[j - 1][0] + ranges[j - 1][1]
+            chunks.append((bytes(self.data[first:end]), [(offset - first, size) for offset, size in ranges[i:j]]))
+            i = j
+        self.trace("  decoding", count, "bodies in", len(chunks), "chunks on", self.workers, "workers")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(_decode_bodies, *zip(*chunks))
+            return [body for bodies in results for body in bodies]
+
+    # decodes a body recorded by a lazy parse
+    def decode_body(self, offset, size):
+        saved = self.pos
+        self.pos = offset
+        try:
+            body = self.read_body(size)
+        except (IndexError, struct.error):
+            raise self.truncated() from None
+        assert self.pos == offset + size
+        self.pos = saved
+        return body
+
+    # The fast paths for single bytes, LEB128 numbers and floats read the
+    # source without checking its end; reading past it raises IndexError or
+    # struct.error, which parse and decode_body turn into this error.
+    def truncated(self):
+        return Exception(f"unexpected end of module at offset {self.end}")
+
     def parse_data_section(self, payload_len):
         # custom name section needs to be parsed after the data section!
         assert self.resData.name_section is None
-        print("  # Parsing data section")
+        self.trace("  # Parsing data section")
         init_offset = self.get_current_offset()
         count = self.readVarUint(32)
         entries = []
@@ -634,18 +818,21 @@ class Parser:
             index = self.readVarUint(32)
             offset = self.read_init_expr()
             size = self.readVarUint(32)
-            data = self.readBytes(size)
+            data = self.readView(size)
             entry = (index, offset, size, data)
-            print("Data entry [len = {:d}] = {}...".format(size, data[:16]))
+            self.trace("Data entry len =", size, bytes(data[:16]))
             entries.append(entry)
         assert self.get_read_len(init_offset) == payload_len
-        print("  + Parsing data section done")
+        self.trace("  + Parsing data section done")
         return entries
 
     def parse(self):
-        print("### Start Parsing WASM")
-        self.parse_preamble()
-        while not self.fileIsEof():
-            self.parse_section()
-        print("+++ Done Parsing WASM")
+        self.trace("### Start Parsing WASM")
+        try:
+            self.parse_preamble()
+            while not self.fileIsEof():
+                self.parse_section()
+        except (IndexError, struct.error):
+            raise self.truncated() from None
+        self.trace("+++ Done Parsing WASM")
         return self.resData
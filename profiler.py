@@ -0,0 +1,180 @@
+import collections
+import json
+import marshal
+import time
+
+# Opt-in profile of the stack engine's instruction loop (see
+# Interpreter.profile_ops): how often every opcode and every pair of
+# consecutively executed opcodes ran, and the wall time spent in every
+# opcode's handler. Timing a handler costs about as much as a cheap handler
+# itself; that part (measured once, see clock_overhead) is subtracted in the
+# reports. Handlers that run other code, like calls on the tiered engine,
+# include its time. Superinstructions (fusion.py) count as opcodes of their
+# own; profile with fuse=False to see the instructions they replace.
+
+
+# the smallest time measured around nothing
+def clock_overhead(samples=1000):
+    clock = time.perf_counter
+    best = None
+    for _ in range(samples):
+        start = clock()
+        elapsed = clock() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+
+def op_name(opcode):
+    return "(start)" if opcode is None else opcode.name
+
+
+class OpProfile:
+    def __init__(self):
+        self.counts = collections.defaultdict(int) # opcode -> executions
+        self.pairs = collections.defaultdict(int) # (opcode, next opcode) -> executions
+        self.times = collections.defaultdict(float) # opcode -> seconds in its handler
+        self.last = None # the opcode executed last, first of the next pair
+        self.clock_overhead = clock_overhead()
+
+    def total(self):
+        return sum(self.counts.values())
+
+    # handler time of `opcode` without the cost of timing it
+    def handler_time(self, opcode):
+        return max(0.0, self.times[opcode] - self.counts[opcode] * self.clock_overhead)
+
+    def to_dict(self):
+        total = self.total() or 1
+        opcodes = sorted(self.counts, key=self.handler_time, reverse=True)
+        return {
+            "instructions": self.total(),
+            "clock_overhead_ns": self.clock_overhead * 1e9,
+            "opcodes": [{"opcode": op_name(op), "count": self.counts[op], "share": self.counts[op] / total,
+                         "time_s": self.handler_time(op),
+                         "ns_per_exec": self.handler_time(op) / self.counts[op] * 1e9} for op in opcodes],
+            "pairs": [{"first": op_name(first), "second": op_name(second), "count": count}
+                      for (first, second), count in sorted(self.pairs.items(), key=lambda item: -item[1])],
+        }
+
+    def write_json(self, stream):
+        json.dump(self.to_dict(), stream, indent=1)
+        stream.write("\n")
+
+    # opcodes by handler time and the `top` most frequent pairs
+    def text(self, top=20):
+        report = self.to_dict()
+        time_total = sum(entry["time_s"] for entry in report["opcodes"]) or 1
+        lines = [f"{report['instructions']} instructions, "
+                 f"timing overhead {report['clock_overhead_ns']:.0f} ns per instruction (subtracted)",
+                 f"{'opcode':28} {'count':>10} {'count %':>7} {'time ms':>9} {'time %':>6} {'ns/exec':>8}"]
+        for entry in report["opcodes"]:
+            lines.append(f"{entry['opcode']:28} {entry['count']:10} {entry['share']:7.1%} "
+                         f"{entry['time_s'] * 1000:9.2f} {entry['time_s'] / time_total:6.1%} "
+                         f"{entry['ns_per_exec']:8.0f}")
+        lines.append("")
+        lines.append(f"{'opcode pair':50} {'count':>10} {'count %':>7}")
+        for entry in report["pairs"][:top]:
+            pair = f"{entry['first']} -> {entry['second']}"
+            lines.append(f"{pair:50} {entry['count']:10} {entry['count'] / (report['instructions'] or 1):7.1%}")
+        return "\n".join(lines)
+
+
+# Deterministic profile of the calls of guest functions on the stack engine
+# (see Interpreter.profile_calls): every entry and exit of a function is
+# recorded, with calls to imported functions as leaves. Per function it
+# keeps the number of calls, the exclusive time (in the function itself)
+# and the inclusive time (with its callees; for recursive functions over
+# the outermost calls only, as in cProfile), per caller and callee the same,
+# and the exclusive time of every distinct call stack.
+class CallProfile:
+    def __init__(self, names, filename="wasm"):
+        self.names = names # function id -> name
+        self.filename = filename # module label in pstats keys
+        self.calls = collections.defaultdict(int)
+        self.primitive_calls = collections.defaultdict(int) # calls not within another call of the function
+        self.exclusive = collections.defaultdict(float)
+        self.inclusive = collections.defaultdict(float)
+        # (caller id, callee id) -> [calls, primitive calls, exclusive, inclusive]
+        self.edges = collections.defaultdict(lambda: [0, 0, 0.0, 0.0])
+        # call tree: [exclusive time, {callee id: node}]
+        self.root = [0.0, {}]
+        self.active = [] # [id, node, start, time in callees] per running call
+        self.running = collections.defaultdict(int) # running calls per function
+        self.stats = {}
+
+    def enter(self, id):
+        parent = self.active[-1][1] if self.active else self.root
+        node = parent[1].get(id)
+        if node is None:
+            node = parent[1][id] = [0.0, {}]
+        self.running[id] += 1
+        self.active.append([id, node, time.perf_counter(), 0.0])
+
+    def leave(self):
+        now = time.perf_counter()
+        id, node, start, callees = self.active.pop()
+        inclusive = now - start
+        exclusive = inclusive - callees
+        node[0] += exclusive
+        self.running[id] -= 1
+        outermost = self.running[id] == 0
+        self.calls[id] += 1
+        self.exclusive[id] += exclusive
+        edge = self.edges[self.active[-1][0] if self.active else None, id]
+        edge[0] += 1
+        edge[2] += exclusive
+        if outermost:
+            self.primitive_calls[id] += 1
+            self.inclusive[id] += inclusive
+            edge[1] += 1
+            edge[3] += inclusive
+        if self.active:
+            self.active[-1][3] += inclusive
+
+    # ends the `count` innermost calls, e.g. when a trap unwinds them
+    def unwind(self, count):
+        for _ in range(count):
+            self.leave()
+
+    def name(self, id):
+        return self.names[id] if id < len(self.names) else f"function {id}"
+
+    # One line per call stack: the function names from the outermost call
+    # on, separated by ';', and the exclusive time in microseconds. This is
+    # the input of flamegraph.pl and compatible tools.
+    def collapsed(self):
+        lines = []
+        path = []
+        pending = [(0, id, child) for id, child in self.root[1].items()]
+        while pending:
+            depth, id, node = pending.pop()
+            del path[depth:]
+            path.append(self.name(id).replace(";", ":"))
+            micros = round(node[0] * 1e6)
+            if micros > 0:
+                lines.append(f"{';'.join(path)} {micros}")
+            pending.extend((depth + 1, callee, child) for callee, child in node[1].items())
+        lines.sort()
+        return "\n".join(lines)
+
+    def write_collapsed(self, stream):
+        stream.write(self.collapsed())
+        stream.write("\n")
+
+    def key(self, id):
+        return self.filename, id, self.name(id)
+
+    # The profile in the form of cProfile: pstats.Stats(profile) reads it,
+    # and files written by dump_stats are read by pstats and its viewers.
+    def create_stats(self):
+        self.stats = {}
+        for id, calls in self.calls.items():
+            self.stats[self.key(id)] = (self.primitive_calls[id], calls, self.exclusive[id], self.inclusive[id], {})
+        for (caller, id), (calls, primitive_calls, exclusive, inclusive) in self.edges.items():
+            if caller is not None:
+                self.stats[self.key(id)][4][self.key(caller)] = (calls, primitive_calls, exclusive, inclusive)
+
+    def dump_stats(self, path):
+        self.create_stats()
+        with open(path, "wb") as f:
+            marshal.dump(self.stats, f)
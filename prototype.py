@@ -1,23 +1,163 @@
 #!/usr/bin/python3
+import argparse
+import os
+import pstats
 import sys
 
+import cache
+import optimizer
+import parallel
 import parser
-from interpreter import Interpreter
-from operations import StackValue
+from interpreter import Interpreter, Module
+from operations import Trap
+from validation import ValidationError
+from tracing import TraceLevel, Tracer, RingBufferSink, StderrSink
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Run an exported function of a WebAssembly module")
+    ap.add_argument("file")
+    ap.add_argument("function", nargs="?")
+    ap.add_argument("args", nargs="*")
+    ap.add_argument("--engine", default="stack", choices=Interpreter.ENGINES,
+                    help="execution engine (default: stack)")
+    ap.add_argument("--trace", nargs="?", const="instr", default="off",
+                    choices=[l.name for l in TraceLevel],
+                    help="trace level (default: off, bare flag: instr)")
+    ap.add_argument("--trace-ring", type=int, metavar="N",
+                    help="keep only the last N trace records and dump them at exit")
+    ap.add_argument("--mmap", action="store_true",
+                    help="parse through a memory mapping of the file (data segments are not copied)")
+    ap.add_argument("--lazy", action="store_true",
+                    help="decode function bodies on first call instead of at load time")
+    ap.add_argument("--workers", type=int, default=1, metavar="N",
+                    help="decode function bodies in N processes (default: 1)")
+    ap.add_argument("--cache-dir", metavar="DIR",
+                    help="keep prepared modules in DIR and load them from there when unchanged")
+    ap.add_argument("--validate", action="store_true",
+                    help="validate the module first (and run without consistency checks)")
+    ap.add_argument("-O", "--opt-level", type=int, default=optimizer.DEFAULT_LEVEL, choices=range(3),
+                    help="0: run the code as is, 1: fold constants and remove unreachable code, "
+                    f"2: also remove redundant local traffic (default: {optimizer.DEFAULT_LEVEL})")
+    ap.add_argument("--opt-report", action="store_true",
+                    help="print the instruction count of every function before and after each optimizer pass")
+    ap.add_argument("--no-fuse", action="store_true",
+                    help="run the stack engine without superinstructions")
+    ap.add_argument("--dump-source", action="store_true",
+                    help="print the Python source generated by the python engine")
+    ap.add_argument("--hot-calls", type=int, default=100, metavar="N",
+                    help="tiered engine: compile a function after N interpreted calls (default: 100)")
+    ap.add_argument("--hot-loops", type=int, default=1000, metavar="N",
+                    help="tiered engine: compile a function after N loop back-edges (default: 1000)")
+    ap.add_argument("--fuel", type=int, metavar="N",
+                    help="trap once the call has executed about N instructions, and print the fuel left")
+    ap.add_argument("--profile-ops", action="store_true",
+                    help="print how often each opcode and opcode pair ran and the time in each opcode's handler "
+                    "(stack and tiered engines; combine with --no-fuse to count unfused instructions)")
+    ap.add_argument("--profile-json", metavar="FILE",
+                    help="write the opcode profile as JSON to FILE ('-' for stdout)")
+    ap.add_argument("--profile-calls", action="store_true",
+                    help="print the calls and the exclusive and inclusive time of every guest function (stack engine)")
+    ap.add_argument("--profile-collapsed", metavar="FILE",
+                    help="write the time per call stack in collapsed-stack format (for flame graphs) to FILE")
+    ap.add_argument("--profile-pstats", metavar="FILE",
+                    help="write the call profile to FILE in the format of cProfile, for pstats and its viewers")
+    ap.add_argument("--tier-report", action="store_true",
+                    help="print the tier every function ended up in")
+    return ap.parse_args()
+
+
+def parse_map_args(argv):
+    ap = argparse.ArgumentParser(prog="prototype.py map",
+                                 description="Run an exported function once per row of arguments in ROWS, "
+                                             "spread over worker processes")
+    ap.add_argument("file")
+    ap.add_argument("function")
+    ap.add_argument("rows", help="file with one whitespace separated row of arguments per line ('-' for stdin)")
+    ap.add_argument("--engine", default="stack", choices=Interpreter.ENGINES,
+                    help="execution engine (default: stack)")
+    ap.add_argument("--workers", type=int, metavar="N",
+                    help="number of worker processes (default: one per core)")
+    ap.add_argument("--chunk-size", type=int, default=256, metavar="N",
+                    help="rows sent to a worker at a time (default: 256)")
+    return ap.parse_args(argv)
+
+
+# prints one result (or trap or error) per row, in the order of the rows
+def main_map(argv):
+    opts = parse_map_args(argv)
+    rows_file = sys.stdin if opts.rows == "-" else open(opts.rows)
+    with rows_file:
+        rows = (line.split() for line in rows_file if line.strip())
+        for result in parallel.map_exported_fn(opts.file, opts.function, rows, opts.workers,
+                                               opts.chunk_size, opts.engine):
+            if isinstance(result, Trap):
+                print(f"trap: {result}")
+            elif isinstance(result, Exception):
+                print(f"error: {type(result).__name__}: {result}")
+            else:
+                print(result)
 
 
 def main():
-    filename = sys.argv[1]
+    if sys.argv[1:2] == ["map"]:
+        return main_map(sys.argv[2:])
+    opts = parse_args()
+    level = TraceLevel[opts.trace]
+    sink = RingBufferSink(opts.trace_ring) if opts.trace_ring else StderrSink()
+    tracer = Tracer(level, sink)
+    filename = opts.file
     print(f"Parsing '{filename}'")
-    with open(filename, "rb") as f:
-        p = parser.Parser(f)
-        res = p.parse()
-    interpr = Interpreter(res)
-    interpr.initialize()
-    if len(sys.argv) > 2:
-        fn_name = sys.argv[2]
-        args = sys.argv[3:]
-        interpr.run_exported_fn(fn_name, args)
-
-
-main()
+    try:
+        if opts.cache_dir:
+            res = cache.load_module(filename, opts.cache_dir, tracer, opts.opt_level, workers=opts.workers)
+        else:
+            with open(filename, "rb") as f:
+                p = parser.Parser(f, tracer, opts.mmap, opts.lazy, opts.workers)
+                res = p.parse()
+        module = Module(res, opts.validate, opts.opt_level)
+        interpr = Interpreter(module, tracer, opts.engine, opts.hot_calls, opts.hot_loops, fuse=not opts.no_fuse)
+        interpr.initialize()
+        profile = interpr.profile_ops() if opts.profile_ops or opts.profile_json else None
+        call_profile = None
+        if opts.profile_calls or opts.profile_collapsed or opts.profile_pstats:
+            call_profile = interpr.profile_calls(filename=os.path.basename(filename))
+        if opts.opt_report:
+            print(module.opt_report())
+        if opts.dump_source:
+            print(interpr.generated_source())
+        if opts.function is not None:
+            try:
+                result = interpr.run_exported_fn(opts.function, opts.args, opts.fuel)
+            finally:
+                if opts.fuel is not None:
+                    print(f"Fuel left: {interpr.fuel}")
+            print(f"#### Result = {result} ####")
+        if opts.tier_report:
+            print(interpr.tier_report())
+        if opts.profile_ops:
+            print(profile.text())
+        if opts.profile_json == "-":
+            profile.write_json(sys.stdout)
+        elif opts.profile_json:
+            with open(opts.profile_json, "w") as f:
+                profile.write_json(f)
+        if opts.profile_calls:
+            pstats.Stats(call_profile).sort_stats("tottime").print_stats(20)
+        if opts.profile_collapsed:
+            with open(opts.profile_collapsed, "w") as f:
+                call_profile.write_collapsed(f)
+        if opts.profile_pstats:
+            call_profile.dump_stats(opts.profile_pstats)
+    except ValidationError as e:
+        # raised by Module, by the cache (which always validates) and, with
+        # --lazy, when a function is first called
+        sys.exit(f"Invalid module: {e}")
+    finally:
+        if isinstance(sink, RingBufferSink):
+            sink.dump(sys.stderr)
+
+
+# worker processes may import this module (spawn start method)
+if __name__ == "__main__":
+    main()
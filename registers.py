@@ -0,0 +1,357 @@
+from opcodes import Opcode as O
+from operations import *
+import analysis
+import memory
+
+# Register engine: every function is translated at load time from the stack
+# form into a register IR addressing frame slots directly.
+#
+# Frame layout: [params + locals | operand stack slots | constants]
+# The operand stack value at height h lives in slot nlocals + h. During
+# translation the operand stack is tracked symbolically, so get_local and
+# constants only push the slot they already live in and emit nothing; a
+# value is copied to its canonical stack slot only when a local it aliases
+# is overwritten or control flow merges.
+#
+# Instructions are tuples (kind, dst, a, b, f).
+
+BIN = 0      # r[dst] = f(r[a], r[b])
+JNZ = 1      # if r[a]: pc = dst
+JZ = 2       # if not r[a]: pc = dst
+MOV = 3      # r[dst] = r[a]
+UN = 4       # r[dst] = f(r[a])
+JMP = 5      # pc = dst
+CALL = 6     # r[dst] = f(*[r[s] for s in a])   (dst None: no result)
+RET = 7      # return r[a]  (a None: no result)
+SELECT = 8   # r[dst] = r[a] if r[f] else r[b]
+TRAP = 9     # raise Trap(a)
+TODO = 10    # unsupported instruction
+STORE = 11   # f(r[a], r[b])
+JTAB = 12    # pc = dst[r[a]] if r[a] < len(dst) else b
+
+KIND_NAMES = ("bin", "jnz", "jz", "mov", "un", "jmp", "call", "ret", "select", "trap", "todo", "store", "jtab")
+
+
+def execute(fn, params):
+    r = list(params)
+    r.extend(fn.reg_template)
+    code = fn.reg_code
+    pc = 0
+    while True:
+        k, d, a, b, f = code[pc]
+        pc += 1
+        if k == BIN:
+            r[d] = f(r[a], r[b])
+        elif k == JNZ:
+            if r[a]:
+                pc = d
+        elif k == MOV:
+            r[d] = r[a]
+        elif k == JZ:
+            if not r[a]:
+                pc = d
+        elif k == UN:
+            r[d] = f(r[a])
+        elif k == JMP:
+            pc = d
+        elif k == CALL:
+            res = f([r[s] for s in a])
+            if d is not None:
+                r[d] = res
+        elif k == RET:
+            return None if a is None else r[a]
+        elif k == SELECT:
+            r[d] = r[a] if r[f] else r[b]
+        elif k == STORE:
+            f(r[a], r[b])
+        elif k == TRAP:
+            raise Trap(a)
+        elif k == JTAB:
+            index = r[a]
+            pc = d[index] if index < len(d) else b
+        else:
+            raise Exception("TODO implement")
+
+
+class _Label:
+    def __init__(self):
+        self.pos = None
+        self.users = []
+
+
+class _Translator:
+    def __init__(self, interp, fn):
+        self.interp = interp
+        self.fn = fn
+        self.nlocals = len(fn.params_types()) + len(fn.local_defaults)
+        self.code = []
+        self.vstack = []        # slot holding each operand stack value
+        self.consts = {}        # (type, repr) of a constant -> constant index
+        self.const_values = []
+        self.max_height = 0
+        self.labelled = True    # a label is bound at the current position
+        self.labels = []
+        self.else_labels = {}   # id(if block) -> label of its else arm
+        self.tables = []        # (instruction index, labels of the targets, default label) of JTABs
+
+    def emit(self, kind, dst=None, a=None, b=None, f=None):
+        self.code.append([kind, dst, a, b, f])
+        self.labelled = False
+
+    def new_label(self):
+        label = _Label()
+        self.labels.append(label)
+        return label
+
+    def jump(self, kind, label, a=None):
+        self.emit(kind, None, a)
+        label.users.append(len(self.code) - 1)
+
+    def bind(self, label):
+        label.pos = len(self.code)
+        self.labelled = True
+
+    def slot(self, height):
+        self.max_height = max(self.max_height, height + 1)
+        return self.nlocals + height
+
+    def const(self, value):
+        # keyed on type and repr so that 0, 0.0 and -0.0 stay distinct
+        key = (type(value), repr(value))
+        if key not in self.consts:
+            self.consts[key] = len(self.const_values)
+            self.const_values.append(value)
+        return ~self.consts[key]  # resolved to real slots once the frame size is known
+
+    def push_result(self):
+        dst = self.slot(len(self.vstack))
+        self.vstack.append(dst)
+        return dst
+
+    def materialize(self, height):
+        canonical = self.slot(height)
+        src = self.vstack[height]
+        if src != canonical:
+            self.emit(MOV, canonical, src)
+            self.vstack[height] = canonical
+
+    def materialize_all(self):
+        for h in range(len(self.vstack)):
+            self.materialize(h)
+
+    def unalias(self, local, keep_top=False):
+        end = len(self.vstack) - (1 if keep_top else 0)
+        for h in range(end):
+            if self.vstack[h] == local:
+                self.materialize(h)
+
+    def retarget_last(self, local):
+        # redirect the instruction that produced the stack top into `local`
+        if self.labelled or not self.code:
+            return False
+        last = self.code[-1]
+        top = self.vstack[-1]
+        if last[0] not in (BIN, UN, SELECT, CALL) or last[1] != top or top != self.slot(len(self.vstack) - 1):
+            return False
+        if local in self.vstack[:-1]:
+            return False
+        last[1] = local
+        return True
+
+    def branch(self, blk, labels):
+        # move the branch value (if any) into place and jump to the target
+        arity = blk.branch_arity()
+        if blk.parent is None:
+            self.emit(RET, None, self.vstack[-1] if arity else None)
+            return
+        if arity:
+            dst = self.slot(blk.height)
+            if self.vstack[-1] != dst:
+                self.emit(MOV, dst, self.vstack[-1])
+        self.jump(JMP, labels[id(blk)])
+
+    def translate(self):
+        fn = self.fn
+        code = fn.code
+        heights = analysis.stack_heights(fn, self.interp.fn_signature, self.interp.type_signature)
+        labels = {}  # id(block) -> branch target label
+        else_labels = self.else_labels
+        for i, instr in enumerate(code):
+            op = instr.opcode
+            p = instr.payload
+            if heights[i] is None:
+                # unreachable: only keep the block structure in sync
+                if op == O.end and p.parent is not None and p.height is not None:
+                    self.end_block(p, labels)
+                elif op == O.else_ and p.height is not None:
+                    self.vstack = self.vstack[:p.height]
+                    self.bind(else_labels.pop(id(p)))
+                continue
+            assert heights[i] == len(self.vstack)
+
+            if op == O.get_local:
+                self.vstack.append(p)
+            elif op in (O.i32_const, O.i64_const, O.f32_const, O.f64_const):
+                self.vstack.append(self.const(p))
+            elif op == O.set_local:
+                self.unalias(p, keep_top=True)
+                if self.retarget_last(p):
+                    self.vstack.pop()
+                else:
+                    src = self.vstack.pop()
+                    if src != p:
+                        self.emit(MOV, p, src)
+            elif op == O.tee_local:
+                self.unalias(p, keep_top=True)
+                if self.retarget_last(p):
+                    self.vstack[-1] = p
+                elif self.vstack[-1] != p:
+                    self.emit(MOV, p, self.vstack[-1])
+                    self.vstack[-1] = p
+            elif op in BINARY_OPS:
+                b = self.vstack.pop()
+                a = self.vstack.pop()
+                self.emit(BIN, self.push_result(), a, b, BINARY_OPS[op])
+            elif op in UNARY_OPS:
+                a = self.vstack.pop()
+                self.emit(UN, self.push_result(), a, None, UNARY_OPS[op])
+            elif op == O.drop:
+                self.vstack.pop()
+            elif op == O.select:
+                cond = self.vstack.pop()
+                b = self.vstack.pop()
+                a = self.vstack.pop()
+                self.emit(SELECT, self.push_result(), a, b, cond)
+            elif op in (O.block, O.loop):
+                self.materialize_all()
+                labels[id(p)] = self.new_label()
+                if op == O.loop:
+                    self.bind(labels[id(p)])
+            elif op == O.if_:
+                cond = self.vstack.pop()
+                self.materialize_all()
+                labels[id(p)] = self.new_label()
+                else_labels[id(p)] = self.new_label()
+                self.jump(JZ, else_labels[id(p)], cond)
+            elif op == O.else_:
+                if p.arity:
+                    self.materialize(p.height)
+                self.jump(JMP, labels[id(p)])
+                self.vstack = self.vstack[:p.height]
+                self.bind(else_labels.pop(id(p)))
+            elif op == O.end:
+                if p.arity:
+                    self.materialize(p.height)
+                self.end_block(p, labels)
+            elif op in (O.br, O.return_):
+                self.branch(p, labels)
+            elif op == O.br_if:
+                cond = self.vstack.pop()
+                if p.parent is None or p.branch_arity() and self.vstack[-1] != self.slot(p.height):
+                    skip = self.new_label()
+                    self.jump(JZ, skip, cond)
+                    self.branch(p, labels)
+                    self.bind(skip)
+                else:
+                    self.jump(JNZ, labels[id(p)], cond)
+            elif op == O.br_table:
+                # one stub per target block doing what a br to it does
+                index = self.vstack.pop()
+                blocks, default = p
+                stubs = {}
+                for blk in blocks + (default,):
+                    if id(blk) not in stubs:
+                        stubs[id(blk)] = blk, self.new_label()
+                self.emit(JTAB, None, index)
+                self.tables.append((len(self.code) - 1, [stubs[id(blk)][1] for blk in blocks],
+                                    stubs[id(default)][1]))
+                for blk, stub in stubs.values():
+                    self.bind(stub)
+                    self.branch(blk, labels)
+            elif op == O.call:
+                callee = self.interp.functions[p]
+                argc = len(callee.params_types())
+                args = tuple(self.vstack[len(self.vstack) - argc:])
+                del self.vstack[len(self.vstack) - argc:]
+                dst = self.push_result() if callee.return_types() else None
+                if callee.imported:
+                    target = callee.call
+                else:
+                    target = lambda args, callee=callee: execute(callee, args)
+                self.emit(CALL, dst, args, None, target)
+            elif op in memory.LOADS:
+                a = self.vstack.pop()
+                self.emit(UN, self.push_result(), a, None, memory.load_function(self.interp.memory, op, p[1]))
+            elif op in memory.STORES:
+                b = self.vstack.pop()
+                a = self.vstack.pop()
+                self.emit(STORE, None, a, b, memory.store_function(self.interp.memory, op, p[1]))
+            elif op == O.current_memory:
+                self.emit(CALL, self.push_result(), (), None, lambda args, mem=self.interp.memory: mem.pages)
+            elif op == O.grow_memory:
+                a = self.vstack.pop()
+                self.emit(CALL, self.push_result(), (a,), None, lambda args, mem=self.interp.memory: mem.grow(args[0]))
+            elif op == O.unreachable:
+                self.emit(TRAP, None, "unreachable executed")
+            elif op == O.nop:
+                pass
+            else:
+                self.emit(TODO)
+                # keep the symbolic stack consistent past the unsupported instruction
+                effect = heights[i + 1] - heights[i] if heights[i + 1] is not None else 0
+                for _ in range(-effect):
+                    self.vstack.pop()
+                for _ in range(effect):
+                    self.push_result()
+        if heights[len(code)] is not None:
+            self.emit(RET, None, self.vstack[-1] if fn.body.arity else None)
+        return self.finish()
+
+    def end_block(self, blk, labels):
+        label = labels.pop(id(blk))
+        else_label = self.else_labels.pop(id(blk), None)
+        if else_label is not None:  # if without else
+            self.bind(else_label)
+        if blk.kind != O.loop:
+            self.bind(label)
+        self.vstack = self.vstack[:blk.height] + [self.slot(blk.height + k) for k in range(blk.arity)]
+
+    def finish(self):
+        base = self.nlocals + self.max_height
+        for label in self.labels:
+            for user in label.users:
+                self.code[user][1] = label.pos
+        for user, targets, default in self.tables:
+            self.code[user][1] = tuple(label.pos for label in targets)
+            self.code[user][3] = default.pos
+        code = []
+        for kind, dst, a, b, f in self.code:
+            if kind == CALL:
+                a = tuple(self.fix(s, base) for s in a)
+            elif kind != TRAP:
+                a = self.fix(a, base)
+            if kind == SELECT:
+                f = self.fix(f, base)
+            code.append((kind, dst, a, self.fix(b, base), f))
+        template = list(self.fn.local_defaults)
+        template.extend([0] * self.max_height)
+        template.extend(self.const_values)
+        return code, template
+
+    def fix(self, s, base):
+        if s is None or s >= 0:
+            return s
+        return base + ~s
+
+
+def compile_function(interp, fn):
+    fn.reg_code, fn.reg_template = _Translator(interp, fn).translate()
+    return fn.reg_code
+
+
+def format_code(code):
+    lines = []
+    for pc, (kind, dst, a, b, f) in enumerate(code):
+        name = getattr(f, "__name__", "") if kind in (BIN, UN) else ""
+        lines.append(f"{pc:4d}: {KIND_NAMES[kind]:6s} {name} d={dst} a={a} b={b}")
+    return "\n".join(lines)
@@ -0,0 +1,113 @@
+from opcodes import Opcode as O
+from wasm import EMPTY, F32, F64, I32, I64, module
+
+# Handcrafted modules with the calls the tests make on them and the results
+# they must give, in order ("trap", message) for a call that traps. Calls
+# share one instance, so later calls see the memory of earlier ones.
+
+DIV_ZERO = ("trap", "integer divide by zero")
+OVERFLOW = ("trap", "integer overflow")
+OUT_OF_BOUNDS = ("trap", "out of bounds memory access")
+
+
+def _control():
+    fib = 7 # index of fib below
+    functions = [
+        # sum of 1..n with a loop that exits through the enclosing block
+        ([I32], [I32], [I32], [(O.block, EMPTY), (O.loop, EMPTY), (O.get_local, 0), O.i32_eqz, (O.br_if, 1),
+                               (O.get_local, 1), (O.get_local, 0), O.i32_add, (O.set_local, 1),
+                               (O.get_local, 0), (O.i32_const, 1), O.i32_sub, (O.set_local, 0), (O.br, 0),
+                               O.end, O.end, (O.get_local, 1)], "sum"),
+        ([I32], [I32], [], [(O.block, EMPTY), (O.block, EMPTY), (O.block, EMPTY), (O.get_local, 0),
+                            (O.br_table, ((0, 1), 2)), O.end, (O.i32_const, 10), O.return_, O.end,
+                            (O.i32_const, 20), O.return_, O.end, (O.i32_const, 30)], "switch"),
+        ([I32], [I32], [], [(O.get_local, 0), (O.i32_const, 0), O.i32_lt_s, (O.if_, I32), (O.i32_const, -1),
+                            O.else_, (O.get_local, 0), (O.i32_const, 0), O.i32_ne, O.end], "sign"),
+        # a value carried out of two blocks by br_if
+        ([I32], [I32], [], [(O.block, I32), (O.block, EMPTY), (O.i32_const, 7), (O.get_local, 0), (O.br_if, 1),
+                            O.drop, O.end, (O.i32_const, 9), O.end], "carry"),
+        # a return from within a loop, with unreachable code after it
+        ([I32], [I32], [], [(O.loop, EMPTY), (O.get_local, 0), (O.i32_const, 3), O.i32_ge_u, (O.if_, EMPTY),
+                            (O.get_local, 0), O.return_, O.end, (O.get_local, 0), (O.i32_const, 1), O.i32_add,
+                            (O.set_local, 0), (O.br, 0), O.end, (O.i32_const, -1)], "early"),
+        ([I32, I32, I32], [I32], [], [(O.get_local, 0), (O.get_local, 1), (O.get_local, 2), O.select], "pick"),
+        ([I64, I64], [I64], [], [(O.get_local, 0), (O.get_local, 1), O.i64_mul], "mul64"),
+        ([I32], [I32], [], [(O.get_local, 0), (O.i32_const, 2), O.i32_lt_u, (O.if_, I32), (O.get_local, 0),
+                            O.else_, (O.get_local, 0), (O.i32_const, 1), O.i32_sub, (O.call, fib),
+                            (O.get_local, 0), (O.i32_const, 2), O.i32_sub, (O.call, fib), O.i32_add, O.end], "fib"),
+        ([F64, F64], [F64], [], [(O.get_local, 0), (O.get_local, 1), O.f64_add, (O.f64_const, 0.5), O.f64_mul],
+         "average"),
+        ([F32, F32], [F32], [], [(O.get_local, 0), (O.get_local, 1), O.f32_add], "add32"),
+        ([I32], [F64], [], [(O.get_local, 0), O.f64_convert_s_i32], "convert"),
+    ]
+    calls = [
+        (("sum", [0]), 0), (("sum", [10]), 55), (("sum", [100]), 5050),
+        (("switch", [0]), 10), (("switch", [1]), 20), (("switch", [2]), 30), (("switch", [7]), 30),
+        (("switch", [-1]), 30),
+        (("sign", [-5]), -1), (("sign", [0]), 0), (("sign", [9]), 1),
+        (("carry", [1]), 7), (("carry", [0]), 9),
+        (("early", [0]), 3), (("early", [10]), 10),
+        (("pick", [1, 2, 1]), 1), (("pick", [1, 2, 0]), 2),
+        (("mul64", [2 ** 40, 2 ** 30]), 0), (("mul64", [-3, 5]), -15),
+        (("fib", [15]), 610),
+        (("average", [1.0, 2.0]), 1.5),
+        (("add32", [0.5, 0.25]), 0.75),
+        (("convert", [-7]), -7.0),
+    ]
+    return module(functions), calls
+
+
+def _traps():
+    functions = [
+        ([I32, I32], [I32], [], [(O.get_local, 0), (O.get_local, 1), O.i32_div_s], "div"),
+        ([I32, I32], [I32], [], [(O.get_local, 0), (O.get_local, 1), O.i32_rem_u], "rem"),
+        ([F64], [I32], [], [(O.get_local, 0), O.i32_trunc_s_f64], "trunc"),
+        ([], [I32], [], [O.unreachable], "unreachable"),
+        # traps in a callee, below a loop and a block of the caller
+        ([I32], [I32], [], [(O.block, I32), (O.loop, I32), (O.i32_const, 1), (O.get_local, 0), (O.call, 0),
+                            O.end, O.end], "nested"),
+    ]
+    calls = [
+        (("div", [7, 2]), 3), (("div", [-7, 2]), -3), (("div", [1, 0]), DIV_ZERO),
+        (("div", [-2 ** 31, -1]), OVERFLOW),
+        (("rem", [7, 0]), DIV_ZERO), (("rem", [7, 3]), 1),
+        (("trunc", [2.9]), 2), (("trunc", [float("nan")]), ("trap", "invalid conversion to integer")),
+        (("trunc", [1e10]), OVERFLOW),
+        (("unreachable", []), ("trap", "unreachable executed")),
+        (("nested", [0]), DIV_ZERO), (("nested", [1]), 1),
+        # the instance is fine after a trap
+        (("div", [9, 3]), 3),
+    ]
+    return module(functions), calls
+
+
+def _memory():
+    functions = [
+        ([I32], [I32], [], [(O.get_local, 0), (O.i32_load8_s, (0, 0))], "load8"),
+        ([I32, I32], [I32], [], [(O.get_local, 0), (O.get_local, 1), (O.i32_store, (2, 0)), (O.get_local, 0),
+                                 (O.i32_load, (2, 0))], "store"),
+        ([I32], [I32], [], [(O.get_local, 0), (O.i32_load16_u, (1, 16))], "load16"),
+        ([I32, I64], [I64], [], [(O.get_local, 0), (O.get_local, 1), (O.i64_store, (3, 0)), (O.get_local, 0),
+                                 (O.i64_load32_s, (2, 0))], "store64"),
+        ([I32, F64], [F64], [], [(O.get_local, 0), (O.get_local, 1), (O.f64_store, (3, 0)), (O.get_local, 0),
+                                 (O.f64_load, (3, 0))], "storef64"),
+        ([I32], [I32], [], [(O.get_local, 0), (O.grow_memory, 0)], "grow"),
+        ([], [I32], [], [(O.current_memory, 0)], "size"),
+    ]
+    calls = [
+        (("load8", [16]), 104), (("load8", [65535]), 0), (("load8", [65536]), OUT_OF_BOUNDS),
+        (("load16", [0]), 0x6568),
+        (("store", [100, 12345]), 12345), (("store", [65534, 1]), OUT_OF_BOUNDS),
+        (("store64", [200, -2]), -2), (("storef64", [300, -2.5]), -2.5),
+        (("size", []), 1), (("grow", [1]), 1), (("grow", [1]), -1), (("size", []), 2),
+        (("store", [70000, 5]), 5), (("load8", [70000]), 5),
+    ]
+    return module(functions, memory=(1, 2), data=[(16, b"hello")]), calls
+
+
+# name -> (module bytes, [((export, args), result)])
+PROGRAMS = {
+    "control": _control(),
+    "traps": _traps(),
+    "memory": _memory(),
+}
@@ -0,0 +1,18 @@
+import pytest
+
+from opcodes import Opcode as O
+from wasm import F32, load, module
+
+
+# generated functions share their namespace with the helpers of operations,
+# among them f32, which guest function 32 must not replace
+@pytest.mark.parametrize("engine", ["python", "tiered"])
+def test_many_functions(engine):
+    add = [(O.get_local, 0), (O.f32_const, 1.5), O.f32_add]
+    m = load(module([([F32], [F32], [], add, f"f{i}") for i in range(40)]))
+    inst = m.instantiate(engine=engine, hot_calls=1)
+    for _ in range(3):
+        assert inst.run_exported_fn("f32", [2.0]) == 3.5
+        assert inst.run_exported_fn("f0", [2.0]) == 3.5
+    if engine == "python":
+        assert all(fn.tier == "compiled" for fn in inst.functions)
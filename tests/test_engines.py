@@ -0,0 +1,87 @@
+import functools
+import glob
+import hashlib
+import math
+import os
+
+import pytest
+
+import parser
+from interpreter import Interpreter, Module
+from operations import Trap
+from programs import PROGRAMS
+
+# Every engine, at the lowest and the default optimization level and without
+# superinstructions, must give the same results: the handcrafted programs
+# the ones they are written with, the examples those of the stack engine
+# on unoptimized code.
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+# (module arguments, instance arguments)
+CONFIGS = {
+    "O0": ({"opt_level": 0}, {}),
+    "O2": ({"opt_level": 2}, {}),
+    "no-fuse": ({}, {"fuse": False}),
+}
+
+# calls of the examples that terminate without host functions; every other
+# example (and function) is still prepared for each engine
+EXAMPLE_CALLS = {
+    "add.wasm": [("add_one", [5]), ("add_one", [-1]), ("fac", [0]), ("fac", [1]), ("fac", [5]), ("fac", [12])],
+    "factorial.wasm": [("fac", [0.0]), ("fac", [5.0]), ("fac", [20.0])],
+    "simple.wasm": [("addTwo", [1, 2]), ("addTwo", [-1, 1]), ("addTwo", [2 ** 31 - 1, 1])],
+    "xor.wasm": [("XOR", [5, 3]), ("XOR", [-1, 0x0f0f])],
+    "hello.wasm": [("_llvm_bswap_i32", [0x12345678]), ("_memset", [1024, 7, 64]), ("_memcpy", [2048, 1024, 64])],
+    "wasm_test.wasm": [("__web_free", [0, 0])],
+    "stuff.wasm": [("e", [])],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load(source, opt_level):
+    if isinstance(source, bytes):
+        return Module(parser.Parser(source).parse(), opt_level=opt_level)
+    with open(os.path.join(EXAMPLES, source), "rb") as f:
+        return Module(parser.Parser(f).parse(), opt_level=opt_level)
+
+
+def outcome(inst, name, args):
+    try:
+        result = inst.run_exported_fn(name, args)
+    except Trap as e:
+        return "trap", str(e)
+    # NaN never equals itself
+    return "nan" if isinstance(result, float) and math.isnan(result) else result
+
+
+# the results of `calls`, twice (the tiered engine compiles functions on
+# their second call), and a digest of the memory afterwards
+def run(source, engine, config, calls):
+    module_args, instance_args = CONFIGS[config]
+    module = load(source, module_args.get("opt_level", 2))
+    inst = module.instantiate(engine=engine, hot_calls=1, hot_loops=3, **instance_args)
+    results = [outcome(inst, name, args) for _ in range(2) for name, args in calls]
+    memory = hashlib.sha256(inst.memory.data).hexdigest() if inst.memory is not None else None
+    return results, memory
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("engine", Interpreter.ENGINES)
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_program(program, engine, config):
+    data, calls = PROGRAMS[program]
+    results, memory = run(data, engine, config, [call for call, expected in calls])
+    # the second round starts from the memory the first one left
+    expected = [expected for call, expected in calls]
+    assert results[:len(calls)] == expected
+    if program != "memory":
+        assert results[len(calls):] == expected
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("engine", Interpreter.ENGINES)
+@pytest.mark.parametrize("example", sorted(os.path.basename(path) for path in glob.glob(os.path.join(EXAMPLES, "*.wasm"))))
+def test_example(example, engine, config):
+    calls = EXAMPLE_CALLS.get(example, [])
+    assert run(example, engine, config, calls) == run(example, "stack", "O0", calls)
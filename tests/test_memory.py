@@ -0,0 +1,77 @@
+import pytest
+
+from interpreter import Interpreter
+from memory import LinearMemory, PAGE_SIZE
+from operations import MASK32, Trap
+from programs import PROGRAMS
+from wasm import load
+
+
+def test_read_write():
+    mem = LinearMemory(1)
+    mem.write(10, b"abc")
+    assert mem.read(9, 5) == b"\0abc\0"
+    with pytest.raises(Trap, match="out of bounds"):
+        mem.read(PAGE_SIZE - 1, 2)
+    with pytest.raises(Trap, match="out of bounds"):
+        mem.write(PAGE_SIZE, b"x")
+
+
+def test_grow():
+    mem = LinearMemory(1, maximum=3)
+    assert mem.grow(2) == 1
+    assert mem.grow(1) == MASK32
+    assert mem.grow(0) == 3
+    assert (mem.pages, len(mem.data), len(mem.dirty)) == (3, 3 * PAGE_SIZE, 3)
+
+
+def test_restore_copies_written_pages():
+    mem = LinearMemory(4)
+    mem.write(0, b"A")
+    snapshot = mem.snapshot()
+    mem.write(PAGE_SIZE - 1, b"BC") # spans pages 0 and 1
+    assert mem.restore(snapshot) == 2
+    assert mem.read(0, 1) == b"A" and mem.read(PAGE_SIZE - 1, 2) == b"\0\0"
+    assert mem.restore(snapshot) == 0
+
+
+def test_restore_drops_grown_pages():
+    mem = LinearMemory(1)
+    snapshot = mem.snapshot()
+    mem.grow(2)
+    mem.write(2 * PAGE_SIZE, b"x")
+    mem.restore(snapshot)
+    assert (mem.pages, len(mem.data), len(mem.dirty)) == (1, PAGE_SIZE, 1)
+
+
+# the dirty flags only cover the latest snapshot; older ones are copied back whole
+def test_restore_older_snapshot():
+    mem = LinearMemory(2)
+    mem.write(0, b"A")
+    older = mem.snapshot()
+    mem.write(0, b"B")
+    newer = mem.snapshot()
+    mem.write(PAGE_SIZE + 4, b"C")
+    mem.restore(older)
+    assert mem.read(0, 1) == b"A" and mem.read(PAGE_SIZE + 4, 1) == b"\0"
+    mem.restore(newer)
+    assert mem.read(0, 1) == b"B" and mem.read(PAGE_SIZE + 4, 1) == b"\0"
+    mem.grow(1)
+    mem.restore(older)
+    assert mem.pages == 2 and mem.read(0, 1) == b"A"
+
+
+# every engine marks the pages it stores to, so that restore finds them
+@pytest.mark.parametrize("engine", Interpreter.ENGINES)
+def test_instance_restore(engine):
+    inst = load(PROGRAMS["memory"][0]).instantiate(engine=engine, hot_calls=1)
+    snapshot = inst.snapshot()
+    initial = bytes(inst.memory.data)
+    for _ in range(2):
+        assert inst.run_exported_fn("store", [100, 12345]) == 12345
+        assert inst.run_exported_fn("store64", [65528, -2]) == -2
+        assert inst.run_exported_fn("grow", [1]) == 1
+        assert inst.run_exported_fn("store", [70000, 5]) == 5
+        inst.restore(snapshot)
+        assert inst.memory.pages == 1
+        assert bytes(inst.memory.data) == initial
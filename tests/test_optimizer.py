@@ -0,0 +1,100 @@
+import optimizer
+from opcodes import Op, Opcode as O
+from operations import MASK32
+from wasm import EMPTY, I32, load, module
+
+
+def ops(*instrs):
+    return [instr if isinstance(instr, Op) else Op(*instr) if isinstance(instr, tuple) else Op(instr, None)
+            for instr in instrs]
+
+
+def kept(code):
+    return [(instr.opcode, instr.payload) for instr in code if instr is not None]
+
+
+def test_fold_constants():
+    code = ops((O.i32_const, 2), (O.i32_const, 3), O.i32_add, O.i32_eqz)
+    optimizer.fold_constants(code)
+    assert kept(code) == [(O.i32_const, 0)]
+
+
+def test_fold_constants_wraps_like_the_interpreter():
+    code = ops((O.i32_const, MASK32), (O.i32_const, 1), O.i32_add)
+    optimizer.fold_constants(code)
+    assert kept(code) == [(O.i32_const, 0)]
+
+
+def test_fold_constants_keeps_traps():
+    code = ops((O.i32_const, 1), (O.i32_const, 0), O.i32_div_u)
+    optimizer.fold_constants(code)
+    assert kept(code) == [(O.i32_const, 1), (O.i32_const, 0), (O.i32_div_u, None)]
+
+
+def test_fold_constant_branches():
+    code = ops((O.i32_const, 1), (O.br_if, "block"), (O.i32_const, 0), (O.br_if, "block"))
+    optimizer.fold_constants(code)
+    assert kept(code) == [(O.br, "block")]
+
+
+def test_fold_constants_stops_at_control_flow():
+    code = ops((O.i32_const, 2), (O.block, "block"), (O.i32_const, 3), O.i32_add)
+    optimizer.fold_constants(code)
+    assert len(kept(code)) == 4
+
+
+def test_remove_unreachable():
+    code = ops((O.block, "outer"), (O.br, "outer"), (O.block, "inner"), (O.i32_const, 1), O.drop, (O.end, "inner"),
+               O.nop, (O.end, "outer"), (O.i32_const, 2))
+    optimizer.remove_unreachable(code)
+    assert kept(code) == [(O.block, "outer"), (O.br, "outer"), (O.end, "outer"), (O.i32_const, 2)]
+
+
+def test_propagate_copies():
+    code = ops((O.get_local, 0), (O.set_local, 1), (O.get_local, 1), (O.get_local, 0), (O.set_local, 0),
+               (O.get_local, 1))
+    optimizer.propagate_copies(code)
+    # the copy is read from the original until the original changes
+    assert kept(code) == [(O.get_local, 0), (O.set_local, 1), (O.get_local, 0), (O.get_local, 0), (O.set_local, 0),
+                          (O.get_local, 1)]
+
+
+def test_remove_dead_stores():
+    code = ops((O.i32_const, 1), (O.set_local, 1), (O.i32_const, 2), (O.tee_local, 2), (O.set_local, 0),
+               (O.get_local, 0))
+    optimizer.remove_dead_stores(code)
+    assert kept(code) == [(O.i32_const, 1), (O.drop, None), (O.i32_const, 2), (O.set_local, 0), (O.get_local, 0)]
+
+
+def test_simplify_locals():
+    cases = [
+        (ops((O.get_local, 0), (O.set_local, 0)), []),
+        (ops((O.set_local, 0), (O.get_local, 0)), [(O.tee_local, 0)]),
+        (ops((O.tee_local, 0), (O.set_local, 0)), [(O.set_local, 0)]),
+        (ops((O.tee_local, 0), O.drop), [(O.set_local, 0)]),
+        (ops((O.get_local, 0), O.drop), []),
+        (ops((O.i32_const, 5), O.drop), []),
+    ]
+    for code, expected in cases:
+        optimizer.simplify_locals(code)
+        assert kept(code) == expected
+
+
+# blocks keep pointing at their instructions once the deleted ones are gone
+def test_optimize_moves_block_offsets():
+    body = [(O.i32_const, 1), (O.i32_const, 2), O.i32_add, O.drop, (O.block, EMPTY), (O.get_local, 0),
+            (O.br_if, 0), O.end, (O.get_local, 0)]
+    m = load(module([([I32], [I32], [], body, "f")]), opt_level=2)
+    prepared = m.body(0)
+    block = prepared.code[0].payload
+    assert [instr.opcode for instr in prepared.code] == [O.block, O.get_local, O.br_if, O.end, O.get_local]
+    assert (block.startOffs, block.endOffs) == (0, 3)
+    assert [name for name, count in prepared.opt_counts] == ["input"] + [name for name, level, run in optimizer.PASSES]
+    assert m.instantiate().run_exported_fn("f", [4]) == 4
+
+
+def test_level_zero_keeps_the_code():
+    body = [(O.i32_const, 1), (O.i32_const, 2), O.i32_add]
+    m = load(module([([], [I32], [], body, "f")]), opt_level=0)
+    assert len(m.body(0).code) == 3
+    assert m.body(0).opt_counts == [("input", 3)]
@@ -0,0 +1,70 @@
+import glob
+import os
+import re
+
+import pytest
+
+import parser
+from interpreter import Module
+from opcodes import Opcode as O
+from programs import PROGRAMS
+from validation import ValidationError
+from wasm import EMPTY, I32, I64, load, module
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+
+def function(body, params=(I32,), results=(I32,), locals=()):
+    return module([(list(params), list(results), list(locals), body, "f")])
+
+
+@pytest.mark.parametrize("path", sorted(glob.glob(os.path.join(EXAMPLES, "*.wasm"))))
+def test_examples_are_valid(path):
+    with open(path, "rb") as f:
+        load(f.read(), validate=True)
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_programs_are_valid(program):
+    load(PROGRAMS[program][0], validate=True)
+
+
+@pytest.mark.parametrize("body, message", [
+    ([(O.i32_const, 1), O.i32_add], "instruction 1 (i32_add): expected i32 but the operand stack is empty"),
+    ([(O.i64_const, 1)], "expected i32 but found i64"),
+    ([(O.get_local, 0), (O.get_local, 0)], "i32 left on the operand stack at the end of the block"),
+    ([(O.br, 1)], "unknown label 1"),
+    ([(O.get_local, 3)], "unknown local 3"),
+    ([(O.call, 5)], "unknown function 5"),
+    ([(O.get_local, 0), (O.i32_load, (0, 0))], "no memory"),
+    ([(O.get_local, 0), (O.if_, I32), (O.i32_const, 1), O.end], "an if without else cannot produce a value"),
+    ([(O.block, I32), (O.block, I64), (O.i32_const, 0), (O.get_local, 0), (O.br_table, ((0,), 1)), O.end, O.drop,
+      (O.i32_const, 0), O.end], "label 0 takes other values than the default label 1"),
+])
+def test_invalid_function(body, message):
+    with pytest.raises(ValidationError, match=re.escape(message)):
+        load(function(body), validate=True)
+
+
+def test_misaligned_access():
+    data = module([([I32], [I32], [], [(O.get_local, 0), (O.i32_load, (3, 0))], "f")], memory=1)
+    with pytest.raises(ValidationError, match=re.escape("alignment 2**3 is larger than the access size 4")):
+        load(data, validate=True)
+
+
+# after an unconditional branch the operand stack is polymorphic
+def test_unreachable_code_is_polymorphic():
+    load(function([O.unreachable, O.i32_add]), validate=True)
+    load(function([(O.block, EMPTY), (O.br, 0), O.i64_add, O.drop, O.end, (O.i32_const, 0)]), validate=True)
+
+
+def test_unvalidated_module_loads():
+    load(function([(O.i64_const, 1)]))
+
+
+# lazily parsed bodies are validated when they are first prepared
+def test_lazy_bodies_are_validated_on_use():
+    res = parser.Parser(function([(O.i32_const, 1), O.i32_add]), lazy=True).parse()
+    m = Module(res, validate=True)
+    with pytest.raises(ValidationError, match="i32_add"):
+        m.instantiate().run_exported_fn("f", [1])
@@ -0,0 +1,100 @@
+import struct
+
+import parser
+from interpreter import Module
+from opcodes import Opcode as O
+
+# Builds small binary modules for the tests. Function bodies are lists of
+# instructions: an Opcode, or (Opcode, immediate) with the immediate encoded
+# as the opcode needs it.
+
+I32, I64, F32, F64 = 0x7f, 0x7e, 0x7d, 0x7c
+EMPTY = 0x40
+
+
+def uleb(n):
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7f, n >> 7
+        if not n:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def sleb(n):
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7f, n >> 7
+        if (n == 0 and not byte & 0x40) or (n == -1 and byte & 0x40):
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def vec(items):
+    return uleb(len(items)) + b"".join(items)
+
+
+def section(id, payload):
+    return bytes([id]) + uleb(len(payload)) + payload
+
+
+def name(s):
+    return uleb(len(s.encode())) + s.encode()
+
+
+def immediate(op, arg):
+    if op in (O.block, O.loop, O.if_):
+        return bytes([arg])
+    if op in (O.i32_const, O.i64_const):
+        return sleb(arg)
+    if op == O.f32_const:
+        return struct.pack("<f", arg)
+    if op == O.f64_const:
+        return struct.pack("<d", arg)
+    if op == O.br_table:
+        targets, default = arg
+        return vec([uleb(t) for t in targets]) + uleb(default)
+    if isinstance(arg, tuple): # memory access: (alignment, offset)
+        return uleb(arg[0]) + uleb(arg[1])
+    return uleb(arg)
+
+
+def code(instrs):
+    out = bytearray()
+    for instr in instrs:
+        op, arg = instr if isinstance(instr, tuple) else (instr, None)
+        out.append(op.value)
+        if arg is not None:
+            out += immediate(op, arg)
+    return bytes(out)
+
+
+# functions: (params, results, locals, body, export name or None)
+def module(functions, memory=None, data=()):
+    types = []
+    for params, results, locals, body, export in functions:
+        if (params, results) not in types:
+            types.append((params, results))
+    out = b"\0asm" + struct.pack("<I", 1)
+    out += section(1, vec([b"\x60" + vec([bytes([t]) for t in params]) + vec([bytes([t]) for t in results])
+                           for params, results in types]))
+    out += section(3, vec([uleb(types.index((f[0], f[1]))) for f in functions]))
+    if memory is not None: # initial pages, or (initial, maximum)
+        limits = b"\x00" + uleb(memory) if isinstance(memory, int) else b"\x01" + uleb(memory[0]) + uleb(memory[1])
+        out += section(5, vec([limits]))
+    out += section(7, vec([name(f[4]) + b"\x00" + uleb(i) for i, f in enumerate(functions) if f[4] is not None]))
+    bodies = []
+    for params, results, locals, body, export in functions:
+        payload = vec([uleb(1) + bytes([t]) for t in locals]) + code(body) + bytes([O.end.value])
+        bodies.append(uleb(len(payload)) + payload)
+    out += section(10, vec(bodies))
+    if data:
+        out += section(11, vec([b"\x00" + bytes([O.i32_const.value]) + sleb(offset) + bytes([O.end.value]) +
+                                uleb(len(d)) + d for offset, d in data]))
+    return out
+
+
+def load(data, **module_args):
+    return Module(parser.Parser(data).parse(), **module_args)
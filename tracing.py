@@ -0,0 +1,76 @@
+import collections
+import enum
+import sys
+
+
+class TraceLevel(enum.IntEnum):
+    off = 0
+    info = 1    # parser sections, module setup
+    calls = 2   # function entry / exit
+    instr = 3   # every executed instruction plus operand stack
+
+
+TraceRecord = collections.namedtuple("TraceRecord", ("level", "event", "args"))
+
+
+def format_record(record):
+    return f"[{record.event}] " + " ".join(str(a) for a in record.args)
+
+
+class NullSink:
+    def emit(self, record):
+        pass
+
+
+class StderrSink:
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+
+    def emit(self, record):
+        print(format_record(record), file=self.stream)
+
+
+class RingBufferSink:
+    def __init__(self, capacity=4096):
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream=None):
+        stream = stream if stream is not None else sys.stderr
+        for record in self.records:
+            print(format_record(record), file=stream)
+
+    def clear(self):
+        self.records.clear()
+
+
+def _noop(*args):
+    pass
+
+
+class Tracer:
+    def __init__(self, level=TraceLevel.off, sink=None):
+        if sink is None:
+            sink = StderrSink() if level > TraceLevel.off else NullSink()
+        self.level = TraceLevel(level)
+        self.sink = sink
+
+    def enabled(self, level):
+        return self.level >= level and not isinstance(self.sink, NullSink)
+
+    # Returns a callable emitting records for `event`. When the level is
+    # disabled this is a shared no-op, so callers can bind it once and call it
+    # unconditionally off the hot paths.
+    def channel(self, level, event):
+        if not self.enabled(level):
+            return _noop
+        sink = self.sink
+
+        def emit(*args):
+            sink.emit(TraceRecord(level, event, args))
+        return emit
+
+
+NO_TRACE = Tracer()
@@ -0,0 +1,361 @@
+import memory
+import parser
+from opcodes import Opcode as O
+from operations import UNARY_OPS, BINARY_OPS
+
+# Load-time validation of a module against the type system of the MVP.
+# Every function body is type-checked in one pass over its code, with the
+# operand and control stacks of the validation algorithm in the spec's
+# appendix: the types on the operand stack are tracked through every block,
+# branch and call, and unreachable code is checked against a polymorphic
+# stack. A valid module cannot underflow the operand stack, pass the wrong
+# number of arguments or branch to a missing label, so instances of a
+# validated module skip the interpreter's consistency checks (see Module).
+
+T = parser.Type
+VALUE_TYPES = (T.i32, T.i64, T.f32, T.f64)
+MAX_PAGES = 0x10000
+
+
+class ValidationError(Exception):
+    pass
+
+
+# (operand types, result type) of the numeric instructions, from their names:
+# the result type comes first, conversions name the operand type last and
+# comparisons produce an i32
+NUMERIC = {}
+for op in list(UNARY_OPS) + list(BINARY_OPS):
+    parts = op.name.split("_")
+    result = T[parts[0]]
+    operand = T[parts[-1]] if parts[-1] in T.__members__ and len(parts) > 2 else result
+    if parts[1] in ("eqz", "eq", "ne", "lt", "gt", "le", "ge"):
+        result = T.i32
+    NUMERIC[op] = ((operand,) if op in UNARY_OPS else (operand, operand), result)
+
+CONSTS = {O.i32_const: T.i32, O.i64_const: T.i64, O.f32_const: T.f32, O.f64_const: T.f64}
+
+
+def type_name(t):
+    return "<any>" if t is None else t.name
+
+
+def function_name(module, id):
+    names = dict(module.name_section[1] or ()) if module.name_section else {}
+    return f"function {id} ({names[id]})" if id in names else f"function {id}"
+
+
+# a control frame: the block's label types (what a branch to it takes) and
+# result types, the operand stack height at its entry and whether the rest
+# of it is unreachable
+class _Ctrl:
+    def __init__(self, opcode, labels, results, height):
+        self.opcode = opcode
+        self.labels = labels
+        self.results = results
+        self.height = height
+        self.unreachable = False
+
+
+class _FunctionValidator:
+    def __init__(self, module, id, fn_type, locals):
+        self.module = module
+        self.id = id
+        params, self.results = fn_type[1]
+        self.locals = list(params) + [t for count, t in locals for _ in range(count)]
+        self.vals = []  # operand types, None for unknown (unreachable code)
+        self.ctrls = []
+        self.pc = 0
+        self.op = None
+
+    def error(self, message):
+        where = f"{function_name(self.module, self.id)}, instruction {self.pc}"
+        if self.op is not None:
+            where += f" ({self.op.name})"
+        raise ValidationError(f"{where}: {message}")
+
+    def push(self, t):
+        self.vals.append(t)
+
+    def pop(self, expected=None):
+        ctrl = self.ctrls[-1]
+        if len(self.vals) == ctrl.height:
+            if ctrl.unreachable:
+                return expected
+            self.error(f"expected {type_name(expected)} but the operand stack is empty")
+        actual = self.vals.pop()
+        if actual is None:
+            return expected
+        if expected is not None and actual != expected:
+            self.error(f"expected {type_name(expected)} but found {type_name(actual)}")
+        return actual
+
+    def pop_all(self, types):
+        for t in reversed(types):
+            self.pop(t)
+
+    def push_ctrl(self, opcode, labels, results):
+        self.ctrls.append(_Ctrl(opcode, labels, results, len(self.vals)))
+
+    def pop_ctrl(self):
+        ctrl = self.ctrls[-1]
+        self.pop_all(ctrl.results)
+        if len(self.vals) != ctrl.height:
+            left = ", ".join(type_name(t) for t in self.vals[ctrl.height:])
+            self.error(f"{left} left on the operand stack at the end of the block")
+        self.ctrls.pop()
+        return ctrl
+
+    def set_unreachable(self):
+        ctrl = self.ctrls[-1]
+        del self.vals[ctrl.height:]
+        ctrl.unreachable = True
+
+    def label(self, depth):
+        if depth >= len(self.ctrls):
+            self.error(f"unknown label {depth}")
+        return self.ctrls[-1 - depth].labels
+
+    def local(self, index):
+        if index >= len(self.locals):
+            self.error(f"unknown local {index}")
+        return self.locals[index]
+
+    def global_(self, index):
+        if index >= len(self.module.globals):
+            self.error(f"unknown global {index}")
+        return self.module.globals[index]
+
+    def memory_access(self, payload, size):
+        if not self.module.has_memory:
+            self.error("no memory")
+        if 1 << payload[0] > size:
+            self.error(f"alignment 2**{payload[0]} is larger than the access size {size}")
+
+    def block_type(self, t):
+        if t == T.empty_block:
+            return []
+        if t not in VALUE_TYPES:
+            self.error(f"invalid block type {t}")
+        return [t]
+
+    def run(self, code):
+        self.push_ctrl(O.block, self.results, self.results)
+        for self.pc, instr in enumerate(code):
+            self.op = op = instr.opcode
+            p = instr.payload
+            if not self.ctrls:
+                self.error("instruction after the end of the function")
+            if op in NUMERIC:
+                operands, result = NUMERIC[op]
+                self.pop_all(operands)
+                self.push(result)
+            elif op in CONSTS:
+                self.push(CONSTS[op])
+            elif op == O.get_local:
+                self.push(self.local(p))
+            elif op == O.set_local:
+                self.pop(self.local(p))
+            elif op == O.tee_local:
+                self.pop(self.local(p))
+                self.push(self.local(p))
+            elif op in memory.LOADS:
+                self.memory_access(p, memory.LOADS[op][0].size)
+                self.pop(T.i32)
+                self.push(T[op.name[:3]])
+            elif op in memory.STORES:
+                self.memory_access(p, memory.STORES[op][0].size)
+                self.pop(T[op.name[:3]])
+                self.pop(T.i32)
+            elif op in (O.block, O.loop):
+                results = self.block_type(p)
+                self.push_ctrl(op, [] if op == O.loop else results, results)
+            elif op == O.if_:
+                self.pop(T.i32)
+                results = self.block_type(p)
+                self.push_ctrl(op, results, results)
+            elif op == O.else_:
+                if self.ctrls[-1].opcode != O.if_:
+                    self.error("else outside of an if")
+                ctrl = self.pop_ctrl()
+                self.push_ctrl(O.else_, ctrl.labels, ctrl.results)
+            elif op == O.end:
+                ctrl = self.pop_ctrl()
+                if ctrl.opcode == O.if_ and ctrl.results:
+                    self.error("an if without else cannot produce a value")
+                for t in ctrl.results:
+                    self.push(t)
+            elif op == O.br:
+                self.pop_all(self.label(p))
+                self.set_unreachable()
+            elif op == O.br_if:
+                self.pop(T.i32)
+                labels = self.label(p)
+                self.pop_all(labels)
+                for t in labels:
+                    self.push(t)
+            elif op == O.br_table:
+                count, table, default = p
+                self.pop(T.i32)
+                labels = self.label(default)
+                for depth in table:
+                    if self.label(depth) != labels:
+                        self.error(f"label {depth} takes other values than the default label {default}")
+                self.pop_all(labels)
+                self.set_unreachable()
+            elif op == O.return_:
+                self.pop_all(self.results)
+                self.set_unreachable()
+            elif op == O.unreachable:
+                self.set_unreachable()
+            elif op == O.nop:
+                pass
+            elif op == O.call:
+                if p >= len(self.module.signatures):
+                    self.error(f"unknown function {p}")
+                params, results = self.module.signatures[p]
+                self.pop_all(params)
+                for t in results:
+                    self.push(t)
+            elif op == O.call_indirect:
+                type_index, reserved = p
+                if not self.module.has_table:
+                    self.error("no table")
+                if type_index >= len(self.module.type_section):
+                    self.error(f"unknown type {type_index}")
+                params, results = self.module.type_section[type_index][1]
+                self.pop(T.i32)
+                self.pop_all(params)
+                for t in results:
+                    self.push(t)
+            elif op == O.drop:
+                self.pop()
+            elif op == O.select:
+                self.pop(T.i32)
+                t1 = self.pop()
+                t2 = self.pop(t1)
+                self.push(t1 if t2 is None else t2)
+            elif op == O.get_global:
+                self.push(self.global_(p)[0])
+            elif op == O.set_global:
+                t, mutable = self.global_(p)
+                if not mutable:
+                    self.error(f"global {p} is immutable")
+                self.pop(t)
+            elif op == O.current_memory:
+                self.memory_access((0, 0), 1)
+                self.push(T.i32)
+            elif op == O.grow_memory:
+                self.memory_access((0, 0), 1)
+                self.pop(T.i32)
+                self.push(T.i32)
+            else:
+                self.error("unknown instruction")
+        # the decoded code ends before the function's final 'end'
+        self.pc, self.op = len(code), None
+        if len(self.ctrls) != 1:
+            self.error("block without end" if self.ctrls else "missing final end")
+        self.pop_ctrl()
+
+
+# Type-checks the body of function `id` (locals and decoded code, before
+# prepare_body) against `module` (see Module). Raises ValidationError.
+def validate_function(module, id, fn_type, locals, code):
+    _FunctionValidator(module, id, fn_type, locals).run(code)
+
+
+# type of a constant expression (global initializers, segment offsets)
+def init_expr_type(res, globals, expr, what):
+    if expr.opcode in CONSTS:
+        return CONSTS[expr.opcode]
+    if expr.opcode == O.get_global:
+        imported = sum(kind == parser.ExternalKind.Global for module, field, kind, type in res.import_section or ())
+        if expr.payload >= imported:
+            raise ValidationError(f"{what}: only imported globals can be read in a constant expression")
+        return globals[expr.payload][0]
+    raise ValidationError(f"{what}: {expr.opcode.name} is not a constant expression")
+
+
+def check_limits(limits, maximum, what):
+    flags, initial, limit = limits
+    if initial > maximum or limit is not None and limit > maximum:
+        raise ValidationError(f"{what}: limits exceed {maximum}")
+    if limit is not None and initial > limit:
+        raise ValidationError(f"{what}: initial size {initial} is larger than the maximum {limit}")
+
+
+# Checks the module's sections outside of function bodies (indices, limits,
+# constant expressions, exports, start function) on a parse result.
+# Raises ValidationError.
+def validate_module(res):
+    types = res.type_section or []
+    for i, (form, signature) in enumerate(types):
+        if form != T.func:
+            raise ValidationError(f"type {i}: not a function type")
+    functions, tables, memories, globals = [], [], [], []
+    for module, field, kind, type in res.import_section or ():
+        what = f"import {module}.{field}"
+        if kind == parser.ExternalKind.Func:
+            if type >= len(types):
+                raise ValidationError(f"{what}: unknown type {type}")
+            functions.append(types[type][1])
+        elif kind == parser.ExternalKind.Table:
+            tables.append(type)
+        elif kind == parser.ExternalKind.Memory:
+            memories.append(type)
+        else:
+            if type[1]:
+                raise ValidationError(f"{what}: imported globals must be immutable")
+            globals.append(type)
+    for i, type in enumerate(res.function_section or ()):
+        if type >= len(types):
+            raise ValidationError(f"function {len(functions)}: unknown type {type}")
+        functions.append(types[type][1])
+    if len(res.function_section or ()) != len(res.code_section or ()):
+        raise ValidationError(f"{len(res.function_section or ())} functions declared "
+                              f"but {len(res.code_section or ())} bodies")
+    tables += res.table_section or ()
+    memories += res.memory_section or ()
+    if len(tables) > 1:
+        raise ValidationError("more than one table")
+    if len(memories) > 1:
+        raise ValidationError("more than one memory")
+    for elem_type, limits in tables:
+        if elem_type != T.anyfunc:
+            raise ValidationError("table element type must be anyfunc")
+        check_limits(limits, 0xffffffff, "table")
+    for limits in memories:
+        check_limits(limits, MAX_PAGES, "memory")
+    for i, ((type, mutable), init) in enumerate(res.global_section or ()):
+        what = f"global {len(globals)}"
+        if init_expr_type(res, globals, init, what) != type:
+            raise ValidationError(f"{what}: initializer is not of type {type.name}")
+        globals.append((type, mutable))
+
+    counts = {parser.ExternalKind.Func: len(functions), parser.ExternalKind.Table: len(tables),
+              parser.ExternalKind.Memory: len(memories), parser.ExternalKind.Global: len(globals)}
+    names = set()
+    for name, kind, index in res.export_section or ():
+        if name in names:
+            raise ValidationError(f"export {name}: duplicate name")
+        names.add(name)
+        if index >= counts[kind]:
+            raise ValidationError(f"export {name}: unknown {kind} {index}")
+    if res.start_section is not None:
+        if res.start_section >= len(functions):
+            raise ValidationError(f"start: unknown function {res.start_section}")
+        if functions[res.start_section] != ([], []):
+            raise ValidationError("start: the start function must take and return nothing")
+    for i, (index, offset, count, elems) in enumerate(res.element_section or ()):
+        if index >= len(tables):
+            raise ValidationError(f"element segment {i}: unknown table {index}")
+        if init_expr_type(res, globals, offset, f"element segment {i}") != T.i32:
+            raise ValidationError(f"element segment {i}: offset is not an i32")
+        for fn in elems:
+            if fn >= len(functions):
+                raise ValidationError(f"element segment {i}: unknown function {fn}")
+    for i, (index, offset, size, data) in enumerate(res.data_section or ()):
+        if index >= len(memories):
+            raise ValidationError(f"data segment {i}: unknown memory {index}")
+        if init_expr_type(res, globals, offset, f"data segment {i}") != T.i32:
+            raise ValidationError(f"data segment {i}: offset is not an i32")